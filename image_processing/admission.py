@@ -0,0 +1,272 @@
+"""
+Admission control for running conversions in parallel within a memory budget.
+
+Each job's peak memory is estimated from its image header with a linear model of the uncompressed image size, which
+can be calibrated against measured peaks with :func:`MemoryModel.fit`. Jobs only start when their estimate fits into
+what's left of the budget, and whenever memory is freed the largest waiting job that fits is started (first fit
+decreasing), so small jobs are packed around large ones instead of waiting behind them.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import logging
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
+
+ImageHeader = namedtuple('ImageHeader', ['width', 'height', 'channels', 'bits_per_sample', 'mode', 'compressed'])
+"""The properties of an image which determine how much memory converting it takes"""
+
+JobResult = namedtuple('JobResult', ['job', 'estimate', 'result', 'error'])
+"""The outcome of a job run by :func:`run_jobs`. error is the exception it raised, or None"""
+
+_BITS_PER_SAMPLE_BY_MODE = {'1': 1, 'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'I': 32, 'F': 32}
+
+TIFF_BITS_PER_SAMPLE_TAG = 258
+TIFF_COMPRESSION_TAG = 259
+TIFF_NO_COMPRESSION = 1
+
+
+def read_image_header(image_filepath):
+    """
+    Read the image properties from its header, without decoding the pixels
+
+    :param image_filepath:
+    :return: :class:`ImageHeader`
+    """
+    with Image.open(image_filepath) as image_pil:
+        width, height = image_pil.size
+        channels = len(image_pil.getbands())
+        bits_per_sample = _BITS_PER_SAMPLE_BY_MODE.get(image_pil.mode, 8)
+        compressed = image_pil.format != 'TIFF'
+        tags = getattr(image_pil, 'tag_v2', None)
+        if tags is not None:
+            tiff_bits = tags.get(TIFF_BITS_PER_SAMPLE_TAG)
+            if tiff_bits:
+                tiff_bits = tiff_bits if isinstance(tiff_bits, tuple) else (tiff_bits,)
+                bits_per_sample = max(tiff_bits)
+                channels = max(channels, len(tiff_bits))
+            compressed = tags.get(TIFF_COMPRESSION_TAG, TIFF_NO_COMPRESSION) != TIFF_NO_COMPRESSION
+        return ImageHeader(width=width, height=height, channels=channels, bits_per_sample=bits_per_sample,
+                           mode=image_pil.mode, compressed=compressed)
+
+
+def uncompressed_bytes(header):
+    """
+    :param header: :class:`ImageHeader`
+    :return: the size of the decoded image in bytes
+    """
+    return header.width * header.height * header.channels * max(header.bits_per_sample, 8) // 8
+
+
+class MemoryModel(object):
+    """
+    Estimates the peak memory of converting an image as
+    ``base_bytes + per_byte * uncompressed size (+ compressed_per_byte * uncompressed size if compressed)``.
+
+    The defaults are deliberately pessimistic: the lossless check holds the source and the expanded jp2 in memory at
+    the same time, and Pillow's jpg resizing makes another copy. Calibrate them for your machines and recipes with
+    :func:`fit`.
+    """
+
+    def __init__(self, base_bytes=256 * 1024 ** 2, per_byte=3.0, compressed_per_byte=1.0):
+        """
+        :param base_bytes: memory used regardless of the image size, e.g. by the interpreter and kakadu
+        :param per_byte: bytes of memory per byte of the uncompressed image
+        :param compressed_per_byte: extra bytes of memory per byte of the uncompressed image, when the source is
+            compressed and has to be decoded into a separate buffer
+        """
+        self.base_bytes = base_bytes
+        self.per_byte = per_byte
+        self.compressed_per_byte = compressed_per_byte
+
+    def estimate(self, header):
+        """
+        :param header: :class:`ImageHeader`
+        :return: estimated peak memory in bytes
+        """
+        size = uncompressed_bytes(header)
+        return int(self.base_bytes + size * (self.per_byte + (self.compressed_per_byte if header.compressed else 0)))
+
+    def estimate_file(self, image_filepath):
+        """
+        :return: estimated peak memory in bytes of converting the image file
+        """
+        return self.estimate(read_image_header(image_filepath))
+
+    @classmethod
+    def fit(cls, samples):
+        """
+        Calibrate a model with least squares.
+        If none of the samples are compressed (or all are), the compressed coefficient is set to 0.
+
+        :param samples: list of (:class:`ImageHeader`, measured peak memory in bytes) pairs, e.g. from the maximum
+            resident set size of processes converting one image each (which Linux reports in kilobytes)
+        :return: :class:`MemoryModel`
+        """
+        rows = [[1.0, uncompressed_bytes(header), uncompressed_bytes(header) if header.compressed else 0.0]
+                for header, _ in samples]
+        peaks = [float(peak) for _, peak in samples]
+        if len(set(row[2] > 0 for row in rows)) < 2:
+            rows = [row[:2] for row in rows]
+        coefficients = _least_squares(rows, peaks)
+        compressed_per_byte = coefficients[2] if len(coefficients) > 2 else 0.0
+        return cls(base_bytes=max(coefficients[0], 0.0), per_byte=coefficients[1],
+                   compressed_per_byte=compressed_per_byte)
+
+
+def _least_squares(rows, values):
+    """
+    Solve the normal equations (A^T A) x = A^T b by Gaussian elimination, as the systems here are tiny
+    """
+    columns = len(rows[0])
+    if len(rows) < columns:
+        raise ValueError("Need at least {0} samples to fit the model".format(columns))
+    matrix = [[sum(row[i] * row[j] for row in rows) for j in range(columns)] +
+              [sum(row[i] * value for row, value in zip(rows, values))] for i in range(columns)]
+    for i in range(columns):
+        pivot = max(range(i, columns), key=lambda r: abs(matrix[r][i]))
+        if matrix[pivot][i] == 0:
+            raise ValueError("Samples don't vary enough to fit the model")
+        matrix[i], matrix[pivot] = matrix[pivot], matrix[i]
+        for r in range(columns):
+            if r != i:
+                factor = matrix[r][i] / matrix[i][i]
+                matrix[r] = [a - factor * b for a, b in zip(matrix[r], matrix[i])]
+    return [matrix[i][columns] / matrix[i][i] for i in range(columns)]
+
+
+class AdmissionController(object):
+    """
+    Keeps the total estimated memory of the jobs running at once within a budget.
+    A job larger than the whole budget is admitted when nothing else is running, so it can't wait forever.
+    Thread safe.
+    """
+
+    def __init__(self, memory_budget):
+        """
+        :param memory_budget: bytes
+        """
+        self.memory_budget = memory_budget
+        self.used = 0
+        self.running = 0
+        self._condition = threading.Condition()
+
+    def fits(self, estimate):
+        """
+        :return: True if a job with this estimate could be admitted now
+        """
+        with self._condition:
+            return self._fits(estimate)
+
+    def _fits(self, estimate):
+        return self.running == 0 or self.used + estimate <= self.memory_budget
+
+    def try_admit(self, estimate):
+        """
+        Admit the job if it fits, without waiting
+
+        :return: True if it was admitted. It must then be released with :func:`release`
+        """
+        with self._condition:
+            if not self._fits(estimate):
+                return False
+            self.used += estimate
+            self.running += 1
+            return True
+
+    def admit(self, estimate, timeout=None):
+        """
+        Wait until the job fits, then admit it. It must be released with :func:`release`
+
+        :param estimate: the job's estimated peak memory in bytes
+        :param timeout: the longest time to wait in seconds, or None to wait as long as it takes
+        :return: True if it was admitted, False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._fits(estimate):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.used += estimate
+            self.running += 1
+            return True
+
+    def release(self, estimate):
+        with self._condition:
+            self.used -= estimate
+            self.running -= 1
+            self._condition.notify_all()
+
+
+def first_fit_decreasing(estimates, available):
+    """
+    Choose which of the waiting jobs to start: the largest that fits, then the largest of the rest that fits in what's
+    left, and so on
+
+    :param estimates: list of (job, estimate) pairs
+    :param available: bytes of the budget which are free
+    :return: the chosen (job, estimate) pairs
+    """
+    chosen = []
+    for job, estimate in sorted(estimates, key=lambda pair: pair[1], reverse=True):
+        if estimate <= available:
+            chosen.append((job, estimate))
+            available -= estimate
+    return chosen
+
+
+def run_jobs(jobs, function, memory_budget, max_workers, memory_model=None):
+    """
+    Run function(job) for each job, with at most max_workers at once and their estimated peak memory within the
+    budget. Whenever a job finishes, the largest waiting jobs that fit are started.
+
+    :param jobs: list of image filepaths
+    :param function: called with each filepath, e.g. a DerivativeFilesGenerator method
+    :param memory_budget: bytes
+    :param max_workers:
+    :param memory_model: :class:`MemoryModel`. Defaults to the uncalibrated model
+    :return: list of :class:`JobResult`, in the order the jobs finished
+    """
+    logger = logging.getLogger(__name__)
+    memory_model = memory_model or MemoryModel()
+    pending = [(job, memory_model.estimate_file(job)) for job in jobs]
+    controller = AdmissionController(memory_budget)
+    results = []
+    pool = ThreadPool(processes=max_workers)
+
+    def run(job, estimate):
+        try:
+            return JobResult(job=job, estimate=estimate, result=function(job), error=None)
+        except Exception as e:
+            logger.error('Job {0} failed: {1!r}'.format(job, e))
+            return JobResult(job=job, estimate=estimate, result=None, error=e)
+        finally:
+            controller.release(estimate)
+
+    try:
+        with controller._condition:
+            while pending or controller.running:
+                free_workers = max_workers - controller.running
+                if controller.running == 0 and pending:
+                    # nothing is running, so the largest job can always start, even if it's over the budget
+                    chosen = [max(pending, key=lambda pair: pair[1])]
+                else:
+                    chosen = first_fit_decreasing(pending, controller.memory_budget - controller.used)
+                for job, estimate in chosen[:free_workers]:
+                    pending.remove((job, estimate))
+                    controller.used += estimate
+                    controller.running += 1
+                    logger.debug('Starting {0}, estimated peak memory {1} bytes'.format(job, estimate))
+                    pool.apply_async(run, (job, estimate), callback=results.append)
+                controller._condition.wait()
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -0,0 +1,147 @@
+"""
+An index of the lossless JPEG2000 files already created, keyed by the content of their source images, so that a source
+which is delivered again (e.g. under a new filename) doesn't have to be encoded and checked again.
+
+An image's content key combines the checksum of its pixel values, its colour mode, size and ICC profile, and the recipe
+used to encode it, so it only matches a jp2 which would be identical apart from its metadata.
+The index is an SQLite database in write-ahead logging mode, which can be shared by concurrent workers (threads or
+processes) on the same machine.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha256
+
+from PIL import Image
+
+from image_processing import utils, validation
+
+DEFAULT_BUSY_TIMEOUT = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jp2_files (
+    content_key TEXT PRIMARY KEY,
+    filepath TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    source_filepath TEXT,
+    created REAL NOT NULL
+)
+"""
+
+
+def content_key(image_filepath, recipe, pixel_checksum=None):
+    """
+    :param image_filepath:
+    :param recipe: JSON serialisable description of how the image is encoded, e.g. the kakadu options and version
+    :param pixel_checksum: the image's checksum from :func:`~image_processing.validation.generate_pixel_checksum`,
+        if it's already been generated
+    :return: the key identifying the image's content and recipe
+    """
+    with Image.open(image_filepath) as image_pil:
+        if pixel_checksum is None:
+            pixel_checksum = validation.generate_pixel_checksum_from_pil_image(image_pil)
+        icc_profile = image_pil.info.get('icc_profile')
+        content = {
+            'pixels': pixel_checksum,
+            'mode': image_pil.mode,
+            'size': list(image_pil.size),
+            'icc_profile': sha256(icc_profile).hexdigest() if icc_profile else None,
+            'recipe': recipe,
+        }
+    return sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ContentIndex(object):
+    """
+    Thread safe: each thread uses its own connection to the database.
+    """
+
+    def __init__(self, database_filepath, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        """
+        :param database_filepath: the SQLite database, which is created if it doesn't exist
+        :param busy_timeout: seconds to wait for another worker's write to finish
+        """
+        self.database_filepath = database_filepath
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self.log = logging.getLogger(__name__)
+        with self._connection() as connection:
+            connection.execute(_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_filepath, timeout=self.busy_timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def add(self, key, jp2_filepath, source_filepath=None):
+        """
+        Record a validated jp2 file, replacing any file already recorded for the key
+
+        :param key: from :func:`content_key`
+        :param jp2_filepath: the jp2 file's final location. It mustn't be moved or modified afterwards
+        :param source_filepath: the image it was created from, for reference
+        """
+        jp2_filepath = os.path.abspath(jp2_filepath)
+        checksum = utils.file_checksum(jp2_filepath)
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO jp2_files VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, jp2_filepath, checksum, os.path.getsize(jp2_filepath), source_filepath,
+                                time.time()))
+        self.log.debug('Indexed {0} as {1}'.format(jp2_filepath, key))
+
+    def lookup(self, key, verify_checksum=True):
+        """
+        :param key: from :func:`content_key`
+        :param verify_checksum: check the recorded file hasn't been modified since it was added. Reading the file is
+            still far cheaper than encoding it again
+        :return: the filepath of the jp2 recorded for the key, or None. Entries for files which have been removed or
+            modified are dropped
+        """
+        row = self._connection().execute('SELECT filepath, checksum, size FROM jp2_files WHERE content_key = ?',
+                                         (key,)).fetchone()
+        if row is None:
+            return None
+        filepath, checksum, size = row
+        if not os.path.isfile(filepath) or os.path.getsize(filepath) != size or \
+                (verify_checksum and utils.file_checksum(filepath) != checksum):
+            self.log.warning('Indexed file {0} has been removed or modified since it was indexed'.format(filepath))
+            self.remove(key, filepath)
+            return None
+        return filepath
+
+    def remove(self, key, jp2_filepath=None):
+        """
+        :param key:
+        :param jp2_filepath: if given, only remove the entry if it still refers to this file, so an entry added by
+            another worker in the meantime is kept
+        """
+        with self._connection() as connection:
+            if jp2_filepath is None:
+                connection.execute('DELETE FROM jp2_files WHERE content_key = ?', (key,))
+            else:
+                connection.execute('DELETE FROM jp2_files WHERE content_key = ? AND filepath = ?',
+                                   (key, jp2_filepath))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM jp2_files').fetchone()[0]
+
+    def close(self):
+        """
+        Close the calling thread's connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -3,28 +3,130 @@ from __future__ import print_function
 from __future__ import division
 
 import io
+import shutil
 import subprocess
 import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import sha256
 
 import os
-from PIL import Image, ImageCms
+from PIL import Image, ImageCms, TiffImagePlugin
 
-from image_processing import utils
+from image_processing import utils, littlecms, jp2, xmp
 from image_processing.exceptions import ImageProcessingError
 
+DEFAULT_ICC_TRANSFORM_CACHE_SIZE = 32
+DEFAULT_ICC_CONVERSION_BAND_HEIGHT = 512
+
+# tags describing the layout of a frame's image data, which are rewritten when it's saved, and pointers to sub-IFDs
+# which wouldn't be valid in a new file
+_FRAME_TAGS_NOT_COPIED = {254, 256, 257, 258, 259, 262, 266, 273, 277, 278, 279, 284, 292, 293, 317, 320,
+                          322, 323, 324, 325, 330, 338, 339, 34665, 34853, 40965}
+
+
+class IccTransformCache(object):
+    """
+    Least recently used cache of LittleCMS colour transforms, so that converting many images between the same pair of
+    profiles only parses the profiles and builds the transform once.
+    Transforms are keyed by the checksums of both profiles, the rendering intent and the colour modes.
+    """
+
+    def __init__(self, max_size=DEFAULT_ICC_TRANSFORM_CACHE_SIZE):
+        """
+        :param max_size: the maximum number of transforms to keep
+        """
+        self.max_size = max_size
+        self._transforms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_transform(self, input_icc, output_icc, input_mode, output_mode, rendering_intent):
+        """
+        :param input_icc: bytes of the input ICC profile
+        :param output_icc: bytes of the output ICC profile
+        :param input_mode: PIL colour mode of the input image
+        :param output_mode: PIL colour mode of the output image
+        :param rendering_intent: an ImageCms intent, e.g. ImageCms.INTENT_PERCEPTUAL
+        :return: :class:`PIL.ImageCms.ImageCmsTransform`
+        """
+        key = (sha256(input_icc).hexdigest(), sha256(output_icc).hexdigest(), input_mode, output_mode,
+               int(rendering_intent))
+        return self._get(key, lambda: ImageCms.buildTransform(
+            ImageCms.getOpenProfile(io.BytesIO(input_icc)), ImageCms.getOpenProfile(io.BytesIO(output_icc)),
+            input_mode, output_mode, renderingIntent=rendering_intent))
+
+    def get_16_bit_transform(self, input_icc, output_icc, input_mode, output_mode, rendering_intent):
+        """
+        As :func:`get_transform`, but for 16 bit per channel images
+
+        :return: :class:`~image_processing.littlecms.Transform16Bit`
+        """
+        key = (sha256(input_icc).hexdigest(), sha256(output_icc).hexdigest(), input_mode, output_mode,
+               int(rendering_intent), 16)
+        return self._get(key, lambda: littlecms.Transform16Bit(input_icc, output_icc, input_mode, output_mode,
+                                                               rendering_intent))
+
+    def _get(self, key, build_transform):
+        with self._lock:
+            transform = self._transforms.pop(key, None)
+            if transform is not None:
+                self._transforms[key] = transform
+                return transform
+
+        transform = build_transform()
+        with self._lock:
+            self._transforms[key] = transform
+            while len(self._transforms) > self.max_size:
+                self._transforms.popitem(last=False)
+        return transform
+
+    def clear(self):
+        with self._lock:
+            self._transforms.clear()
+
+    def __len__(self):
+        return len(self._transforms)
+
+
+_shared_icc_transform_cache = IccTransformCache()
+
 
 class Converter(object):
     """
     Convert TIFF to and from JPEG while preserving technical metadata and ICC profiles
     """
 
-    def __init__(self, exiftool_path='exiftool'):
+    def __init__(self, exiftool_path='exiftool', icc_transform_cache=None, exiftool_timeout=None,
+                 resource_limits=None):
+        """
+        :param exiftool_path: path to the exiftool executable
+        :param icc_transform_cache: :class:`IccTransformCache` for ICC profile conversions.
+            By default, one cache is shared by all converters in the process
+        :param exiftool_timeout: seconds to wait for each exiftool command before killing it and raising a
+            :class:`~image_processing.exceptions.CommandTimeoutError`. None waits as long as it takes.
+            exiftool only reads and writes metadata, so the time it takes doesn't depend on the size of the image
+        :param resource_limits: :class:`~image_processing.utils.ResourceLimits` for the exiftool processes
+        """
         if not utils.cmd_is_executable(exiftool_path):
             raise OSError("Could not find executable {0}. Check exiftool is installed and exists at the configured path"
                           .format(exiftool_path))
         self.exiftool_path = exiftool_path
+        self.exiftool_timeout = exiftool_timeout
+        self.resource_limits = resource_limits
+        self.icc_transform_cache = icc_transform_cache if icc_transform_cache is not None \
+            else _shared_icc_transform_cache
         self.logger = logging.getLogger(__name__)
 
+    def get_exiftool_version(self):
+        """
+        :return: the exiftool version number. Cached for the life of the process
+        """
+        return utils.get_executable_version(self.exiftool_path, ['-ver'])
+
+    def _run_exiftool(self, command_options):
+        utils.run_command(command_options, timeout=self.exiftool_timeout, resource_limits=self.resource_limits)
+
     def convert_to_tiff(self, input_filepath, output_filepath):
         """
         Convert an image file to TIFF, preserving ICC profile and embedded metadata
@@ -36,15 +138,39 @@ class Converter(object):
             input_pil.save(output_filepath, "TIFF")
         self.copy_over_embedded_metadata(input_filepath, output_filepath)
 
-    def convert_to_jpg(self, input_filepath, output_filepath, resize=None, quality=None):
+    def extract_frame(self, input_filepath, frame_index, output_filepath):
+        """
+        Save one frame (page) of a multi-frame TIFF as a TIFF, with its own ICC profile and embedded metadata.
+        Only that frame is read into memory.
+
+        :param input_filepath:
+        :param frame_index: starting from 0
+        :param output_filepath:
+        """
+        with Image.open(input_filepath) as input_pil:
+            try:
+                input_pil.seek(frame_index)
+            except EOFError:
+                raise ImageProcessingError("{0} does not have a frame {1}".format(input_filepath, frame_index))
+            frame_tags = TiffImagePlugin.ImageFileDirectory_v2()
+            if hasattr(input_pil, 'tag_v2'):
+                for tag, value in input_pil.tag_v2.items():
+                    if tag not in _FRAME_TAGS_NOT_COPIED:
+                        frame_tags[tag] = value
+                        frame_tags.tagtype[tag] = input_pil.tag_v2.tagtype[tag]
+            input_pil.save(output_filepath, "TIFF", tiffinfo=frame_tags)
+
+    def convert_to_jpg(self, input_filepath, output_filepath, resize=None, quality=None, shared_raster=None):
         """
         Convert an image file to JPEG, preserving ICC profile and embedded metadata
         :param input_filepath:
         :param output_filepath:
         :param resize: if present, resize by this amount to make a thumbnail. e.g. 0.5 to make a thumbnail half the size
         :param quality: quality of created jpg: either None, or 1-95
+        :param shared_raster: :class:`~image_processing.shared_raster.SharedRaster` of the input image. If given, its
+            pixels are used instead of decoding the input file again. The embedded metadata still comes from the file
         """
-        with Image.open(input_filepath) as input_pil:
+        with _open_image(input_filepath, shared_raster) as input_pil:
             icc_profile = input_pil.info.get('icc_profile')
             if input_pil.mode == 'RGBA':
                 self.logger.warning(
@@ -76,15 +202,64 @@ class Converter(object):
         command_options += [output_image_filepath]
         self.logger.debug(' '.join(command_options))
         try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
+            self._run_exiftool(command_options)
         except subprocess.CalledProcessError as e:
             raise ImageProcessingError('Exiftool at {0} failed to copy from {1}. Command: {2}, Error: {3}'.
                                        format(self.exiftool_path, input_image_filepath, ' '.join(command_options), e))
 
+    def generate_xmp_packet(self, input_image_filepath):
+        """
+        Translate the embedded image metadata into XMP, the same way as
+        copy_over_embedded_metadata(..., write_only_xmp=True), but without writing it to an image
+
+        :param input_image_filepath:
+        :return: the XMP packet, as bytes
+        """
+        if not os.access(input_image_filepath, os.R_OK):
+            raise IOError("Could not read input image path {0}".format(input_image_filepath))
+        scratch_folder = tempfile.mkdtemp(prefix='image-processing_')
+        try:
+            xmp_filepath = os.path.join(scratch_folder, 'packet.xmp')
+            command_options = [self.exiftool_path, '-tagsFromFile', input_image_filepath, '-xmp:all<all',
+                               '-o', xmp_filepath]
+            self.logger.debug(' '.join(command_options))
+            try:
+                self._run_exiftool(command_options)
+            except subprocess.CalledProcessError as e:
+                raise ImageProcessingError('Exiftool at {0} failed to extract XMP from {1}. Command: {2}, Error: {3}'.
+                                           format(self.exiftool_path, input_image_filepath,
+                                                  ' '.join(command_options), e))
+            with open(xmp_filepath, 'rb') as xmp_file:
+                return xmp_file.read()
+        finally:
+            shutil.rmtree(scratch_folder)
+
+    def copy_over_xmp_to_jp2(self, input_image_filepath, jp2_filepath, xmp_packet=None):
+        """
+        Replace the XMP in a JP2 file with the embedded metadata of the input image, translated to XMP.
+        Gives the same result as copy_over_embedded_metadata(..., write_only_xmp=True), but only the XMP box of the JP2
+        is written, rather than exiftool rewriting the whole file.
+
+        :param input_image_filepath:
+        :param jp2_filepath:
+        :param xmp_packet: the XMP to write, if it's already been generated with generate_xmp_packet.
+            If the input image is a JP2, its XMP box is copied over as it is
+        """
+        if xmp_packet is None:
+            if os.path.splitext(input_image_filepath)[1].lower() == '.jp2':
+                xmp_packet = jp2.read_xmp(input_image_filepath)
+            if xmp_packet is None:
+                xmp_packet = self.generate_xmp_packet(input_image_filepath)
+        if not os.access(jp2_filepath, os.W_OK):
+            raise IOError("Could not write to output path {0}".format(jp2_filepath))
+        jp2.write_xmp(jp2_filepath, xmp_packet)
+
     def extract_xmp_to_sidecar_file(self, image_filepath, output_xmp_filepath):
         """
         Extract embedded image metadata from the image_filepath to an xmp file.
         Includes the ICC profile description.
+        If all of a TIFF or JPEG's metadata is already in an XMP packet written by exiftool, the packet is written out
+        directly, otherwise exiftool translates the metadata.
         """
         if os.path.isfile(output_xmp_filepath):
             os.remove(output_xmp_filepath)
@@ -95,48 +270,220 @@ class Converter(object):
         if not os.path.splitext(output_xmp_filepath)[1] == ".xmp":
             raise IOError("XMP output file {0} needs an xmp extension".format(output_xmp_filepath))
 
+        if self._extract_xmp_to_sidecar_file_natively(image_filepath, output_xmp_filepath):
+            return
+
         command_options = [self.exiftool_path, '-tagsFromFile', image_filepath, '-all',
                            '-ICC_Profile:ProfileDescription>ICCProfileName',  # map icc profile name to photoshop:ICCProfile
                            '-o', output_xmp_filepath]  # must not exist already
 
         self.logger.debug(' '.join(command_options))
         try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
+            self._run_exiftool(command_options)
         except subprocess.CalledProcessError as e:
             raise ImageProcessingError('Exiftool at {0} failed to extract metadata from {1}. Command: {2}, Error: {3}'.
                                        format(self.exiftool_path, image_filepath, ' '.join(command_options), e))
 
-    def convert_icc_profile(self, image_filepath, output_filepath, icc_profile_filepath, new_colour_mode=None):
+    def _extract_xmp_to_sidecar_file_natively(self, image_filepath, output_xmp_filepath):
+        """
+        If all the image's metadata is in an XMP packet written by exiftool, write the sidecar file from it directly
+        rather than running exiftool to translate the metadata.
+
+        :return: True if the sidecar file was written
+        """
+        try:
+            embedded_metadata = xmp.read_embedded_metadata(image_filepath)
+        except IOError:
+            return False
+        if embedded_metadata.xmp is None or embedded_metadata.untranslated or \
+                not xmp.is_exiftool_packet(embedded_metadata.xmp):
+            self.logger.debug('Using exiftool to extract metadata from {0}: untranslated metadata {1}'
+                              .format(image_filepath, embedded_metadata.untranslated))
+            return False
+        sidecar_packet = xmp.to_sidecar(embedded_metadata.xmp)
+        if embedded_metadata.icc_profile:
+            sidecar_packet = xmp.set_icc_profile_name(sidecar_packet,
+                                                      xmp.get_icc_profile_name(embedded_metadata.icc_profile))
+        with open(output_xmp_filepath, 'wb') as output_xmp_file:
+            output_xmp_file.write(sidecar_packet)
+        self.logger.debug('Extracted embedded XMP from {0} to {1}'.format(image_filepath, output_xmp_filepath))
+        return True
+
+    def convert_icc_profile(self, image_filepath, output_filepath, icc_profile_filepath, new_colour_mode=None,
+                            shared_raster=None):
         """
         Convert the image to a new icc profile. This is lossy, so should only be done when necessary (e.g. if jp2 doesn't support the colour profile)
-        Doesn't support 16bit images due to limitations of Pillow
+        16 bit TIFFs are converted with LittleCMS directly, as Pillow doesn't support them, which needs numpy and tifffile.
+        See :func:`convert_16_bit_icc_profile`
 
         Uses the perceptual rendering intent, as it's the recommended one for general photographic purposes, and loses less information on out-of-gamut colours than relative colormetric
         However, if we're converting to a matrix profile like AdobeRGB, this will use relative colormetric instead, as perceptual intents are only supported by lookup table colour profiles
         In practise, we should be converting to a wide gamut profile, so out-of-gamut colours will be limited anyway
+
+        The colour transform is cached (see :class:`IccTransformCache`).
+        8 bit images are converted whole, so both the input and output images are held in memory; 16 bit images are
+        converted a band at a time
         :param image_filepath:
         :param output_filepath:
         :param icc_profile_filepath:
         :param new_colour_mode:
+        :param shared_raster: :class:`~image_processing.shared_raster.SharedRaster` of the image. If given, the pixels of
+            8 bit images are taken from it instead of decoding the file again
         :return:
         """
+        with open(icc_profile_filepath, 'rb') as icc_file:
+            output_icc = icc_file.read()
+        self._convert_icc_profile(image_filepath, output_filepath, output_icc, new_colour_mode,
+                                  shared_raster=shared_raster)
+
+    def convert_icc_profiles(self, image_and_output_filepaths, icc_profile_filepath, new_colour_mode=None):
+        """
+        Convert a batch of images to the same icc profile, with the same options as :func:`convert_icc_profile`.
+        The output profile is only read once, and images with the same input profile share one colour transform.
+
+        :param image_and_output_filepaths: list of (image filepath, output filepath) tuples
+        :param icc_profile_filepath:
+        :param new_colour_mode:
+        """
+        with open(icc_profile_filepath, 'rb') as icc_file:
+            output_icc = icc_file.read()
+        for image_filepath, output_filepath in image_and_output_filepaths:
+            self._convert_icc_profile(image_filepath, output_filepath, output_icc, new_colour_mode)
+
+    def _convert_icc_profile(self, image_filepath, output_filepath, output_icc, new_colour_mode, shared_raster=None):
         with Image.open(image_filepath) as input_pil:
             # BitsPerSample is 258 (see PIL.TiffTags.TAGS_V2). tag_v2 is populated when opening an image, but not when saving
             orig_bit_depths = input_pil.tag_v2[258]
 
+            if orig_bit_depths in [(16, 16, 16, 16), (16, 16, 16), (16,)]:
+                input_pil.close()
+                self._convert_16_bit_icc_profile(image_filepath, output_filepath, output_icc, new_colour_mode)
+                return
+
             if orig_bit_depths not in [(8, 8, 8, 8), (8, 8, 8), (8,), (1,)]:
-                raise ImageProcessingError("ICC profile conversion was unsuccessful for {0}: unsupported bit depth {1} "
-                                           "Note: Pillow does not support 16 bit image profile conversion."
+                raise ImageProcessingError("ICC profile conversion was unsuccessful for {0}: unsupported bit depth {1}"
                                            .format(image_filepath, orig_bit_depths))
 
-            input_icc_obj = input_pil.info.get('icc_profile')
+            input_icc = input_pil.info.get('icc_profile')
 
-            if input_icc_obj is None:
+            if input_icc is None:
                 raise ImageProcessingError("Image doesn't have a profile")
 
-            input_profile = ImageCms.getOpenProfile(io.BytesIO(input_icc_obj))
-            output_pil = ImageCms.profileToProfile(input_pil, input_profile, icc_profile_filepath,
-                                                   renderingIntent=ImageCms.INTENT_PERCEPTUAL,
-                                                   outputMode=new_colour_mode, inPlace=0)
+            output_mode = new_colour_mode or input_pil.mode
+            transform = self.icc_transform_cache.get_transform(input_icc, output_icc, input_pil.mode, output_mode,
+                                                               ImageCms.INTENT_PERCEPTUAL)
+            if shared_raster is not None:
+                # Pillow only decodes the pixels when they're used, so the file is just read for its tags
+                with shared_raster.as_image() as shared_pil:
+                    output_pil = transform.apply(shared_pil)
+            else:
+                output_pil = transform.apply(input_pil)
+            output_pil.info['icc_profile'] = output_icc
             output_pil.save(output_filepath)
         self.copy_over_embedded_metadata(image_filepath, output_filepath)
+
+    def convert_16_bit_icc_profile(self, image_filepath, output_filepath, icc_profile_filepath, new_colour_mode=None):
+        """
+        Convert a 16 bit per channel TIFF to a new icc profile, with the same rendering intent as
+        :func:`convert_icc_profile`. The output is an uncompressed 16 bit TIFF.
+
+        Memory use is bounded regardless of the image size: the source is read a strip or row of tiles at a time
+        (or memory mapped, if it's uncompressed), transformed, and written out before the next band is read.
+        Needs the optional numpy and tifffile packages.
+
+        :param image_filepath: TIFF with 16 bit greyscale, RGB or RGBA pixels, and chunky planar configuration
+        :param output_filepath:
+        :param icc_profile_filepath:
+        :param new_colour_mode: 'L', 'RGB' or 'RGBA', or None to keep the same colour mode
+        """
+        with open(icc_profile_filepath, 'rb') as icc_file:
+            output_icc = icc_file.read()
+        self._convert_16_bit_icc_profile(image_filepath, output_filepath, output_icc, new_colour_mode)
+
+    def _convert_16_bit_icc_profile(self, image_filepath, output_filepath, output_icc, new_colour_mode):
+        try:
+            import numpy
+            import tifffile
+        except ImportError:
+            raise ImageProcessingError("ICC profile conversion was unsuccessful for {0}: 16 bit conversion needs "
+                                       "the numpy and tifffile packages".format(image_filepath))
+
+        with tifffile.TiffFile(image_filepath) as input_tiff:
+            page = input_tiff.pages[0]
+            if page.bitspersample != 16 or page.planarconfig != 1:
+                raise ImageProcessingError("ICC profile conversion was unsuccessful for {0}: only 16 bit images with "
+                                           "contiguous samples are supported".format(image_filepath))
+            input_icc_tag = page.tags.get(34675)  # InterColorProfile
+            if input_icc_tag is None:
+                raise ImageProcessingError("Image doesn't have a profile")
+            input_mode = {1: 'L', 3: 'RGB', 4: 'RGBA'}.get(page.samplesperpixel)
+            if input_mode is None:
+                raise ImageProcessingError("ICC profile conversion was unsuccessful for {0}: unsupported number of "
+                                           "samples per pixel {1}".format(image_filepath, page.samplesperpixel))
+            output_mode = new_colour_mode or input_mode
+            transform = self.icc_transform_cache.get_16_bit_transform(bytes(input_icc_tag.value), output_icc,
+                                                                      input_mode, output_mode,
+                                                                      ImageCms.INTENT_PERCEPTUAL)
+            output_samples = len(output_mode)
+
+            if page.is_memmappable:
+                band_rows = DEFAULT_ICC_CONVERSION_BAND_HEIGHT
+                bands = _memmapped_bands(tifffile.memmap(image_filepath, mode='r'), band_rows)
+            else:
+                band_rows = page.tilelength if page.is_tiled else page.rowsperstrip
+                bands = _decoded_bands(page, numpy)
+
+            def transformed_strips():
+                for band in bands:
+                    band = numpy.ascontiguousarray(band, dtype=numpy.uint16)
+                    output_band = numpy.empty((band.shape[0], band.shape[1], output_samples), dtype=numpy.uint16)
+                    transform.apply(band, output_band)
+                    yield output_band.tobytes()
+
+            shape = (page.imagelength, page.imagewidth, output_samples)
+            # the strips are in native byte order, which is tifffile's default
+            with tifffile.TiffWriter(output_filepath,
+                                     bigtiff=numpy.prod(shape) * 2 > 2 ** 32 - 2 ** 25) as output_tiff:
+                output_tiff.write(transformed_strips(), shape=shape if output_samples > 1 else shape[:2],
+                                  dtype=numpy.uint16, photometric='minisblack' if output_mode == 'L' else 'rgb',
+                                  extrasamples=['unassalpha'] if output_mode == 'RGBA' else None,
+                                  rowsperstrip=band_rows, iccprofile=output_icc, metadata=None)
+        self.copy_over_embedded_metadata(image_filepath, output_filepath)
+
+
+def _open_image(image_filepath, shared_raster=None):
+    """
+    :return: a PIL image of the file, or of the shared raster of it if there is one
+    """
+    if shared_raster is not None:
+        return shared_raster.as_image()
+    return Image.open(image_filepath)
+
+
+def _memmapped_bands(image_array, band_rows):
+    for top in range(0, image_array.shape[0], band_rows):
+        yield image_array[top:top + band_rows]
+
+
+def _decoded_bands(page, numpy):
+    """
+    Assemble the strips or tiles of a tifffile page into bands of rows, decoding one segment at a time
+
+    :param page: tifffile.TiffPage
+    :param numpy: the numpy module
+    """
+    band = None
+    band_top = None
+    for segment, (_, _, top, left, _), shape in page.segments(maxworkers=1):
+        if band is not None and top != band_top:
+            yield band
+            band = None
+        if band is None:
+            band_top = top
+            band = numpy.zeros((min(shape[1], page.imagelength - top), page.imagewidth, page.samplesperpixel),
+                               dtype=numpy.uint16)
+        if segment is not None:
+            width = min(shape[2], page.imagewidth - left)
+            band[:, left:left + width] = segment.reshape(shape)[0, :band.shape[0], :width]
+    if band is not None:
+        yield band
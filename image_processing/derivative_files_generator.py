@@ -3,11 +3,16 @@ from __future__ import print_function
 from __future__ import division
 
 import os
-import shutil
+import random
 import logging
+import shutil
 import tempfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-from image_processing import conversion, validation, kakadu
+from image_processing import conversion, validation, kakadu, jp2, utils, storage, iiif_static
 from image_processing.kakadu import Kakadu
 from PIL import Image
 
@@ -15,13 +20,67 @@ DEFAULT_TIFF_FILENAME = 'full.tiff'
 DEFAULT_EMBEDDED_METADATA_FILENAME = 'full.xmp'
 DEFAULT_JPG_FILENAME = 'full.jpg'
 DEFAULT_LOSSLESS_JP2_FILENAME = 'full_lossless.jp2'
+DEFAULT_TILE_PYRAMID_FOLDER_NAME = 'iiif'
 
 DEFAULT_JPG_THUMBNAIL_RESIZE_VALUE = 0.6
 DEFAULT_JPG_HIGH_QUALITY_VALUE = 92
 
+DEFAULT_LOSSLESS_CHECK_SAMPLE_SIZE = 16
+
+DEFAULT_FRAME_WORKERS = 4
+DEFAULT_UPLOAD_WORKERS = 2
+
 DEFAULT_EXIFTOOL_PATH = "exiftool"
 DEFAULT_KAKADU_BASE_PATH = ""
 
+JPG_TYPE = 'jpg'
+EMBEDDED_METADATA_TYPE = 'xmp'
+TIFF_TYPE = 'tiff'
+LOSSLESS_JP2_TYPE = 'jp2'
+TILE_PYRAMID_TYPE = 'iiif'
+
+GeneratedFile = namedtuple('GeneratedFile', ['type', 'path', 'size', 'checksum', 'verified', 'kakadu_stats'])
+GeneratedFile.__new__.__defaults__ = (None,)
+"""
+A derivative yielded by :func:`DerivativeFilesGenerator.iter_derivatives_from_tiff`: its type (e.g.
+:const:`LOSSLESS_JP2_TYPE`), filepath, size in bytes, sha256 hex digest (None for the tile pyramid, which is a folder
+and whose size is the total of its files), whether it has been validated (True for
+the jp2, None for derivatives which aren't validated), and for the jp2, the list of
+:class:`~image_processing.kakadu.KakaduStats` of the kakadu commands which created and checked it, if the generator
+collects them
+"""
+
+
+class StageTimeouts(object):
+    """
+    Timeouts for the external commands run while generating derivatives, after which they're killed and a
+    :class:`~image_processing.exceptions.CommandTimeoutError` is raised.
+    The time kakadu takes grows with the number of pixels, so each kakadu timeout is
+    ``base seconds + seconds per megapixel * megapixels``. exiftool only handles the metadata, so its timeout is fixed.
+    """
+
+    def __init__(self, kdu_compress=(120, 2.0), kdu_expand=(60, 1.0), kdu_transcode=(60, 0.5), exiftool=120):
+        """
+        The defaults are several times what a healthy conversion needs, so they only catch commands which have hung
+
+        :param kdu_compress: (base seconds, seconds per megapixel)
+        :param kdu_expand: (base seconds, seconds per megapixel)
+        :param kdu_transcode: (base seconds, seconds per megapixel)
+        :param exiftool: seconds
+        """
+        self.kakadu = {'kdu_compress': kdu_compress, 'kdu_expand': kdu_expand, 'kdu_transcode': kdu_transcode}
+        self.exiftool = exiftool
+
+    def kakadu_timeout(self, command, width, height):
+        """
+        :param command: 'kdu_compress', 'kdu_expand' or 'kdu_transcode'
+        :param width: of the image (or region) being processed
+        :param height:
+        :return: the timeout in seconds
+        """
+        base_seconds, seconds_per_megapixel = self.kakadu[command]
+        return base_seconds + seconds_per_megapixel * width * height / 1000000
+
 
 class DerivativeFilesGenerator(object):
     """
@@ -36,18 +95,56 @@ class DerivativeFilesGenerator(object):
                  use_default_filenames=True,
                  require_icc_profile_for_greyscale=False,
                  require_icc_profile_for_colour=True,
-                 exiftool_path=DEFAULT_EXIFTOOL_PATH):
+                 exiftool_path=DEFAULT_EXIFTOOL_PATH,
+                 lossless_check_sample_size=None,
+                 hardlink_source_files=False,
+                 stage_timeouts=None,
+                 child_resource_limits=None,
+                 content_index=None,
+                 fingerprint_index=None,
+                 on_near_duplicates=None,
+                 collect_kakadu_stats=False,
+                 compress_options_policy=kakadu.default_compress_options_policy,
+                 share_source_raster=False):
         """
 
         :param kakadu_base_path: the location of the kdu_compress and kdu_expand executables
         :param jpg_high_quality_value: between 0 and 95
         :param jpg_thumbnail_resize_value: between 0 and 1
-        :param kakadu_compress_options: options for kdu_compress to create a lossless jp2 file
+        :param kakadu_compress_options: options for kdu_compress to create a lossless jp2 file, before they're
+            adapted to each image by the compress_options_policy
         :param use_default_filenames: use the filenames specified in this module instead of using the original filename
         :param require_icc_profile_for_greyscale: raise an error if a greyscale image doesn't have an ICC profile.
             Note: bitonal images do not need ICC profiles even if this is true
         :param require_icc_profile_for_colour: raise an error if a colour image does not have an ICC profile
         :param exiftool_path: path to the exiftool executable
+        :param lossless_check_sample_size: if set, lossless checks only compare this many randomly chosen tiles of the
+            jp2 file with the source instead of the whole image.
+            See :func:`check_conversion_was_lossless_sampled`
+        :param hardlink_source_files: allow copies of the source files in the output folder to be hardlinks, if the
+            filesystem doesn't support reflinks. Only use this if source files are never modified in place
+        :param stage_timeouts: :class:`StageTimeouts` for the kakadu and exiftool commands. By default they can run
+            for as long as they take
+        :param child_resource_limits: :class:`~image_processing.utils.ResourceLimits` for the kakadu and exiftool
+            processes
+        :param content_index: :class:`~image_processing.content_index.ContentIndex`. If given, a TIFF whose pixels,
+            ICC profile and encoding options match one already converted gets a copy of that jp2 (as a reflink where the
+            filesystem supports it) with its own XMP written in, instead of being encoded and checked again. Only jp2
+            files published to an output folder are indexed
+        :param fingerprint_index: :class:`~image_processing.fingerprint.FingerprintIndex`. If given, each source's
+            fingerprint is computed from its jpg, checked for near duplicates and added to the index
+        :param on_near_duplicates: called with the source's identifier (its filepath, or key for stored sources) and the
+            list of (identifier, distance) of its near duplicates in the fingerprint index, if it has any
+        :param collect_kakadu_stats: run kakadu with -stats and -cpu, log what each command did, and attach the
+            :class:`~image_processing.kakadu.KakaduStats` to the jp2 yielded by :func:`iter_derivatives_from_tiff`
+        :param compress_options_policy: function which adapts kakadu_compress_options to each image, given them and
+            the image's :class:`~image_processing.kakadu.ImageProbe`, e.g. to use different code-block sizes for
+            bitonal images. None uses kakadu_compress_options for every image. The options used are recorded in a
+            comment in each jp2, which :func:`~image_processing.kakadu.read_recipe` reads back
+        :param share_source_raster: decode each TIFF once into a
+            :class:`~image_processing.shared_raster.SharedRaster`, which the jpg, the pixel checksum and the lossless
+            check then use instead of decoding the TIFF again. The block is released once the TIFF's derivatives have
+            been generated. Needs Python 3.8 or later
         """
 
         self.jpg_high_quality_value = jpg_high_quality_value
@@ -56,9 +153,22 @@ class DerivativeFilesGenerator(object):
         self.require_icc_profile_for_colour = require_icc_profile_for_colour
         self.use_default_filenames = use_default_filenames
         self.kakadu_compress_options = kakadu_compress_options
-        self.converter = conversion.Converter(exiftool_path=exiftool_path)
-
-        self.kakadu = Kakadu(kakadu_base_path=kakadu_base_path)
+        self.lossless_check_sample_size = lossless_check_sample_size
+        self.hardlink_source_files = hardlink_source_files
+        self.stage_timeouts = stage_timeouts
+        self.content_index = content_index
+        self.fingerprint_index = fingerprint_index
+        self.on_near_duplicates = on_near_duplicates
+        self.collect_kakadu_stats = collect_kakadu_stats
+        self.compress_options_policy = compress_options_policy
+        self.share_source_raster = share_source_raster
+        # the stats of the kakadu commands run by the current thread are collected here, when a list is set
+        self._kakadu_stats = threading.local()
+        self.converter = conversion.Converter(
+            exiftool_path=exiftool_path, exiftool_timeout=stage_timeouts.exiftool if stage_timeouts else None,
+            resource_limits=child_resource_limits)
+
+        self.kakadu = Kakadu(kakadu_base_path=kakadu_base_path, resource_limits=child_resource_limits)
 
         self.log = logging.getLogger(__name__)
 
@@ -83,35 +193,40 @@ class DerivativeFilesGenerator(object):
             jpg_filepath, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
             require_icc_profile_for_greyscale=self.require_icc_profile_for_greyscale)
 
-        output_jpg_filepath = os.path.join(output_folder, self._get_filename(DEFAULT_JPG_FILENAME, source_file_name))
-        shutil.copy(jpg_filepath, output_jpg_filepath)
-        generated_files = [output_jpg_filepath]
+        with utils.StagingFolder(output_folder) as staging_folder:
+            output_jpg_filepath = staging_folder.filepath(self._get_filename(DEFAULT_JPG_FILENAME, source_file_name))
+            self._place_source_file(jpg_filepath, output_jpg_filepath)
+            generated_files = [output_jpg_filepath]
 
-        if save_embedded_metadata:
-            embedded_metadata_file_path = os.path.join(output_folder,
-                                                       self._get_filename(DEFAULT_EMBEDDED_METADATA_FILENAME, source_file_name))
-            self.converter.extract_xmp_to_sidecar_file(jpg_filepath, embedded_metadata_file_path)
-            self.log.debug('Extracted metadata file {0} generated'.format(embedded_metadata_file_path))
-            generated_files += [embedded_metadata_file_path]
+            if save_embedded_metadata:
+                embedded_metadata_file_path = staging_folder.filepath(
+                    self._get_filename(DEFAULT_EMBEDDED_METADATA_FILENAME, source_file_name))
+                self.converter.extract_xmp_to_sidecar_file(jpg_filepath, embedded_metadata_file_path)
+                self.log.debug('Extracted metadata file {0} generated'.format(embedded_metadata_file_path))
+                generated_files += [embedded_metadata_file_path]
+
+            with tempfile.NamedTemporaryFile(prefix='image-processing_', suffix='.tif') as scratch_tiff_file_obj:
+                scratch_tiff_filepath = scratch_tiff_file_obj.name
+                self.converter.convert_to_tiff(jpg_filepath, scratch_tiff_filepath)
 
-        with tempfile.NamedTemporaryFile(prefix='image-processing_', suffix='.tif') as scratch_tiff_file_obj:
-            scratch_tiff_filepath = scratch_tiff_file_obj.name
-            self.converter.convert_to_tiff(jpg_filepath, scratch_tiff_filepath)
+                validation.check_colour_profiles_match(jpg_filepath, scratch_tiff_filepath)
 
-            validation.check_colour_profiles_match(jpg_filepath, scratch_tiff_filepath)
+                lossless_filepath = staging_folder.filepath(
+                    self._get_filename(DEFAULT_LOSSLESS_JP2_FILENAME, source_file_name))
+                self.generate_jp2_from_tiff(scratch_tiff_filepath, lossless_filepath)
+                self.validate_jp2_conversion(scratch_tiff_filepath, lossless_filepath, check_lossless=check_lossless)
+                generated_files.append(lossless_filepath)
 
-            lossless_filepath = os.path.join(output_folder,
-                                             self._get_filename(DEFAULT_LOSSLESS_JP2_FILENAME, source_file_name))
-            self.generate_jp2_from_tiff(scratch_tiff_filepath, lossless_filepath)
-            self.validate_jp2_conversion(scratch_tiff_filepath, lossless_filepath, check_lossless=check_lossless)
-            generated_files.append(lossless_filepath)
+            # nothing appears in the output folder until everything has been generated and validated
+            generated_files = staging_folder.publish(generated_files)
 
         self.log.debug("Successfully generated derivatives for {0} in {1}".format(jpg_filepath, output_folder))
 
         return generated_files
 
     def generate_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff=False, save_embedded_metadata=True,
-                                       create_jpg_as_thumbnail=True, check_lossless=True):
+                                       create_jpg_as_thumbnail=True, check_lossless=True, on_file_generated=None,
+                                       tile_pyramid_id=None):
         """
         Extracts the embedded metadata, creates a JPEG file and a validated JPEG2000 file.
         Stores all in the given folder.
@@ -123,10 +238,234 @@ class DerivativeFilesGenerator(object):
         :param include_tiff: Include copy of source tiff file in derivatives
         :param save_embedded_metadata: If true, metadata will be extracted from the image file and preserved in a separate xml file
         :param check_lossless: If true, check the created jpg2000 file is visually identical to the source file
+        :param on_file_generated: if given, this is called with a :class:`GeneratedFile` as soon as each derivative is
+            ready, and the derivatives are published one by one as in :func:`iter_derivatives_from_tiff`, rather than
+            all together once the jp2 has been validated
+        :param tile_pyramid_id: if given, a static IIIF level 0 tile pyramid is also created from the jp2, in a folder
+            named :const:`DEFAULT_TILE_PYRAMID_FOLDER_NAME`, with this URI as its @id. See
+            :func:`generate_tile_pyramid`
         :return: filepaths of created files
         """
+        if on_file_generated is not None:
+            generated_files = []
+            for generated_file in self.iter_derivatives_from_tiff(
+                    tiff_filepath, output_folder, include_tiff=include_tiff,
+                    save_embedded_metadata=save_embedded_metadata, create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                    check_lossless=check_lossless, tile_pyramid_id=tile_pyramid_id):
+                on_file_generated(generated_file)
+                generated_files.append(generated_file.path)
+            return generated_files
+        return self._generate_derivatives_from_tiff(
+            tiff_filepath, output_folder, include_tiff=include_tiff, save_embedded_metadata=save_embedded_metadata,
+            create_jpg_as_thumbnail=create_jpg_as_thumbnail, check_lossless=check_lossless,
+            source_file_name=os.path.basename(tiff_filepath), tile_pyramid_id=tile_pyramid_id)
+
+    def iter_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff=False, save_embedded_metadata=True,
+                                   create_jpg_as_thumbnail=True, check_lossless=True, tile_pyramid_id=None):
+        """
+        Like :func:`generate_derivatives_from_tiff`, but each derivative is published to the output folder and yielded
+        as soon as it's complete, so e.g. the jpg can be transferred while the jp2 is still being created.
+        The jp2 is yielded last, once it has been validated, after the tile pyramid if there is one.
+        If generating any derivative fails, the ones already published are removed from the output folder before the
+        error is raised, so anything received from the iterator should be discarded too.
+
+        See :func:`generate_derivatives_from_tiff` for the parameters.
+
+        :return: iterator of :class:`GeneratedFile`
+        """
+        published_filepaths = []
+        kakadu_stats = []
+        with self._source_raster(tiff_filepath) as shared_raster, \
+                utils.StagingFolder(output_folder) as staging_folder:
+            content_key, pixel_checksum = self._content_key(tiff_filepath, shared_raster)
+            try:
+                for file_type, staged_filepath in self._iter_derivatives_from_tiff(
+                        tiff_filepath, staging_folder, include_tiff, save_embedded_metadata, create_jpg_as_thumbnail,
+                        check_lossless, os.path.basename(tiff_filepath), content_key=content_key,
+                        pixel_checksum=pixel_checksum, kakadu_stats=kakadu_stats, tile_pyramid_id=tile_pyramid_id,
+                        shared_raster=shared_raster):
+                    if file_type == TILE_PYRAMID_TYPE:
+                        size = sum(os.path.getsize(os.path.join(folder, filename))
+                                   for folder, _, filenames in os.walk(staged_filepath) for filename in filenames)
+                        checksum = None
+                    else:
+                        size = os.path.getsize(staged_filepath)
+                        checksum = utils.file_checksum(staged_filepath)
+                    filepath = staging_folder.publish([staged_filepath])[0]
+                    published_filepaths.append(filepath)
+                    if file_type == LOSSLESS_JP2_TYPE:
+                        self._index_jp2(content_key, filepath, tiff_filepath)
+                    is_jp2 = file_type == LOSSLESS_JP2_TYPE
+                    yield GeneratedFile(type=file_type, path=filepath, size=size, checksum=checksum,
+                                        verified=True if is_jp2 else None,
+                                        kakadu_stats=list(kakadu_stats) if is_jp2 and self.collect_kakadu_stats
+                                        else None)
+            except Exception:
+                for filepath in published_filepaths:
+                    if os.path.isdir(filepath):
+                        shutil.rmtree(filepath)
+                    elif os.path.isfile(filepath):
+                        os.remove(filepath)
+                raise
+        self.log.debug("Successfully generated derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+
+    def generate_derivatives_from_multi_frame_tiff(self, tiff_filepath, output_folder, include_tiff=False,
+                                                   save_embedded_metadata=True, create_jpg_as_thumbnail=True,
+                                                   check_lossless=True, max_workers=DEFAULT_FRAME_WORKERS):
+        """
+        Creates a set of derivatives for every frame (page) of a multi-frame TIFF, e.g. a multi-page scan.
+        Each frame is extracted to its own temporary TIFF, one at a time per worker, so the whole stack is never in
+        memory or on disk at once. Frames are processed in parallel, and each frame's derivatives are published to the
+        output folder as soon as they're complete. Derivative filenames have the frame number, starting from 1,
+        appended, e.g. full_0001.jpg and full_lossless_0001.jp2.
+
+        See :func:`generate_derivatives_from_tiff` for the other parameters.
+
+        :param max_workers: the most frames to process at once
+        :return: list of the filepaths created for each frame
+        """
+        self.log.debug("Processing frames of {0}".format(tiff_filepath))
+        with Image.open(tiff_filepath) as tiff_pil:
+            frame_count = getattr(tiff_pil, 'n_frames', 1)
+
+        scratch_folder = tempfile.mkdtemp(prefix='image-processing_frames_')
+        pool = ThreadPool(processes=max(1, min(max_workers, frame_count)))
+        try:
+            def generate_frame_derivatives(frame_number):
+                frame_tiff_filepath = os.path.join(scratch_folder, 'frame_{0:04d}.tif'.format(frame_number))
+                self.converter.extract_frame(tiff_filepath, frame_number - 1, frame_tiff_filepath)
+                try:
+                    return self._generate_derivatives_from_tiff(
+                        frame_tiff_filepath, output_folder, include_tiff=include_tiff,
+                        save_embedded_metadata=save_embedded_metadata, create_jpg_as_thumbnail=create_jpg_as_thumbnail,
+                        check_lossless=check_lossless, source_file_name=os.path.basename(tiff_filepath),
+                        frame_number=frame_number, source_identifier='{0}#{1}'.format(tiff_filepath, frame_number))
+                finally:
+                    os.remove(frame_tiff_filepath)
+
+            generated_files = pool.map(generate_frame_derivatives, range(1, frame_count + 1), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(scratch_folder, ignore_errors=True)
+
+        self.log.debug("Successfully generated derivatives for {0} frames of {1} in {2}"
+                       .format(frame_count, tiff_filepath, output_folder))
+        return generated_files
+
+    def generate_derivatives_from_stored_tiff(self, source_storage, source_key, output_storage, output_prefix,
+                                              include_tiff=False, save_embedded_metadata=True,
+                                              create_jpg_as_thumbnail=True, check_lossless=True,
+                                              upload_workers=DEFAULT_UPLOAD_WORKERS):
+        """
+        Like :func:`generate_derivatives_from_tiff`, but reading the TIFF from, and writing the derivatives to,
+        :mod:`~image_processing.storage` adapters, e.g. an S3 compatible object store.
+
+        The TIFF's header is checked through a ranged read before anything is downloaded, so unsuitable files fail fast.
+        The TIFF is then downloaded to a temporary file, because kdu_compress can't read from a stream, and removed
+        afterwards. Each derivative is uploaded as soon as it has been created, while the later ones are still being
+        generated; the jp2 is uploaded last, once it has been validated. If generating any derivative fails, the ones
+        that have already been uploaded are deleted.
+
+        See :func:`generate_derivatives_from_tiff` for the other parameters.
+
+        :param source_storage: :class:`~image_processing.storage.Storage`
+        :param source_key:
+        :param output_storage: :class:`~image_processing.storage.Storage`
+        :param output_prefix: the derivatives' keys are their filenames under this prefix
+        :param upload_workers: the most derivatives to upload at once
+        :return: the keys of the created objects
+        """
+        source_file_name = source_key.split('/')[-1]
+        with source_storage.open(source_key) as source_file_obj:
+            validation.check_image_suitable_for_jp2_conversion(
+                source_file_obj, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
+                require_icc_profile_for_greyscale=self.require_icc_profile_for_greyscale)
+
+        scratch_folder = tempfile.mkdtemp(prefix='image-processing_stored_')
+        pool = ThreadPool(processes=upload_workers)
+        uploads = []
+        try:
+            tiff_filepath = os.path.join(scratch_folder, source_file_name)
+            source_storage.download(source_key, tiff_filepath)
+            self.log.debug("Downloaded {0} to {1}".format(source_key, tiff_filepath))
+            with utils.StagingFolder(scratch_folder) as staging_folder:
+                for _, filepath in self._iter_derivatives_from_tiff(
+                        tiff_filepath, staging_folder, include_tiff, save_embedded_metadata,
+                        create_jpg_as_thumbnail, check_lossless, source_file_name, source_identifier=source_key):
+                    key = storage.join_key(output_prefix, os.path.basename(filepath))
+                    uploads.append((key, pool.apply_async(output_storage.upload, (filepath, key))))
+                # the staged files must be kept until they're uploaded
+                for _, upload in uploads:
+                    upload.get()
+        except Exception:
+            self._delete_uploads(output_storage, uploads)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(scratch_folder, ignore_errors=True)
+
+        output_keys = [key for key, _ in uploads]
+        self.log.debug("Successfully generated derivatives for {0}: {1}".format(source_key, output_keys))
+        return output_keys
+
+    def _delete_uploads(self, output_storage, uploads):
+        for key, upload in uploads:
+            upload.wait()
+            if upload.successful():
+                try:
+                    output_storage.delete(key)
+                except Exception as e:
+                    self.log.warning('Could not delete {0} after a failure: {1!r}'.format(key, e))
+
+    def _generate_derivatives_from_tiff(self, tiff_filepath, output_folder, include_tiff, save_embedded_metadata,
+                                        create_jpg_as_thumbnail, check_lossless, source_file_name, frame_number=None,
+                                        source_identifier=None, tile_pyramid_id=None):
+        """
+        :param source_file_name: the filename derivative filenames are based on
+        :param frame_number: if set, derivative filenames have this frame number appended
+        :param source_identifier: identifies the source in the fingerprint index. Defaults to the tiff filepath
+        :param tile_pyramid_id: if given, a tile pyramid with this @id is also created
+        """
+        with self._source_raster(tiff_filepath) as shared_raster, \
+                utils.StagingFolder(output_folder) as staging_folder:
+            content_key, pixel_checksum = self._content_key(tiff_filepath, shared_raster)
+            staged_files = list(self._iter_derivatives_from_tiff(
+                tiff_filepath, staging_folder, include_tiff, save_embedded_metadata, create_jpg_as_thumbnail,
+                check_lossless, source_file_name, frame_number, content_key=content_key, pixel_checksum=pixel_checksum,
+                source_identifier=source_identifier, tile_pyramid_id=tile_pyramid_id, shared_raster=shared_raster))
+
+            # nothing appears in the output folder until everything has been generated and validated
+            generated_files = staging_folder.publish([filepath for _, filepath in staged_files])
+            for (file_type, _), filepath in zip(staged_files, generated_files):
+                if file_type == LOSSLESS_JP2_TYPE:
+                    self._index_jp2(content_key, filepath, tiff_filepath)
+
+        self.log.debug("Successfully generated derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+
+        return generated_files
+
+    def _iter_derivatives_from_tiff(self, tiff_filepath, staging_folder, include_tiff, save_embedded_metadata,
+                                    create_jpg_as_thumbnail, check_lossless, source_file_name, frame_number=None,
+                                    content_key=None, pixel_checksum=None, source_identifier=None, kakadu_stats=None,
+                                    tile_pyramid_id=None, shared_raster=None):
+        """
+        Generate the derivatives into the staging folder, yielding the type and filepath of each as soon as that file
+        is complete. The jp2 is yielded last, once it has been validated.
+
+        :param staging_folder: :class:`~image_processing.utils.StagingFolder`
+        :param content_key: if given, a jp2 already recorded for it in the content index is reused
+        :param pixel_checksum: the source's pixel checksum, if it's already been generated
+        :param source_identifier: identifies the source in the fingerprint index. Defaults to the tiff filepath
+        :param kakadu_stats: if given, a list which the stats of the kakadu commands creating and checking the jp2 are
+            appended to, when the generator collects them
+        :param tile_pyramid_id: if given, a tile pyramid with this @id is created from the jp2, and yielded before it.
+            The jp2 is published as soon as it's yielded, so the pyramid has to be created first
+        :param shared_raster: :class:`~image_processing.shared_raster.SharedRaster` of the tiff, which the jpg is made
+            from if given
+        """
         self.log.debug("Processing {0}".format(tiff_filepath))
-        source_file_name = os.path.basename(tiff_filepath)
 
         validation.check_image_suitable_for_jp2_conversion(
             tiff_filepath, require_icc_profile_for_colour=self.require_icc_profile_for_colour,
@@ -142,43 +481,107 @@ class DerivativeFilesGenerator(object):
             # or if we need to normalise the tiff. Otherwise just use the original tiff
             temp_tiff_filepath = temp_tiff_file_obj.name
             if os.path.splitext(tiff_filepath)[1].lower() not in ['.tif', '.tiff']:
-                shutil.copy(tiff_filepath, temp_tiff_filepath)
+                utils.place_file(tiff_filepath, temp_tiff_filepath)
                 normalised_tiff_filepath = temp_tiff_filepath
             else:
                 normalised_tiff_filepath = tiff_filepath
 
-            jpeg_filepath = os.path.join(output_folder, self._get_filename(DEFAULT_JPG_FILENAME, source_file_name))
+            jpeg_filepath = staging_folder.filepath(
+                self._get_filename(DEFAULT_JPG_FILENAME, source_file_name, frame_number))
 
             jpg_quality = None if create_jpg_as_thumbnail else self.jpg_high_quality_value
             jpg_resize = self.jpg_thumbnail_resize_value if create_jpg_as_thumbnail else None
 
             self.converter.convert_to_jpg(normalised_tiff_filepath, jpeg_filepath,
-                                      quality=jpg_quality, resize=jpg_resize)
+                                          quality=jpg_quality, resize=jpg_resize, shared_raster=shared_raster)
             self.log.debug('jpeg file {0} generated'.format(jpeg_filepath))
-            generated_files = [jpeg_filepath]
+            if self.fingerprint_index is not None:
+                self._check_near_duplicates(jpeg_filepath, source_identifier or tiff_filepath)
+            yield JPG_TYPE, jpeg_filepath
 
             if save_embedded_metadata:
-                embedded_metadata_file_path = os.path.join(output_folder,
-                                                           self._get_filename(DEFAULT_EMBEDDED_METADATA_FILENAME, source_file_name))
+                embedded_metadata_file_path = staging_folder.filepath(
+                    self._get_filename(DEFAULT_EMBEDDED_METADATA_FILENAME, source_file_name, frame_number))
                 self.converter.extract_xmp_to_sidecar_file(tiff_filepath, embedded_metadata_file_path)
                 self.log.debug('Extracted metadata file {0} generated'.format(embedded_metadata_file_path))
-                generated_files += [embedded_metadata_file_path]
+                yield EMBEDDED_METADATA_TYPE, embedded_metadata_file_path
 
             if include_tiff:
-                output_tiff_filepath = os.path.join(output_folder,
-                                                    self._get_filename(DEFAULT_TIFF_FILENAME, source_file_name))
-                shutil.copy(tiff_filepath, output_tiff_filepath)
-                generated_files += [output_tiff_filepath]
-
-            lossless_filepath = os.path.join(output_folder,
-                                             self._get_filename(DEFAULT_LOSSLESS_JP2_FILENAME, source_file_name))
-            self.generate_jp2_from_tiff(normalised_tiff_filepath, lossless_filepath)
-            self.validate_jp2_conversion(normalised_tiff_filepath, lossless_filepath, check_lossless=check_lossless)
-            generated_files.append(lossless_filepath)
-
-            self.log.debug("Successfully generated derivatives for {0} in {1}".format(tiff_filepath, output_folder))
+                output_tiff_filepath = staging_folder.filepath(
+                    self._get_filename(DEFAULT_TIFF_FILENAME, source_file_name, frame_number))
+                self._place_source_file(tiff_filepath, output_tiff_filepath)
+                yield TIFF_TYPE, output_tiff_filepath
+
+            lossless_filepath = staging_folder.filepath(
+                self._get_filename(DEFAULT_LOSSLESS_JP2_FILENAME, source_file_name, frame_number))
+            indexed_filepath = self.content_index.lookup(content_key) if content_key is not None else None
+            if indexed_filepath is not None:
+                # the indexed jp2 has already been validated against identical pixels, so only its metadata differs
+                utils.place_file(indexed_filepath, lossless_filepath)
+                self.converter.copy_over_xmp_to_jp2(normalised_tiff_filepath, lossless_filepath)
+                self.log.info('Reused {0}, which has the same content as {1}'.format(indexed_filepath, tiff_filepath))
+            else:
+                # there's no yield while collecting, so another generator on this thread can't collect into the list
+                self._kakadu_stats.collected = kakadu_stats
+                try:
+                    self.generate_jp2_from_tiff(normalised_tiff_filepath, lossless_filepath)
+                    self.validate_jp2_conversion(normalised_tiff_filepath, lossless_filepath,
+                                                 check_lossless=check_lossless, source_pixel_checksum=pixel_checksum)
+                finally:
+                    self._kakadu_stats.collected = None
+
+            if tile_pyramid_id is not None:
+                pyramid_folder = staging_folder.filepath(
+                    self._get_filename(DEFAULT_TILE_PYRAMID_FOLDER_NAME, source_file_name, frame_number))
+                with Image.open(normalised_tiff_filepath) as tiff_pil:
+                    icc_profile = tiff_pil.info.get('icc_profile')
+                self.generate_tile_pyramid(lossless_filepath, pyramid_folder, tile_pyramid_id, icc_profile=icc_profile)
+                yield TILE_PYRAMID_TYPE, pyramid_folder
+            yield LOSSLESS_JP2_TYPE, lossless_filepath
+
+    def _source_raster(self, tiff_filepath):
+        """
+        :return: context manager giving a :class:`~image_processing.shared_raster.SharedRaster` of the TIFF, which is
+            released on exit, or None if the generator doesn't share source rasters
+        """
+        if not self.share_source_raster:
+            return _no_shared_raster()
+        from image_processing.shared_raster import SharedRaster
+        return SharedRaster.create(tiff_filepath)
 
-            return generated_files
+    def _content_key(self, tiff_filepath, shared_raster=None):
+        """
+        :return: the content key and pixel checksum of the TIFF. The key is None if there's no content index, and the
+            checksum is too unless it can be taken from the shared raster
+        """
+        if self.content_index is None:
+            return None, (shared_raster.pixel_checksum() if shared_raster is not None else None)
+        # imported here so that sqlite3 is only loaded when there is an index to look things up in
+        from image_processing.content_index import content_key
+        pixel_checksum = validation.generate_pixel_checksum(tiff_filepath, shared_raster=shared_raster)
+        recipe = {'kakadu_compress_options': self.get_compress_options(tiff_filepath),
+                  'kakadu_version': self.kakadu.get_version()}
+        return content_key(tiff_filepath, recipe, pixel_checksum=pixel_checksum), pixel_checksum
+
+    def _index_jp2(self, content_key, jp2_filepath, tiff_filepath):
+        if content_key is not None:
+            self.content_index.add(content_key, jp2_filepath, source_filepath=tiff_filepath)
+
+    def _check_near_duplicates(self, jpeg_filepath, source_identifier):
+        """
+        Fingerprint the source from its jpg, which is much quicker to decode, and add it to the fingerprint index
+        """
+        from image_processing.fingerprint import dhash_file
+        near_duplicates = self.fingerprint_index.search_and_add(source_identifier, dhash_file(jpeg_filepath))
+        if near_duplicates:
+            self.log.warning('{0} is a near duplicate of {1}'.format(
+                source_identifier, ', '.join(identifier for identifier, _ in near_duplicates)))
+            if self.on_near_duplicates is not None:
+                self.on_near_duplicates(source_identifier, near_duplicates)
+
+    def _place_source_file(self, source_filepath, output_filepath):
+        method = utils.place_file(source_filepath, output_filepath, allow_hardlink=self.hardlink_source_files)
+        self.log.debug('Placed {0} at {1} using {2}'.format(source_filepath, output_filepath, method))
 
     def generate_jp2_from_tiff(self, tiff_file, jp2_filepath):
         """
@@ -187,20 +590,101 @@ class DerivativeFilesGenerator(object):
 
         :param tiff_file: The source TIFF file.
         :param jp2_filepath: The output filepath
+        :return: :class:`~image_processing.kakadu.KakaduStats` of the compression, if the generator collects them
         """
-        kakadu_options = list(self.kakadu_compress_options)
+        kakadu_options = self.get_compress_options(tiff_file)
+        with Image.open(tiff_file) as tiff_pil:
+            image_size = tiff_pil.size
+
+        with _reserved_xmp_box() as box_options:
+            stats = self._run_kakadu('kdu_compress', tiff_file, jp2_filepath,
+                                     kakadu_options=kakadu_options + kakadu.recipe_comment_options(kakadu_options) +
+                                     box_options,
+                                     timeout=self._kakadu_timeout('kdu_compress', *image_size))
+        self.log.debug('Lossless jp2 file {0} generated'.format(jp2_filepath))
+        # as of v7.10.4, kakadu doesn't copy over a lot of the technical metadata, so we do that separately.
+        # It's written into the reserved box, so the file isn't copied again
+        self.converter.copy_over_xmp_to_jp2(tiff_file, jp2_filepath)
+        return stats
 
+    def get_compress_options(self, tiff_file):
+        """
+        :param tiff_file: The source TIFF file
+        :return: the kdu_compress options for creating a lossless JPEG2000 from the file, chosen by the
+            compress_options_policy
+        """
+        kakadu_options = list(self.kakadu_compress_options)
         with Image.open(tiff_file) as tiff_pil:
+            if self.compress_options_policy is not None:
+                kakadu_options = list(self.compress_options_policy(kakadu_options, kakadu.probe_image(tiff_pil)))
+                if kakadu_options != list(self.kakadu_compress_options):
+                    self.log.debug('Compressing {0} with {1}'.format(tiff_file, ' '.join(kakadu_options)))
             if tiff_pil.mode == 'RGBA':
                 if kakadu.ALPHA_OPTION not in kakadu_options:
                     kakadu_options += [kakadu.ALPHA_OPTION]
+        return kakadu_options
 
-        self.kakadu.kdu_compress(tiff_file, jp2_filepath, kakadu_options=kakadu_options)
-        self.log.debug('Lossless jp2 file {0} generated'.format(jp2_filepath))
-        # as of v7.10.4, kakadu doesn't copy over a lot of the technical metadata, so we do that separately
-        self.converter.copy_over_embedded_metadata(tiff_file, jp2_filepath, write_only_xmp=True)
+    def generate_tile_pyramid(self, jp2_filepath, pyramid_folder, image_id, icc_profile=None):
+        """
+        Creates a static IIIF level 0 tile pyramid from a JPEG2000, with
+        :func:`~image_processing.iiif_static.generate_tile_pyramid`
+
+        :param jp2_filepath: e.g. the lossless JPEG2000 created by generate_jp2_from_tiff
+        :param pyramid_folder: the folder to write the tiles and info.json to
+        :param image_id: the URI the pyramid will be hosted at
+        :param icc_profile: the ICC profile to embed in the tiles, e.g. the source image's
+        :return: the number of tiles
+        """
+        return iiif_static.generate_tile_pyramid(
+            self.kakadu, jp2_filepath, pyramid_folder, image_id, jpg_quality=self.jpg_high_quality_value,
+            icc_profile=icc_profile, kakadu_timeout=self._jp2_kakadu_timeout('kdu_expand', jp2_filepath))
 
-    def validate_jp2_conversion(self, tiff_file, jp2_filepath, check_lossless=True, jpylyzer_output_filepath=None):
+    def generate_lossy_jp2_from_lossless(self, lossless_jp2_filepath, lossy_jp2_filepath, layers=None, rate=None):
+        """
+        Creates a lossy JPEG2000 at lossy_jp2_filepath from an existing lossless JPEG2000, without going back to the
+        source TIFF.
+
+        If layers is given, the quality layers above it are discarded with kdu_transcode. This doesn't decode the image,
+        so is much cheaper than a re-encode, but the resulting bitrate depends on how the lossless file was layered
+        (the default options write 6 layers).
+        Otherwise the lossless file is expanded and recompressed at the given rate (or the rate in
+        :const:`~image_processing.kakadu.LOSSY_OPTIONS` if none is given).
+
+        :param lossless_jp2_filepath: The source lossless JPEG2000 file, e.g. one created by generate_jp2_from_tiff
+        :param lossy_jp2_filepath: The output filepath
+        :param layers: the number of quality layers to keep
+        :param rate: the bitrate (bits per pixel) to recompress at. Can't be used with layers
+        """
+        if layers is not None and rate is not None:
+            raise ValueError("Only one of layers or rate can be used to create a lossy jp2")
+
+        if layers is not None:
+            if layers < 1:
+                raise ValueError("At least one quality layer must be kept, not {0}".format(layers))
+            self._run_kakadu('kdu_transcode', lossless_jp2_filepath, lossy_jp2_filepath,
+                             kakadu_options=['-layers', str(layers)],
+                             timeout=self._jp2_kakadu_timeout('kdu_transcode', lossless_jp2_filepath))
+        else:
+            kakadu_options = list(kakadu.DEFAULT_LOSSY_COMPRESS_OPTIONS)
+            if rate is not None:
+                kakadu_options[kakadu_options.index('-rate') + 1] = str(rate)
+            with tempfile.NamedTemporaryFile(prefix='jp2_reconvert_', suffix='.tif') as expanded_tiff_file_obj:
+                expanded_tiff_filepath = expanded_tiff_file_obj.name
+                self._run_kakadu('kdu_expand', lossless_jp2_filepath, expanded_tiff_filepath, kakadu_options=[],
+                                 timeout=self._jp2_kakadu_timeout('kdu_expand', lossless_jp2_filepath))
+                with Image.open(expanded_tiff_filepath) as tiff_pil:
+                    if tiff_pil.mode == 'RGBA':
+                        kakadu_options += [kakadu.ALPHA_OPTION]
+                with _reserved_xmp_box() as box_options:
+                    self._run_kakadu('kdu_compress', expanded_tiff_filepath, lossy_jp2_filepath,
+                                     kakadu_options=kakadu_options + box_options,
+                                     timeout=self._jp2_kakadu_timeout('kdu_compress', lossless_jp2_filepath))
+        self.log.debug('Lossy jp2 file {0} generated from {1}'.format(lossy_jp2_filepath, lossless_jp2_filepath))
+        # as with generate_jp2_from_tiff, don't rely on kakadu to carry over the technical metadata
+        self.converter.copy_over_xmp_to_jp2(lossless_jp2_filepath, lossy_jp2_filepath)
+
+    def validate_jp2_conversion(self, tiff_file, jp2_filepath, check_lossless=True, jpylyzer_output_filepath=None,
+                                source_pixel_checksum=None):
         """
         Validate the jp2 file using jpylyzer, and check that the conversion from tif to jp2 was lossless
         Raises a :class:`~image_processing.exceptions.ValidationError` if either check fails.
@@ -209,12 +693,20 @@ class DerivativeFilesGenerator(object):
         :param jp2_filepath:
         :param check_lossless: if false, don't check the conversion from tif to jp2 was lossless
         :param jpylyzer_output_filepath: write the jpylyzer xml output to this file if given
+        :param source_pixel_checksum: the tiff's pixel checksum from
+            :func:`~image_processing.validation.generate_pixel_checksum`, if it's already been generated
         """
         validation.validate_jp2(jp2_filepath, jpylyzer_output_filepath)
         if check_lossless:
-            self.check_conversion_was_lossless(tiff_file, jp2_filepath)
+            if self.lossless_check_sample_size:
+                self.check_conversion_was_lossless_sampled(tiff_file, jp2_filepath,
+                                                           sample_size=self.lossless_check_sample_size,
+                                                           source_pixel_checksum=source_pixel_checksum)
+            else:
+                self.check_conversion_was_lossless(tiff_file, jp2_filepath,
+                                                   source_pixel_checksum=source_pixel_checksum)
 
-    def check_conversion_was_lossless(self, source_file, lossless_jpg_2000_file):
+    def check_conversion_was_lossless(self, source_file, lossless_jpg_2000_file, source_pixel_checksum=None):
         """
         Visually compare the source file to the TIFF generated by expanding the lossless JPEG2000,
         and raise a :class:`~image_processing.exceptions.ValidationError` if they do not match.
@@ -222,17 +714,128 @@ class DerivativeFilesGenerator(object):
 
         :param source_file: Must be TIFF - cannot convert losslessly from JPEG to TIFF
         :param lossless_jpg_2000_file: The JPEG2000 file to compare.
+        :param source_pixel_checksum: the source's pixel checksum, if it's already been generated
         """
         self.log.debug('Checking conversion from source file {0} to jp2 file {1} was lossless'
                        .format(source_file, lossless_jpg_2000_file))
         with tempfile.NamedTemporaryFile(prefix='jp2_reconvert_', suffix='.tif') as reconverted_tiff_file_obj:
             reconverted_tiff_filepath = reconverted_tiff_file_obj.name
-            self.kakadu.kdu_expand(lossless_jpg_2000_file, reconverted_tiff_filepath, kakadu_options=['-fussy'])
-            validation.check_visually_identical(source_file, reconverted_tiff_filepath)
+            self._run_kakadu('kdu_expand', lossless_jpg_2000_file, reconverted_tiff_filepath,
+                             kakadu_options=['-fussy'],
+                             timeout=self._jp2_kakadu_timeout('kdu_expand', lossless_jpg_2000_file))
+            validation.check_visually_identical(source_file, reconverted_tiff_filepath,
+                                                source_pixel_checksum=source_pixel_checksum)
         self.log.info('Conversion from source file {0} to jp2 file {1} was lossless'
                       .format(source_file, lossless_jpg_2000_file))
 
-    def _get_filename(self, default_filename, source_file_name):
+    def check_conversion_was_lossless_sampled(self, source_file, lossless_jpg_2000_file,
+                                              sample_size=DEFAULT_LOSSLESS_CHECK_SAMPLE_SIZE, seed=None,
+                                              source_pixel_checksum=None):
+        """
+        A cheaper version of :func:`check_conversion_was_lossless` for very large images.
+        Expands a random sample of the JPEG2000's tiles with kdu_expand -region, and compares each one with the same
+        window of the source file. If any of them don't match, or the image has too few tiles for sampling to be
+        worthwhile, falls back to the full check.
+        With numpy and tifffile, only the strips or tiles of the source TIFF which cover the sampled tiles are decoded.
+        Raises a :class:`~image_processing.exceptions.ValidationError` if the full check fails.
+
+        :param source_file: Must be TIFF - cannot convert losslessly from JPEG to TIFF
+        :param lossless_jpg_2000_file: The JPEG2000 file to compare.
+        :param sample_size: the number of tiles to compare
+        :param seed: seed for choosing the tiles. Defaults to the source filename, so any failures can be reproduced
+        :param source_pixel_checksum: the source's pixel checksum, if it's already been generated, for the full check
+        """
+        if seed is None:
+            seed = os.path.basename(source_file)
+        info = jp2.read_codestream_info(lossless_jpg_2000_file)
+        tile_columns = -(-info.width // info.tile_width)
+        tile_rows = -(-info.height // info.tile_height)
+        if tile_columns * tile_rows <= sample_size or info.x_offset or info.y_offset \
+                or info.tile_x_offset or info.tile_y_offset:
+            self.log.debug('Sampling tiles of {0} is not worthwhile, checking the whole image'
+                           .format(lossless_jpg_2000_file))
+            self.check_conversion_was_lossless(source_file, lossless_jpg_2000_file,
+                                               source_pixel_checksum=source_pixel_checksum)
+            return
+
+        tiles = random.Random(seed).sample(range(tile_columns * tile_rows), sample_size)
+        self.log.debug('Checking conversion from source file {0} to jp2 file {1} was lossless, using tiles {2} '
+                       '(seed {3})'.format(source_file, lossless_jpg_2000_file, sorted(tiles), seed))
+
+        if not self._sampled_tiles_match(source_file, lossless_jpg_2000_file, info, tiles):
+            self.log.warning('Sampled tiles of {0} do not match {1}, checking the whole image'
+                             .format(lossless_jpg_2000_file, source_file))
+            self.check_conversion_was_lossless(source_file, lossless_jpg_2000_file,
+                                               source_pixel_checksum=source_pixel_checksum)
+            return
+        self.log.info('Conversion from source file {0} to jp2 file {1} was lossless in {2} sampled tiles'
+                      .format(source_file, lossless_jpg_2000_file, sample_size))
+
+    def _sampled_tiles_match(self, source_file, lossless_jpg_2000_file, info, tiles):
+        """
+        :return: True if all the given tiles of the jp2 file have the same pixels as the source file
+        """
+        tile_columns = -(-info.width // info.tile_width)
+        with _SourceRegions(source_file) as source_regions:
+            source_is_bitonal = source_regions.mode == validation.BITONAL
+            for tile in tiles:
+                left = (tile % tile_columns) * info.tile_width
+                top = (tile // tile_columns) * info.tile_height
+                width = min(info.tile_width, info.width - left)
+                height = min(info.tile_height, info.height - top)
+                with tempfile.NamedTemporaryFile(prefix='jp2_region_', suffix='.tif') as region_tiff_file_obj:
+                    region_tiff_filepath = region_tiff_file_obj.name
+                    self._run_kakadu('kdu_expand', lossless_jpg_2000_file, region_tiff_filepath,
+                                     kakadu_options=['-fussy'] + kakadu.region_options(
+                                         left, top, width, height, info.width, info.height),
+                                     timeout=self._kakadu_timeout('kdu_expand', width, height))
+                    validation.check_colour_profiles_match(source_file, region_tiff_filepath)
+                    with Image.open(region_tiff_filepath) as region_image:
+                        if region_image.size != (width, height):
+                            self.log.warning('Expanded region of tile {0} has size {1}, not {2}'
+                                             .format(tile, region_image.size, (width, height)))
+                            return False
+                        if source_is_bitonal:
+                            region_image = region_image.convert(validation.BITONAL)
+                        region_checksum = validation.generate_pixel_checksum_from_pil_image(region_image)
+                source_checksum = validation.generate_pixel_checksum_from_pil_image(
+                    source_regions.region(left, top, width, height))
+                if region_checksum != source_checksum:
+                    self.log.warning('Tile {0} of {1} does not match {2}'
+                                     .format(tile, lossless_jpg_2000_file, source_file))
+                    return False
+        return True
+
+    def _run_kakadu(self, command, *args, **kwargs):
+        """
+        Run one of the :class:`~image_processing.kakadu.Kakadu` commands, collecting its stats if the generator
+        collects them
+
+        :param command: 'kdu_compress', 'kdu_expand' or 'kdu_transcode'
+        :return: :class:`~image_processing.kakadu.KakaduStats`, or None
+        """
+        stats = getattr(self.kakadu, command)(*args, collect_stats=self.collect_kakadu_stats, **kwargs)
+        if stats is not None:
+            self.log.info('{0} of {1} took {2:.2f}s ({3} CPU seconds), {4} tiles, {5} code-blocks, {6} warnings'.format(
+                command, args[0], stats.wall_seconds, stats.cpu_seconds, stats.tile_count, stats.code_block_count,
+                len(stats.warnings)))
+            collected = getattr(self._kakadu_stats, 'collected', None)
+            if collected is not None:
+                collected.append(stats)
+        return stats
+
+    def _kakadu_timeout(self, command, width, height):
+        if self.stage_timeouts is None:
+            return None
+        return self.stage_timeouts.kakadu_timeout(command, width, height)
+
+    def _jp2_kakadu_timeout(self, command, jp2_filepath):
+        if self.stage_timeouts is None:
+            return None
+        info = jp2.read_codestream_info(jp2_filepath)
+        return self.stage_timeouts.kakadu_timeout(command, info.width, info.height)
+
+    def _get_filename(self, default_filename, source_file_name, frame_number=None):
         """
         Get a filename for the derivative file specified by default_filename
         If use_default_filenames is set, just use the default value provided
@@ -240,16 +843,121 @@ class DerivativeFilesGenerator(object):
 
         :param default_filename:
         :param source_file_name:
+        :param frame_number: if set, appended to the filename, for derivatives of one frame of a multi-frame image
         """
         if self.use_default_filenames:
-            return default_filename
-
-        orig_filename_base = os.path.splitext(source_file_name)[0]
-        if default_filename == DEFAULT_TIFF_FILENAME:
-            return "{0}.tiff".format(orig_filename_base)
-        elif default_filename == DEFAULT_JPG_FILENAME:
-            return "{0}.jpg".format(orig_filename_base)
-        elif default_filename == DEFAULT_EMBEDDED_METADATA_FILENAME:
-            return "{0}.xmp".format(orig_filename_base)
-        elif default_filename == DEFAULT_LOSSLESS_JP2_FILENAME:
-            return "{0}.jp2".format(orig_filename_base)
+            filename = default_filename
+        else:
+            orig_filename_base = os.path.splitext(source_file_name)[0]
+            if default_filename == DEFAULT_TIFF_FILENAME:
+                filename = "{0}.tiff".format(orig_filename_base)
+            elif default_filename == DEFAULT_JPG_FILENAME:
+                filename = "{0}.jpg".format(orig_filename_base)
+            elif default_filename == DEFAULT_EMBEDDED_METADATA_FILENAME:
+                filename = "{0}.xmp".format(orig_filename_base)
+            elif default_filename == DEFAULT_LOSSLESS_JP2_FILENAME:
+                filename = "{0}.jp2".format(orig_filename_base)
+            elif default_filename == DEFAULT_TILE_PYRAMID_FOLDER_NAME:
+                filename = "{0}_iiif".format(orig_filename_base)
+            else:
+                return None
+
+        if frame_number is not None:
+            filename_base, extension = os.path.splitext(filename)
+            filename = "{0}_{1:04d}{2}".format(filename_base, frame_number, extension)
+        return filename
+
+
+class _SourceRegions(object):
+    """
+    Reads windows of the source image for the sampled lossless check. For 8 bit greyscale, RGB and RGBA TIFFs, only the
+    strips or tiles which cover each window are decoded, with tifffile. Otherwise, or without numpy and tifffile, the
+    window is cropped with Pillow, which decodes the whole image.
+    Use as a context manager.
+    """
+
+    SEGMENT_MODES = {(1, 1): 'L', (3, 2): 'RGB', (4, 2): 'RGBA'}
+    """PIL modes of the TIFFs read a segment at a time, by (samples per pixel, photometric interpretation)"""
+
+    def __init__(self, source_filepath):
+        self.source_filepath = source_filepath
+        self.mode = None
+        self._source_image = None
+        self._tiff = None
+        self._page = None
+        self._numpy = None
+
+    def __enter__(self):
+        self._source_image = Image.open(self.source_filepath)
+        self.mode = self._source_image.mode
+        if self._source_image.format != 'TIFF':
+            return self
+        try:
+            import numpy
+            import tifffile
+        except ImportError:
+            return self
+        tiff = tifffile.TiffFile(self.source_filepath)
+        page = tiff.pages[0]
+        # only when tifffile gives the same pixels as Pillow: e.g. Pillow unpremultiplies associated alpha
+        if page.bitspersample == 8 and page.planarconfig == 1 and \
+                self.SEGMENT_MODES.get((page.samplesperpixel, int(page.photometric))) == self.mode:
+            self._tiff, self._page, self._numpy = tiff, page, numpy
+        else:
+            tiff.close()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._tiff is not None:
+            self._tiff.close()
+        self._source_image.close()
+
+    def region(self, left, top, width, height):
+        """
+        :return: PIL image of the window
+        """
+        if self._page is None:
+            return self._source_image.crop((left, top, left + width, top + height))
+        page = self._page
+        if page.is_tiled:
+            segment_height, segment_width = page.tilelength, page.tilewidth
+        else:
+            segment_height, segment_width = min(page.rowsperstrip, page.imagelength), page.imagewidth
+        segments_across = -(-page.imagewidth // segment_width)
+        indices = [row * segments_across + column
+                   for row in range(top // segment_height, (top + height - 1) // segment_height + 1)
+                   for column in range(left // segment_width, (left + width - 1) // segment_width + 1)]
+
+        window = self._numpy.zeros((height, width, page.samplesperpixel), dtype=self._numpy.uint8)
+        segments = self._tiff.filehandle.read_segments([page.dataoffsets[index] for index in indices],
+                                                       [page.databytecounts[index] for index in indices],
+                                                       indices=indices)
+        for data, index in segments:
+            segment, (_, _, segment_top, segment_left, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            # the segment has a leading plane dimension, and tiles at the edges are padded
+            segment = segment[0]
+            row_start, row_end = max(top, segment_top), min(top + height, segment_top + segment.shape[0])
+            column_start = max(left, segment_left)
+            column_end = min(left + width, segment_left + segment.shape[1])
+            window[row_start - top:row_end - top, column_start - left:column_end - left] = \
+                segment[row_start - segment_top:row_end - segment_top,
+                        column_start - segment_left:column_end - segment_left]
+        return Image.fromarray(window[:, :, 0] if self.mode == 'L' else window)
+
+
+@contextmanager
+def _no_shared_raster():
+    yield None
+
+
+@contextmanager
+def _reserved_xmp_box():
+    """
+    Write a :func:`~image_processing.jp2.reserved_xmp_box` to a temporary file
+
+    :return: context manager giving the kdu_compress options which add the box to the jp2
+    """
+    with tempfile.NamedTemporaryFile(prefix='reserved_xmp_', suffix='.box') as box_file:
+        box_file.write(jp2.reserved_xmp_box())
+        box_file.flush()
+        yield [kakadu.BOX_OPTION, box_file.name]
@@ -15,3 +15,14 @@ class OpenJPEGError(ImageProcessingError):
 
 class ValidationError(ImageProcessingError):
     pass
+
+class CommandTimeoutError(ImageProcessingError):
+    """
+    An external command took longer than its timeout (or its CPU time limit), and was killed with its process group.
+    Distinct from the errors raised when a command fails, so callers can retry or quarantine the image instead.
+    """
+
+    def __init__(self, message, command=None, timeout=None):
+        super(CommandTimeoutError, self).__init__(message)
+        self.command = command
+        self.timeout = timeout
@@ -0,0 +1,168 @@
+"""
+Perceptual fingerprints for finding near duplicate images, e.g. the same page scanned again with slightly different
+cropping or exposure.
+
+Fingerprints are 64 bit difference hashes (dHash): the image is shrunk to 9x8 greyscale pixels, and each bit records
+whether a pixel is brighter than its right hand neighbour. They're cheap to compute from the jpg thumbnail, and similar
+images have fingerprints which differ in only a few bits.
+:class:`FingerprintIndex` keeps them packed in a numpy array, so an image can be compared with millions of others in
+milliseconds.
+
+Needs numpy, which is an optional dependency.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import threading
+
+from PIL import Image
+
+from image_processing.exceptions import ImageProcessingError
+
+HASH_SIZE = 8
+DEFAULT_MAX_DISTANCE = 10
+"""The most bits two fingerprints can differ by for the images to be near duplicates"""
+
+INITIAL_CAPACITY = 1024
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImageProcessingError("numpy is needed for image fingerprints. Install it with pip install numpy")
+    return numpy
+
+
+def dhash(image_pil):
+    """
+    :param image_pil: :class:`PIL.Image` instance
+    :return: the image's 64 bit difference hash, as an int
+    """
+    small_image = image_pil.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = bytearray(small_image.tobytes())
+    fingerprint = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            fingerprint = (fingerprint << 1) | (left > right)
+    return fingerprint
+
+
+def dhash_file(image_filepath):
+    """
+    :param image_filepath: ideally a small derivative such as the jpg thumbnail, which is much quicker to decode than
+        the source and gives the same fingerprint
+    :return: the image's 64 bit difference hash, as an int
+    """
+    with Image.open(image_filepath) as image_pil:
+        # jpegs can be decoded at a fraction of their size, which is still far bigger than the fingerprint needs
+        image_pil.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        return dhash(image_pil)
+
+
+def hamming_distance(fingerprint, other_fingerprint):
+    """
+    :return: the number of bits which differ between the two fingerprints
+    """
+    return bin(fingerprint ^ other_fingerprint).count('1')
+
+
+class FingerprintIndex(object):
+    """
+    An in-memory index of fingerprints, searched by Hamming distance with vectorised numpy operations.
+    Thread safe. Save it with :func:`save` and load it again with :func:`load`.
+    """
+
+    def __init__(self):
+        numpy = _numpy()
+        self._fingerprints = numpy.zeros(INITIAL_CAPACITY, dtype=numpy.uint64)
+        self._identifiers = []
+        self._lock = threading.Lock()
+        # the number of bits set in each byte value
+        self._popcount_table = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+    def __len__(self):
+        return len(self._identifiers)
+
+    def add(self, identifier, fingerprint):
+        """
+        :param identifier: text identifying the image, e.g. its filepath
+        :param fingerprint: from :func:`dhash`
+        """
+        with self._lock:
+            self._add_locked(identifier, fingerprint)
+
+    def _add_locked(self, identifier, fingerprint):
+        numpy = _numpy()
+        count = len(self._identifiers)
+        if count == len(self._fingerprints):
+            grown = numpy.zeros(len(self._fingerprints) * 2, dtype=numpy.uint64)
+            grown[:count] = self._fingerprints
+            self._fingerprints = grown
+        self._fingerprints[count] = fingerprint
+        self._identifiers.append(identifier)
+
+    def search(self, fingerprint, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        :param fingerprint: from :func:`dhash`
+        :param max_distance: the most bits the fingerprints can differ by
+        :return: list of (identifier, distance) of the indexed images within max_distance, nearest first
+        """
+        with self._lock:
+            return self._search_locked(fingerprint, max_distance)
+
+    def _search_locked(self, fingerprint, max_distance):
+        numpy = _numpy()
+        count = len(self._identifiers)
+        fingerprints = self._fingerprints[:count]
+        identifiers = self._identifiers
+        differences = numpy.bitwise_xor(fingerprints, numpy.uint64(fingerprint))
+        if hasattr(numpy, 'bitwise_count'):
+            # numpy 2.0+
+            distances = numpy.bitwise_count(differences)
+        else:
+            distances = self._popcount_table[differences.view(numpy.uint8)].reshape(count, 8).sum(axis=1)
+        matches = numpy.nonzero(distances <= max_distance)[0]
+        matches = matches[numpy.argsort(distances[matches], kind='stable')]
+        return [(identifiers[i], int(distances[i])) for i in matches]
+
+    def search_and_add(self, identifier, fingerprint, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        Search for near duplicates of an image, then add it to the index. Both are done holding the lock, so of two
+        near duplicates added at the same time, the second always finds the first
+
+        :return: list of (identifier, distance), as :func:`search`
+        """
+        with self._lock:
+            matches = self._search_locked(fingerprint, max_distance)
+            self._add_locked(identifier, fingerprint)
+        return matches
+
+    def save(self, index_filepath):
+        """
+        :param index_filepath: a .npz file
+        """
+        numpy = _numpy()
+        with self._lock:
+            count = len(self._identifiers)
+            with open(index_filepath, 'wb') as index_file:
+                numpy.savez(index_file, fingerprints=self._fingerprints[:count],
+                            identifiers=numpy.array(self._identifiers, dtype=numpy.str_))
+
+    @classmethod
+    def load(cls, index_filepath):
+        """
+        :param index_filepath: a file written by :func:`save`
+        :return: :class:`FingerprintIndex`
+        """
+        numpy = _numpy()
+        index = cls()
+        with numpy.load(index_filepath, allow_pickle=False) as saved:
+            fingerprints = saved['fingerprints']
+            index._identifiers = [str(identifier) for identifier in saved['identifiers']]
+        index._fingerprints = numpy.zeros(max(INITIAL_CAPACITY, len(fingerprints)), dtype=numpy.uint64)
+        index._fingerprints[:len(fingerprints)] = fingerprints
+        return index
@@ -0,0 +1,189 @@
+"""
+Parsing of IIIF Image API request paths, and planning how to serve them from a JPEG2000 file:
+which region of the full resolution image to decode, and how many resolution levels can be discarded.
+Rotation and quality are parsed but not planned for: they're cheap to apply after decoding.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import math
+import random
+import re
+from collections import namedtuple
+
+try:
+    from urllib.parse import unquote
+except ImportError:  # python 2
+    from urllib import unquote
+
+from image_processing.exceptions import ImageProcessingError
+
+IIIFRequest = namedtuple('IIIFRequest', ['identifier', 'region', 'size', 'rotation', 'quality', 'format'])
+"""The parameters of an IIIF image request, as strings"""
+
+DecodePlan = namedtuple('DecodePlan', ['left', 'top', 'width', 'height', 'reduce', 'output_width', 'output_height'])
+"""
+The region of the full resolution image to decode, the number of resolution levels to discard,
+and the final size of the image once it's been scaled
+"""
+
+_REQUEST_PATTERN = re.compile(
+    r'(?P<identifier>[^/\s"]+)/(?P<region>[^/\s"]+)/(?P<size>[^/\s"]+)/(?P<rotation>!?[\d.]+)/'
+    r'(?P<quality>[a-z]+)\.(?P<format>[a-z0-9]+)(?:[?\s"]|$)')
+
+
+def parse_request(request_line):
+    """
+    Find an IIIF image request in a URL, a path, or a line of a web server access log.
+
+    :param request_line:
+    :return: :class:`IIIFRequest`, or None if there isn't an image request in the line
+    """
+    match = _REQUEST_PATTERN.search(request_line)
+    if match is None:
+        return None
+    return IIIFRequest(identifier=unquote(match.group('identifier')), region=match.group('region'),
+                       size=match.group('size'), rotation=match.group('rotation'),
+                       quality=match.group('quality'), format=match.group('format'))
+
+
+def resolve_region(region, image_width, image_height):
+    """
+    :param region: an IIIF region parameter, e.g. 'full', 'square', '0,0,512,512' or 'pct:0,0,50,50'
+    :param image_width:
+    :param image_height:
+    :return: (left, top, width, height) of the region in the full resolution image, clipped to the image
+    """
+    if region == 'full':
+        return 0, 0, image_width, image_height
+    if region == 'square':
+        side = min(image_width, image_height)
+        return (image_width - side) // 2, (image_height - side) // 2, side, side
+    try:
+        if region.startswith('pct:'):
+            x, y, w, h = [float(v) for v in region[4:].split(',')]
+            left, top = int(round(x * image_width / 100)), int(round(y * image_height / 100))
+            width, height = int(round(w * image_width / 100)), int(round(h * image_height / 100))
+        else:
+            left, top, width, height = [int(v) for v in region.split(',')]
+    except ValueError:
+        raise ImageProcessingError("Invalid IIIF region {0}".format(region))
+    width = min(width, image_width - left)
+    height = min(height, image_height - top)
+    if left < 0 or top < 0 or width <= 0 or height <= 0:
+        raise ImageProcessingError("IIIF region {0} is outside the {1}x{2} image"
+                                   .format(region, image_width, image_height))
+    return left, top, width, height
+
+
+def resolve_size(size, region_width, region_height):
+    """
+    :param size: an IIIF size parameter, e.g. 'full', 'max', '512,', ',512', 'pct:50', '512,512' or '!512,512'
+    :param region_width:
+    :param region_height:
+    :return: (width, height) of the output image
+    """
+    if size in ['full', 'max']:
+        return region_width, region_height
+    try:
+        if size.startswith('pct:'):
+            scale = float(size[4:]) / 100
+            return max(1, int(round(region_width * scale))), max(1, int(round(region_height * scale)))
+        best_fit = size.startswith('!')
+        width, height = size.lstrip('!').split(',')
+        if width and height:
+            width, height = int(width), int(height)
+            if best_fit:
+                scale = min(width / region_width, height / region_height)
+                return max(1, int(round(region_width * scale))), max(1, int(round(region_height * scale)))
+            return width, height
+        if width:
+            width = int(width)
+            return width, max(1, int(round(region_height * width / region_width)))
+        height = int(height)
+        return max(1, int(round(region_width * height / region_height))), height
+    except (ValueError, ZeroDivisionError):
+        raise ImageProcessingError("Invalid IIIF size {0}".format(size))
+
+
+def plan_decode(request, image_width, image_height, levels):
+    """
+    Work out the cheapest way to decode the image for the request: the most resolution levels that can be discarded
+    while still decoding at least as many pixels as the output size.
+
+    :param request: :class:`IIIFRequest`
+    :param image_width: size of the full resolution image
+    :param image_height:
+    :param levels: the number of resolution levels (DWT levels) in the JPEG2000 file
+    :return: :class:`DecodePlan`
+    """
+    left, top, width, height = resolve_region(request.region, image_width, image_height)
+    output_width, output_height = resolve_size(request.size, width, height)
+    reduce = 0
+    while reduce < levels and \
+            int(math.ceil(width / 2 ** (reduce + 1))) >= output_width and \
+            int(math.ceil(height / 2 ** (reduce + 1))) >= output_height:
+        reduce += 1
+    return DecodePlan(left=left, top=top, width=width, height=height, reduce=reduce,
+                      output_width=output_width, output_height=output_height)
+
+
+def info_json(image_id, width, height, tile_width, tile_height, levels, compliance_level=1, sizes=None):
+    """
+    The IIIF Image API 2.1 image information document for an image tiled like a JPEG2000 file, so that a viewer asks
+    for tiles which line up with the JPEG2000's tiles.
+
+    :param image_id: the image's base URI, i.e. the request URL without the region, size, rotation, quality and format
+    :param width: size of the full resolution image
+    :param height:
+    :param tile_width: size of the tiles at full resolution
+    :param tile_height:
+    :param levels: the number of resolution levels (DWT levels), giving the scale factors viewers can ask for
+    :param compliance_level: 0 for a static tile pyramid, which can only serve the listed tiles and sizes
+    :param sizes: list of (width, height) of the whole image sizes to list. Defaults to the size at each scale factor
+    :return: dict, to be serialised as JSON
+    """
+    scale_factors = [2 ** level for level in range(levels + 1)]
+    if sizes is None:
+        sizes = [(int(math.ceil(width / scale)), int(math.ceil(height / scale))) for scale in scale_factors]
+    return {
+        '@context': 'http://iiif.io/api/image/2/context.json',
+        '@id': image_id,
+        'protocol': 'http://iiif.io/api/image',
+        'width': width,
+        'height': height,
+        'sizes': [{'width': size_width, 'height': size_height} for size_width, size_height in sorted(sizes)],
+        'tiles': [{'width': tile_width, 'height': tile_height, 'scaleFactors': scale_factors}],
+        'profile': ['http://iiif.io/api/image/2/level{0}.json'.format(compliance_level)],
+    }
+
+
+def synthetic_requests(images, count, tile_size=512, thumbnail_fraction=0.1, seed=0):
+    """
+    Generate requests like the ones a deep zoom viewer (e.g. OpenSeadragon or Mirador) makes against a level 0 or 1
+    IIIF server: tiles at every scale factor, and some thumbnails.
+
+    :param images: list of (identifier, width, height, levels) tuples
+    :param count: the number of requests to generate
+    :param tile_size: tile size advertised in the info.json
+    :param thumbnail_fraction: fraction of the requests that are for a thumbnail of the full image
+    :param seed:
+    :return: list of :class:`IIIFRequest`
+    """
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        identifier, width, height, levels = rng.choice(images)
+        if rng.random() < thumbnail_fraction:
+            requests.append(IIIFRequest(identifier, 'full', '!256,256', '0', 'default', 'jpg'))
+            continue
+        scale = 2 ** rng.randint(0, levels)
+        region_size = tile_size * scale
+        left = rng.randrange(0, width, region_size)
+        top = rng.randrange(0, height, region_size)
+        region_width, region_height = min(region_size, width - left), min(region_size, height - top)
+        output_width = int(math.ceil(region_width / scale))
+        requests.append(IIIFRequest(identifier, '{0},{1},{2},{3}'.format(left, top, region_width, region_height),
+                                    '{0},'.format(output_width), '0', 'default', 'jpg'))
+    return requests
@@ -0,0 +1,236 @@
+"""
+Replay a log of IIIF image requests against local JPEG2000 files, to measure how quickly a compression recipe lets an
+image server decode the regions it's asked for. Each request is decoded with kdu_expand (or opj_decompress) using
+-region and -reduce, the same way an image server would. Run it as a script:
+::
+
+    python -m image_processing.iiif_replay --kakadu-base-path /opt/kakadu --log access.log jp2_folder/
+
+or with ``--synthetic 1000`` instead of a log, to generate deep zoom viewer tile requests.
+The identifier in each request is matched to the name of a JPEG2000 file in the folder, with or without the extension.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from timeit import default_timer
+
+from image_processing import iiif, jp2, kakadu, openjpeg
+from image_processing.exceptions import ImageProcessingError
+
+_PROC_IO_FILEPATH = '/proc/self/io'
+
+ReplayResult = namedtuple('ReplayResult', ['request', 'plan', 'seconds', 'bytes_read', 'error'])
+"""
+The outcome of replaying one request. bytes_read is None if it can't be measured on this platform.
+"""
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+def _bytes_read_by_children():
+    """
+    On Linux, the read I/O of child processes is added to the parent's counters when they're reaped,
+    so the change in this over a subprocess call is the number of bytes it read
+
+    :return: bytes read by this process and its finished children, or None if not available
+    """
+    try:
+        with open(_PROC_IO_FILEPATH) as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def find_jp2_files(jp2_folder, recursive=False):
+    """
+    :param jp2_folder:
+    :param recursive: include files in subfolders, identified by their path relative to jp2_folder, e.g.
+        'book/page1/full_lossless'
+    :return: dict of IIIF identifier to jp2 filepath. Each file is included with and without its extension
+    """
+    jp2_files = {}
+    for folder, subfolders, filenames in os.walk(jp2_folder):
+        subfolders.sort()
+        relative_folder = os.path.relpath(folder, jp2_folder)
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in ['.jp2', '.jpx', '.j2k']:
+                identifier = filename if relative_folder == os.curdir else \
+                    '/'.join(relative_folder.split(os.sep) + [filename])
+                filepath = os.path.join(folder, filename)
+                jp2_files[identifier] = filepath
+                jp2_files[os.path.splitext(identifier)[0]] = filepath
+        if not recursive:
+            break
+    return jp2_files
+
+
+class RequestReplayer(object):
+    """
+    Decodes IIIF requests from local JPEG2000 files with either Kakadu or OpenJPEG
+    """
+
+    def __init__(self, jp2_files, kakadu_base_path=None, openjpeg_base_path=None):
+        """
+        :param jp2_files: dict of IIIF identifier to jp2 filepath
+        :param kakadu_base_path: the location of kdu_expand
+        :param openjpeg_base_path: the location of opj_decompress. Only used if kakadu_base_path isn't given
+        """
+        self.jp2_files = jp2_files
+        self.log = logging.getLogger(__name__)
+        if kakadu_base_path is not None:
+            self.kakadu = kakadu.Kakadu(kakadu_base_path)
+            self.openjpeg = None
+        elif openjpeg_base_path is not None:
+            self.kakadu = None
+            self.openjpeg = openjpeg.OpenJPEG(openjpeg_base_path)
+        else:
+            raise ValueError("Either kakadu_base_path or openjpeg_base_path is needed to decode requests")
+        self._codestream_info = {}
+
+    def replay(self, requests):
+        """
+        Decode each request in turn, timing it and measuring how much of the file was read.
+
+        :param requests: iterable of :class:`~image_processing.iiif.IIIFRequest`
+        :return: list of :class:`ReplayResult`
+        """
+        scratch_folder = tempfile.mkdtemp(prefix='image-processing_replay_')
+        try:
+            output_filepath = os.path.join(scratch_folder, 'region.tif')
+            return [self._replay_request(request, output_filepath) for request in requests]
+        finally:
+            shutil.rmtree(scratch_folder)
+
+    def _replay_request(self, request, output_filepath):
+        plan = None
+        try:
+            jp2_filepath = self.jp2_files[request.identifier]
+            if jp2_filepath not in self._codestream_info:
+                self._codestream_info[jp2_filepath] = jp2.read_codestream_info(jp2_filepath)
+            info = self._codestream_info[jp2_filepath]
+            plan = iiif.plan_decode(request, info.width, info.height, info.levels)
+
+            bytes_read_before = _bytes_read_by_children()
+            start = default_timer()
+            self.decode(jp2_filepath, output_filepath, plan, info)
+            seconds = default_timer() - start
+            bytes_read_after = _bytes_read_by_children()
+            bytes_read = None if bytes_read_before is None else bytes_read_after - bytes_read_before
+            return ReplayResult(request=request, plan=plan, seconds=seconds, bytes_read=bytes_read, error=None)
+        except (KeyError, ImageProcessingError, IOError, OSError) as e:
+            self.log.warning('Request {0} failed: {1!r}'.format(request, e))
+            return ReplayResult(request=request, plan=plan, seconds=None, bytes_read=None, error=str(e))
+
+    def decode(self, jp2_filepath, output_filepath, plan, info):
+        """
+        Decode the planned region at the planned resolution level to output_filepath
+
+        :param jp2_filepath:
+        :param output_filepath:
+        :param plan: :class:`~image_processing.iiif.DecodePlan`
+        :param info: :class:`~image_processing.jp2.CodestreamInfo` for the jp2 file
+        """
+        if self.kakadu is not None:
+            self.kakadu.kdu_expand(jp2_filepath, output_filepath,
+                                   kakadu_options=kakadu.region_options(plan.left, plan.top, plan.width, plan.height,
+                                                                        info.width, info.height) +
+                                   ['-reduce', str(plan.reduce)])
+        else:
+            self.openjpeg.opj_decompress(jp2_filepath, output_filepath, openjpeg_options=[
+                '-d', '{0},{1},{2},{3}'.format(plan.left, plan.top, plan.left + plan.width, plan.top + plan.height),
+                '-r', str(plan.reduce)])
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile
+
+    :param values: list of numbers
+    :param percent: between 0 and 100
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(math.ceil(percent / 100 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarise(results):
+    """
+    :param results: list of :class:`ReplayResult`
+    :return: dict of request counts, latency percentiles (seconds) and bytes read per request
+    """
+    succeeded = [result for result in results if result.error is None]
+    latencies = [result.seconds for result in succeeded]
+    bytes_read = [result.bytes_read for result in succeeded if result.bytes_read is not None]
+    summary = {
+        'requests': len(results),
+        'errors': len(results) - len(succeeded),
+        'mean_seconds': sum(latencies) / len(latencies) if latencies else None,
+        'max_seconds': max(latencies) if latencies else None,
+        'mean_bytes_read': sum(bytes_read) / len(bytes_read) if bytes_read else None,
+        'p50_bytes_read': percentile(bytes_read, 50),
+        'p99_bytes_read': percentile(bytes_read, 99),
+    }
+    for percent in PERCENTILES:
+        summary['p{0}_seconds'.format(percent)] = percentile(latencies, percent)
+    return summary
+
+
+def read_request_log(log_filepath):
+    """
+    :param log_filepath: file with one request per line, as URLs, paths or web server access log lines
+    :return: list of :class:`~image_processing.iiif.IIIFRequest`. Lines without an image request are skipped
+    """
+    with open(log_filepath) as log_file:
+        requests = [iiif.parse_request(line) for line in log_file]
+    return [request for request in requests if request is not None]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay IIIF image requests against local JPEG2000 files')
+    parser.add_argument('jp2_folder', help='folder of JPEG2000 files named by IIIF identifier')
+    request_source = parser.add_mutually_exclusive_group(required=True)
+    request_source.add_argument('--log', help='file of IIIF request URLs or access log lines')
+    request_source.add_argument('--synthetic', type=int, help='generate this many deep zoom requests')
+    parser.add_argument('--tile-size', type=int, default=512, help='tile size for synthetic requests')
+    parser.add_argument('--seed', type=int, default=0)
+    decoder = parser.add_mutually_exclusive_group(required=True)
+    decoder.add_argument('--kakadu-base-path', help='location of kdu_expand')
+    decoder.add_argument('--openjpeg-base-path', help='location of opj_decompress')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    jp2_files = find_jp2_files(args.jp2_folder)
+    if args.log:
+        requests = read_request_log(args.log)
+    else:
+        images = []
+        for filename, filepath in sorted(jp2_files.items()):
+            if filename == os.path.basename(filepath):
+                info = jp2.read_codestream_info(filepath)
+                images.append((filename, info.width, info.height, info.levels))
+        requests = iiif.synthetic_requests(images, args.synthetic, tile_size=args.tile_size, seed=args.seed)
+
+    replayer = RequestReplayer(jp2_files, kakadu_base_path=args.kakadu_base_path,
+                               openjpeg_base_path=args.openjpeg_base_path)
+    summary = summarise(replayer.replay(requests))
+    for key in sorted(summary):
+        print('{0}: {1}'.format(key, summary[key]))
+    return 0 if summary['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
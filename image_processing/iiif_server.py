@@ -0,0 +1,443 @@
+"""
+A lightweight local IIIF image server, for checking JPEG2000 files before they're published: point a deep zoom viewer
+such as OpenSeadragon or Mirador at it to pan and zoom around the files in an output folder.
+Each request is decoded with kdu_expand using -region and -reduce, as planned by :mod:`image_processing.iiif`, and the
+encoded responses are kept in a :class:`TileCache`. Run it as a script:
+::
+
+    python -m image_processing.iiif_server --kakadu-base-path /opt/kakadu --cache-folder /tmp/tiles output_folder/
+
+JPEG2000 files in subfolders are identified by their path relative to the folder, with the slashes URL encoded, e.g.
+``http://localhost:8182/book%2Fpage1%2Ffull_lossless/info.json``.
+It's meant for a single workstation: it only uses the standard library, and doesn't attempt any access control.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+from PIL import Image
+
+from image_processing import iiif, iiif_replay, jp2, kakadu
+from image_processing.exceptions import ImageProcessingError, KakaduError, CommandTimeoutError
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import quote, unquote
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote, unquote
+
+DEFAULT_PORT = 8182
+DEFAULT_MAX_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_JPG_QUALITY = 90
+
+FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'tif': ('TIFF', 'image/tiff'),
+}
+"""IIIF formats which can be served, with their Pillow format and content type"""
+
+QUALITY_MODES = {'default': None, 'color': None, 'gray': 'L', 'bitonal': '1'}
+
+
+class _Flight(object):
+    """
+    A tile being created by one thread, which other threads asking for the same tile wait for
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+
+class TileCache(object):
+    """
+    A thread safe least recently used cache of encoded tiles, in memory and optionally on disk, evicted by size.
+    Concurrent requests for a tile which isn't cached are coalesced, so it's only created once.
+    The disk cache survives restarts, so it should be cleared if the JPEG2000 files are modified without their
+    modification time changing.
+    """
+
+    def __init__(self, max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES, disk_folder=None,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """
+        :param max_memory_bytes: the most the tiles kept in memory can add up to
+        :param disk_folder: if given, tiles are also kept in this folder
+        :param max_disk_bytes: the most the tiles kept on disk can add up to
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_folder = disk_folder
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.log = logging.getLogger(__name__)
+        if disk_folder is not None:
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        if not os.path.isdir(self.disk_folder):
+            os.makedirs(self.disk_folder)
+        entries = []
+        for filename in os.listdir(self.disk_folder):
+            filepath = os.path.join(self.disk_folder, filename)
+            if filename.startswith('.'):
+                # left over from a write which was interrupted
+                os.remove(filepath)
+                continue
+            stat = os.stat(filepath)
+            entries.append((stat.st_mtime, filename, stat.st_size))
+        # the least recently used tiles were touched longest ago
+        for _, digest, size in sorted(entries):
+            self._disk[digest] = size
+            self._disk_bytes += size
+        self._evict_from_disk()
+
+    def get(self, key, create):
+        """
+        :param key: text identifying the tile
+        :param create: function which returns the tile's bytes, called if it isn't cached
+        :return: the tile's bytes
+        """
+        digest = sha1(key.encode('utf-8')).hexdigest()
+        with self._lock:
+            data = self._memory.pop(digest, None)
+            if data is not None:
+                self._memory[digest] = data
+                self.memory_hits += 1
+                return data
+            flight = self._in_flight.get(digest)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._in_flight[digest] = _Flight()
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.data
+
+        try:
+            data = self._read_from_disk(digest)
+            if data is None:
+                with self._lock:
+                    self.misses += 1
+                data = create()
+                self._write_to_disk(digest, data)
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+            self._remember(digest, data)
+            flight.data = data
+            return data
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[digest]
+            flight.done.set()
+
+    def _remember(self, digest, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            self._memory[digest] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _read_from_disk(self, digest):
+        if self.disk_folder is None:
+            return None
+        with self._lock:
+            if digest not in self._disk:
+                return None
+            self._disk[digest] = self._disk.pop(digest)
+        filepath = os.path.join(self.disk_folder, digest)
+        try:
+            with open(filepath, 'rb') as tile_file:
+                data = tile_file.read()
+            # keep the order on disk, for when the cache is loaded again
+            os.utime(filepath, None)
+            return data
+        except (IOError, OSError):
+            # evicted by another thread in the meantime
+            return None
+
+    def _write_to_disk(self, digest, data):
+        if self.disk_folder is None or len(data) > self.max_disk_bytes:
+            return
+        file_descriptor, temp_filepath = tempfile.mkstemp(prefix='.', dir=self.disk_folder)
+        with os.fdopen(file_descriptor, 'wb') as tile_file:
+            tile_file.write(data)
+        os.rename(temp_filepath, os.path.join(self.disk_folder, digest))
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(digest, 0)
+            self._disk[digest] = len(data)
+            self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            digest, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.disk_folder, digest))
+            except OSError as e:
+                self.log.warning('Could not remove cached tile {0}: {1!r}'.format(digest, e))
+
+
+class TileService(object):
+    """
+    Answers IIIF image and image information requests for the JPEG2000 files in a folder
+    """
+
+    def __init__(self, jp2_folder, kakadu_base_path, cache=None, jpg_quality=DEFAULT_JPG_QUALITY):
+        """
+        :param jp2_folder: searched recursively. Files added while the service is running are found when they're
+            first requested
+        :param kakadu_base_path: the location of kdu_expand
+        :param cache: :class:`TileCache`. Defaults to an in-memory cache
+        :param jpg_quality: between 0 and 95
+        """
+        self.jp2_folder = jp2_folder
+        self.kakadu = kakadu.Kakadu(kakadu_base_path)
+        self.cache = cache if cache is not None else TileCache()
+        self.jpg_quality = jpg_quality
+        self.log = logging.getLogger(__name__)
+        self._jp2_files = {}
+        self._codestream_info = {}
+        self._lock = threading.Lock()
+
+    def find_jp2_file(self, identifier):
+        """
+        :return: the filepath of the jp2 file with the IIIF identifier, or None
+        """
+        with self._lock:
+            filepath = self._jp2_files.get(identifier)
+            if filepath is None or not os.path.isfile(filepath):
+                self._jp2_files = iiif_replay.find_jp2_files(self.jp2_folder, recursive=True)
+                filepath = self._jp2_files.get(identifier)
+            return filepath
+
+    def codestream_info(self, jp2_filepath):
+        """
+        :return: :class:`~image_processing.jp2.CodestreamInfo`, cached until the file is modified
+        """
+        modified = os.path.getmtime(jp2_filepath)
+        with self._lock:
+            cached = self._codestream_info.get(jp2_filepath)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        info = jp2.read_codestream_info(jp2_filepath)
+        with self._lock:
+            self._codestream_info[jp2_filepath] = (modified, info)
+        return info
+
+    def image_info(self, identifier, base_uri):
+        """
+        :param identifier: IIIF identifier
+        :param base_uri: the server's URI, which the identifier is appended to for the image's @id
+        :return: dict for the info.json, or None if there's no such image
+        """
+        jp2_filepath = self.find_jp2_file(identifier)
+        if jp2_filepath is None:
+            return None
+        info = self.codestream_info(jp2_filepath)
+        return iiif.info_json('{0}/{1}'.format(base_uri.rstrip('/'), quote(identifier, safe='')),
+                              info.width, info.height, info.tile_width, info.tile_height, info.levels)
+
+    def image(self, request):
+        """
+        :param request: :class:`~image_processing.iiif.IIIFRequest`
+        :return: (content type, image bytes), or None if there's no such image
+        """
+        if request.format not in FORMATS:
+            raise ImageProcessingError('Unsupported IIIF format {0}'.format(request.format))
+        if request.quality not in QUALITY_MODES:
+            raise ImageProcessingError('Unsupported IIIF quality {0}'.format(request.quality))
+        jp2_filepath = self.find_jp2_file(request.identifier)
+        if jp2_filepath is None:
+            return None
+        info = self.codestream_info(jp2_filepath)
+        plan = iiif.plan_decode(request, info.width, info.height, info.levels)
+        # the plan normalises the request, so e.g. 'full' and '0,0,w,h' share a cache entry
+        key = '{0}:{1}:{2}:{3}:{4}:{5}'.format(os.path.abspath(jp2_filepath), os.path.getmtime(jp2_filepath),
+                                               tuple(plan), request.rotation, request.quality, request.format)
+        data = self.cache.get(key, lambda: self._render(jp2_filepath, info, plan, request))
+        return FORMATS[request.format][1], data
+
+    def _render(self, jp2_filepath, info, plan, request):
+        scratch_folder = tempfile.mkdtemp(prefix='image-processing_iiif_')
+        try:
+            region_filepath = os.path.join(scratch_folder, 'region.tif')
+            self.kakadu.kdu_expand(jp2_filepath, region_filepath,
+                                   kakadu_options=kakadu.region_options(plan.left, plan.top, plan.width, plan.height,
+                                                                        info.width, info.height) +
+                                   ['-reduce', str(plan.reduce)])
+            with Image.open(region_filepath) as region_image:
+                image = region_image.copy()
+        finally:
+            shutil.rmtree(scratch_folder)
+
+        if image.size != (plan.output_width, plan.output_height):
+            image = image.resize((plan.output_width, plan.output_height), Image.LANCZOS)
+        image = _rotate(image, request.rotation)
+        mode = QUALITY_MODES[request.quality]
+        if mode is not None and image.mode != mode:
+            image = image.convert(mode)
+        pil_format = FORMATS[request.format][0]
+        if pil_format == 'JPEG' and image.mode not in ['RGB', 'L', 'CMYK']:
+            image = image.convert('RGB')
+
+        output = io.BytesIO()
+        save_options = {'quality': self.jpg_quality} if pil_format == 'JPEG' else {}
+        if image.info.get('icc_profile'):
+            save_options['icc_profile'] = image.info['icc_profile']
+        image.save(output, pil_format, **save_options)
+        return output.getvalue()
+
+
+def _rotate(image, rotation):
+    """
+    :param rotation: IIIF rotation, in degrees clockwise, with a leading ! to mirror the image first
+    """
+    if rotation.startswith('!'):
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        rotation = rotation[1:]
+    try:
+        degrees = float(rotation) % 360
+    except ValueError:
+        raise ImageProcessingError('Invalid IIIF rotation {0}'.format(rotation))
+    transpositions = {90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90}
+    if degrees == 0:
+        return image
+    if degrees in transpositions:
+        return image.transpose(transpositions[degrees])
+    # PIL rotates anticlockwise
+    return image.rotate(-degrees, resample=Image.BICUBIC, expand=True)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # set on the subclass created by make_server
+    tile_service = None
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        try:
+            if path.endswith('/info.json'):
+                self._send_info(path)
+                return
+            request = iiif.parse_request(path)
+            if request is None:
+                self._send_error(400, 'Not an IIIF image request')
+                return
+            result = self.tile_service.image(request)
+            if result is None:
+                self._send_error(404, 'No image {0}'.format(request.identifier))
+                return
+            self._send(200, result[0], result[1])
+        except (KakaduError, CommandTimeoutError, IOError, OSError) as e:
+            self.log_error('%s', e)
+            self._send_error(500, str(e))
+        except ImageProcessingError as e:
+            # an invalid request
+            self._send_error(400, str(e))
+        except Exception as e:
+            # e.g. a PIL error: still answer, rather than dropping the connection
+            logging.getLogger(__name__).exception('Failed to handle %s', self.path)
+            self._send_error(500, 'Internal error: {0}'.format(e))
+
+    def _send_info(self, path):
+        identifier = unquote(path[:-len('/info.json')].rsplit('/', 1)[-1])
+        base_uri = 'http://{0}{1}'.format(self.headers.get('Host', 'localhost'),
+                                          path[:-len('/info.json')].rsplit('/', 1)[0])
+        info = self.tile_service.image_info(identifier, base_uri)
+        if info is None:
+            self._send_error(404, 'No image {0}'.format(identifier))
+            return
+        self._send(200, 'application/json', json.dumps(info, indent=2).encode('utf-8'))
+
+    def _send_error(self, status, message):
+        self._send(status, 'text/plain; charset=utf-8', message.encode('utf-8'))
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        # viewers are often served from another origin
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug('%s - %s', self.address_string(), format % args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(tile_service, host='127.0.0.1', port=DEFAULT_PORT):
+    """
+    :param tile_service: :class:`TileService`
+    :param host: only listens on this machine by default
+    :param port: 0 picks a free port, which is server.server_address[1]
+    :return: an HTTP server, which handles each request in its own thread. Call its serve_forever method to run it
+    """
+    handler = type('RequestHandler', (_RequestHandler, object), {'tile_service': tile_service})
+    return _ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve IIIF image requests from local JPEG2000 files')
+    parser.add_argument('jp2_folder', help='folder of JPEG2000 files, which is searched recursively')
+    parser.add_argument('--kakadu-base-path', required=True, help='location of kdu_expand')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--cache-folder', help='keep tiles on disk in this folder too')
+    parser.add_argument('--max-memory-mb', type=int, default=DEFAULT_MAX_MEMORY_BYTES // (1024 * 1024))
+    parser.add_argument('--max-disk-mb', type=int, default=DEFAULT_MAX_DISK_BYTES // (1024 * 1024))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    cache = TileCache(max_memory_bytes=args.max_memory_mb * 1024 * 1024, disk_folder=args.cache_folder,
+                      max_disk_bytes=args.max_disk_mb * 1024 * 1024)
+    server = make_server(TileService(args.jp2_folder, args.kakadu_base_path, cache=cache),
+                         host=args.host, port=args.port)
+    print('Serving {0} at http://{1}:{2}/'.format(args.jp2_folder, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
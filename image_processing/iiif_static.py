@@ -0,0 +1,187 @@
+"""
+Static IIIF Level 0 tile pyramids, for delivery channels which can only host static files.
+The pyramid is a folder of jpg tiles laid out the way a viewer asks for them, e.g.
+``512,512,512,512/512,/0/default.jpg``, with an ``info.json`` describing them.
+
+Each resolution level is decoded from the JPEG2000 once, with kdu_expand -reduce, then cut into tiles one band (row of
+tiles) at a time, so only one band of an 8 bit greyscale or RGB image is held in memory (other images are held a
+level at a time). The tiles in a band are jpg encoded in parallel: Pillow releases
+the GIL while encoding, so threads use all the cores.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image
+
+from image_processing import iiif, jp2
+from image_processing.exceptions import ImageProcessingError
+
+DEFAULT_JPG_QUALITY = 90
+INFO_FILENAME = 'info.json'
+
+_PNM_MODES = {1: ('L', '.pgm'), 3: ('RGB', '.ppm')}
+
+
+def generate_tile_pyramid(kakadu_instance, jp2_filepath, pyramid_folder, image_id, tile_size=None,
+                          jpg_quality=DEFAULT_JPG_QUALITY, icc_profile=None, workers=None, kakadu_timeout=None):
+    """
+    :param kakadu_instance: :class:`~image_processing.kakadu.Kakadu`
+    :param jp2_filepath:
+    :param pyramid_folder: the folder to write the tiles and info.json to. It's created if it doesn't exist
+    :param image_id: the URI the pyramid will be hosted at, for the info.json's @id
+    :param tile_size: the width and height of the tiles. Defaults to the jp2's tile size, which is cheapest to decode
+        if the pyramid is ever replaced by an image server
+    :param jpg_quality: between 0 and 95
+    :param icc_profile: embedded in each tile, e.g. the ICC profile of the source image
+    :param workers: the number of tiles to encode at the same time. Defaults to the number of cores
+    :param kakadu_timeout: seconds to allow kdu_expand for each resolution level
+    :return: the number of tiles written
+    """
+    log = logging.getLogger(__name__)
+    info = jp2.read_codestream_info(jp2_filepath)
+    if info.x_offset or info.y_offset:
+        raise ImageProcessingError('Tile pyramids can only be made from jp2 files without an image offset, unlike {0}'
+                                   .format(jp2_filepath))
+    tile_width, tile_height = (tile_size, tile_size) if tile_size else (info.tile_width, info.tile_height)
+    if not os.path.isdir(pyramid_folder):
+        os.makedirs(pyramid_folder)
+
+    sizes = []
+    tile_count = 0
+    scratch_folder = tempfile.mkdtemp(prefix='image-processing_pyramid_')
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        for reduce in range(info.levels + 1):
+            scale = 2 ** reduce
+            level_width = int(math.ceil(info.width / scale))
+            level_height = int(math.ceil(info.height / scale))
+            if level_width <= tile_width and level_height <= tile_height:
+                # viewers ask for the whole image by its size, so only small sizes are listed
+                sizes.append((level_width, level_height))
+
+            mode, extension = _PNM_MODES.get(info.components, (None, '.tif')) \
+                if set(info.bit_depths) == {8} else (None, '.tif')
+            decoded_filepath = os.path.join(scratch_folder, 'level{0}{1}'.format(reduce, extension))
+            kakadu_instance.kdu_expand(jp2_filepath, decoded_filepath, kakadu_options=['-reduce', str(reduce)],
+                                       timeout=kakadu_timeout)
+            with _BandReader(decoded_filepath, pnm_mode=mode) as band_reader:
+                if band_reader.size != (level_width, level_height):
+                    raise ImageProcessingError('Level {0} of {1} decoded to {2}, not {3}'.format(
+                        reduce, jp2_filepath, band_reader.size, (level_width, level_height)))
+                for band_top in range(0, level_height, tile_height):
+                    band = band_reader.read(band_top, min(tile_height, level_height - band_top))
+                    tiles = []
+                    for tile_left in range(0, level_width, tile_width):
+                        width = min(tile_width, level_width - tile_left)
+                        region = '{0},{1},{2},{3}'.format(
+                            tile_left * scale, band_top * scale,
+                            min(tile_width * scale, info.width - tile_left * scale),
+                            min(tile_height * scale, info.height - band_top * scale))
+                        tile_filepath = _image_filepath(pyramid_folder, region, width)
+                        tiles.append((band, (tile_left, 0, tile_left + width, band.size[1]), tile_filepath))
+                    pool.map(lambda tile: _save_tile(tile[0], tile[1], tile[2], jpg_quality, icc_profile), tiles)
+                    tile_count += len(tiles)
+            os.remove(decoded_filepath)
+
+            if (level_width, level_height) in sizes:
+                # the single tile is the whole image at this size
+                shutil.copyfile(tiles[0][2], _image_filepath(pyramid_folder, 'full', level_width))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(scratch_folder, ignore_errors=True)
+
+    image_info = iiif.info_json(image_id, info.width, info.height, tile_width, tile_height, info.levels,
+                                compliance_level=0, sizes=sizes)
+    with open(os.path.join(pyramid_folder, INFO_FILENAME), 'w') as info_file:
+        json.dump(image_info, info_file, indent=2)
+    log.debug('Tile pyramid of {0} tiles generated in {1}'.format(tile_count, pyramid_folder))
+    return tile_count
+
+
+def _image_filepath(pyramid_folder, region, width):
+    folder = os.path.join(pyramid_folder, region, '{0},'.format(width), '0')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return os.path.join(folder, 'default.jpg')
+
+
+def _save_tile(band, box, tile_filepath, jpg_quality, icc_profile):
+    tile = band.crop(box)
+    if tile.mode in ['1', 'LA']:
+        tile = tile.convert('L')
+    elif tile.mode not in ['RGB', 'L']:
+        tile = tile.convert('RGB')
+    save_options = {'quality': jpg_quality}
+    if icc_profile:
+        save_options['icc_profile'] = icc_profile
+    tile.save(tile_filepath, 'JPEG', **save_options)
+
+
+class _BandReader(object):
+    """
+    Reads bands of rows from a decoded image. Binary PGM and PPM files are read a band at a time; anything else is
+    loaded whole
+    """
+
+    def __init__(self, image_filepath, pnm_mode=None):
+        """
+        :param pnm_mode: the image's mode, if it's an 8 bit PGM or PPM file
+        """
+        self.image_filepath = image_filepath
+        self.pnm_mode = pnm_mode
+        self._file = None
+        self._image = None
+        self._data_offset = None
+        self.size = None
+
+    def __enter__(self):
+        if self.pnm_mode is None:
+            with Image.open(self.image_filepath) as image:
+                image.load()
+                self._image = image.copy()
+            self.size = self._image.size
+        else:
+            self._file = open(self.image_filepath, 'rb')
+            self.size, self._data_offset = _read_pnm_header(self._file)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            self._file.close()
+        self._image = None
+
+    def read(self, top, height):
+        """
+        :return: :class:`PIL.Image` of the rows from top to top + height
+        """
+        if self._image is not None:
+            return self._image.crop((0, top, self.size[0], top + height))
+        row_bytes = self.size[0] * len(self.pnm_mode)
+        self._file.seek(self._data_offset + top * row_bytes)
+        return Image.frombytes(self.pnm_mode, (self.size[0], height), self._file.read(row_bytes * height))
+
+
+def _read_pnm_header(pnm_file):
+    """
+    :return: ((width, height), offset of the pixel data) of an 8 bit binary PGM or PPM file
+    """
+    tokens = []
+    while len(tokens) < 4:
+        line = pnm_file.readline()
+        if not line:
+            raise ImageProcessingError('Truncated PNM header in {0}'.format(pnm_file.name))
+        tokens += line.split(b'#')[0].split()
+    if tokens[0] not in [b'P5', b'P6'] or int(tokens[3]) != 255 or len(tokens) > 4:
+        raise ImageProcessingError('Unsupported PNM header {0} in {1}'.format(tokens, pnm_file.name))
+    return (int(tokens[1]), int(tokens[2])), pnm_file.tell()
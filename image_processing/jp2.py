@@ -0,0 +1,489 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import binascii
+import os
+import shutil
+import struct
+import tempfile
+from collections import namedtuple
+
+from image_processing.exceptions import ImageProcessingError
+
+CODESTREAM_BOX_TYPE = b'jp2c'
+HEADER_BOX_TYPE = b'jp2h'
+UUID_BOX_TYPE = b'uuid'
+XML_BOX_TYPE = b'xml '
+UUID_INFO_BOX_TYPE = b'uinf'
+METADATA_BOX_TYPES = [UUID_BOX_TYPE, XML_BOX_TYPE, UUID_INFO_BOX_TYPE]
+"""Top level boxes which hold metadata rather than the image: uuid (e.g. XMP, IPTC or GeoJP2), xml and uuid info"""
+XMP_UUID = binascii.unhexlify('BE7ACFCB97A942E89C71999491E3AFAC')
+
+XMP_PADDING = (b' ' * 100 + b'\n') * 24
+"""The whitespace exiftool adds to the end of an XMP packet it writes, so it can be edited in place"""
+XMP_RESERVED_BOX_LENGTH = 64 * 1024
+"""The size of the XMP box reserved in new jp2 files by :func:`reserved_xmp_box`"""
+_EMPTY_XMP_PACKET = (b'<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+                     b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>\n<?xpacket end="w"?>')
+_XPACKET_END = b'<?xpacket end'
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+_SOC_MARKER = b'\xff\x4f'
+_SIZ_MARKER = 0xff51
+_COD_MARKER = 0xff52
+_COM_MARKER = 0xff64
+_SOT_MARKER = 0xff90
+
+PROGRESSION_ORDERS = ['LRCP', 'RLCP', 'RPCL', 'PCRL', 'CPRL']
+
+CodestreamInfo = namedtuple('CodestreamInfo', [
+    'width', 'height', 'x_offset', 'y_offset', 'tile_width', 'tile_height', 'tile_x_offset', 'tile_y_offset',
+    'components', 'bit_depths', 'progression_order', 'layers', 'levels', 'code_block_size', 'precinct_sizes',
+    'reversible', 'sop_markers', 'eph_markers'])
+"""
+Coding parameters read from the main header of a JPEG2000 codestream.
+Sizes are (height, width) pairs, in the same order as kakadu's command line options, e.g. Cblk={64,64}.
+precinct_sizes is listed from the highest resolution level down, as in Cprecincts, or is None if the default
+(maximal) precincts were used.
+sop_markers and eph_markers say whether the packets have SOP and EPH markers, as with Cuse_sop=yes and Cuse_eph=yes.
+"""
+
+
+def iter_boxes(file_obj, start=0, end=None):
+    """
+    Iterate over the JP2 boxes between start and end of the file, without reading their contents
+
+    :param file_obj: binary file object, opened for reading
+    :param start: offset of the first box
+    :param end: offset the boxes finish at, or None for the end of the file
+    :return: generator of (box type, box offset, header length, box length) tuples
+    """
+    if end is None:
+        file_obj.seek(0, 2)
+        end = file_obj.tell()
+    offset = start
+    while offset < end:
+        file_obj.seek(offset)
+        header = file_obj.read(8)
+        if len(header) < 8:
+            raise ImageProcessingError("Truncated JP2 box header at offset {0}".format(offset))
+        box_length, box_type = struct.unpack('>I4s', header)
+        header_length = 8
+        if box_length == 1:
+            box_length = struct.unpack('>Q', file_obj.read(8))[0]
+            header_length = 16
+        elif box_length == 0:
+            # the last box can run to the end of the file
+            box_length = end - offset
+        if box_length < header_length:
+            raise ImageProcessingError("Invalid JP2 box length {0} at offset {1}".format(box_length, offset))
+        yield box_type, offset, header_length, box_length
+        offset += box_length
+
+
+def read_codestream_info(jp2_filepath):
+    """
+    Read the image and coding parameters from the SIZ and COD markers in the main header of the codestream.
+    Only the header is read, so this is cheap even for very large files.
+
+    :param jp2_filepath: a JP2 file, or a raw JPEG2000 codestream
+    :return: :class:`CodestreamInfo`
+    """
+    siz = cod = None
+    with open(jp2_filepath, 'rb') as f:
+        for marker, segment in _iter_main_header(f, jp2_filepath):
+            if marker == _SIZ_MARKER:
+                siz = segment
+            elif marker == _COD_MARKER:
+                cod = segment
+            if siz is not None and cod is not None:
+                break
+    if siz is None or cod is None:
+        raise ImageProcessingError("Missing SIZ or COD marker in {0}".format(jp2_filepath))
+    return _parse_siz_and_cod(siz, cod)
+
+
+def read_codestream_comments(jp2_filepath):
+    """
+    Read the text of the COM markers in the main header of the codestream, e.g. the kakadu version and anything
+    written with kdu_compress -com
+
+    :param jp2_filepath: a JP2 file, or a raw JPEG2000 codestream
+    :return: list of comments, in the order they appear
+    """
+    comments = []
+    with open(jp2_filepath, 'rb') as f:
+        for marker, segment in _iter_main_header(f, jp2_filepath):
+            # the first two bytes say whether the comment is binary (0) or Latin-1 text (1)
+            if marker == _COM_MARKER and struct.unpack('>H', segment[:2])[0] == 1:
+                comments.append(segment[2:].decode('latin-1'))
+    return comments
+
+
+def write_codestream_comment(jp2_filepath, comment, replace_prefix=None):
+    """
+    Add a text comment to the end of the main header of the codestream, as kdu_compress -com does.
+    The rest of the codestream has to move, so the file is rewritten.
+
+    :param jp2_filepath: a JP2 file, or a raw JPEG2000 codestream
+    :param comment: text which can be encoded as Latin-1
+    :param replace_prefix: if given, the existing comments starting with this are removed, e.g. an outdated recipe
+    """
+    text = comment.encode('latin-1')
+    new_segment = struct.pack('>HHH', _COM_MARKER, len(text) + 4, 1) + text
+    with open(jp2_filepath, 'rb') as f:
+        pieces = []
+        position = 0
+        for marker, segment in _iter_main_header(f, jp2_filepath):
+            if replace_prefix is not None and marker == _COM_MARKER and struct.unpack('>H', segment[:2])[0] == 1 \
+                    and segment[2:].decode('latin-1').startswith(replace_prefix):
+                segment_offset = f.tell() - len(segment) - 4
+                pieces.append((position, segment_offset - position))
+                position = f.tell()
+        # the main header ends at the first SOT marker, which has just been read
+        header_end = f.tell() - 4
+        f.seek(0, 2)
+        file_length = f.tell()
+        pieces += [(position, header_end - position), new_segment, (header_end, file_length - header_end)]
+        length_change = sum(len(piece) if isinstance(piece, bytes) else piece[1] for piece in pieces) - file_length
+
+        codestream_box = None
+        f.seek(0)
+        if f.read(2) != _SOC_MARKER:
+            for box_type, offset, header_length, _ in iter_boxes(f):
+                if box_type == CODESTREAM_BOX_TYPE:
+                    codestream_box = (offset, header_length)
+                    break
+        _rewrite_file(f, jp2_filepath, pieces)
+
+    if codestream_box is not None:
+        offset, header_length = codestream_box
+        with open(jp2_filepath, 'r+b') as f:
+            if header_length == 16:
+                f.seek(offset + 8)
+                box_length = struct.unpack('>Q', f.read(8))[0]
+                f.seek(offset + 8)
+                f.write(struct.pack('>Q', box_length + length_change))
+            else:
+                f.seek(offset)
+                box_length = struct.unpack('>I', f.read(4))[0]
+                # a box length of 0 runs to the end of the file, so doesn't change
+                if box_length != 0:
+                    f.seek(offset)
+                    f.write(struct.pack('>I', box_length + length_change))
+
+
+def _iter_main_header(f, jp2_filepath):
+    """
+    :param f: binary file object of a JP2 file or raw codestream, opened for reading
+    :return: generator of (marker, segment) of the marker segments in the main header of the codestream
+    """
+    if f.read(2) == _SOC_MARKER:
+        codestream_offset = 0
+    else:
+        codestream_offset = None
+        for box_type, offset, header_length, _ in iter_boxes(f):
+            if box_type == CODESTREAM_BOX_TYPE:
+                codestream_offset = offset + header_length
+                break
+        if codestream_offset is None:
+            raise ImageProcessingError("No codestream box found in {0}".format(jp2_filepath))
+    f.seek(codestream_offset)
+    if f.read(2) != _SOC_MARKER:
+        raise ImageProcessingError("Codestream in {0} does not start with an SOC marker".format(jp2_filepath))
+    while True:
+        marker_header = f.read(4)
+        if len(marker_header) < 4:
+            raise ImageProcessingError("Truncated codestream header in {0}".format(jp2_filepath))
+        marker, length = struct.unpack('>HH', marker_header)
+        if marker == _SOT_MARKER:
+            return
+        yield marker, f.read(length - 2)
+
+
+def _parse_siz_and_cod(siz, cod):
+    (_, x_size, y_size, x_offset, y_offset, tile_width, tile_height,
+     tile_x_offset, tile_y_offset, components) = struct.unpack('>HIIIIIIIIH', siz[:36])
+    bit_depths = [(struct.unpack('>B', siz[36 + 3 * i:37 + 3 * i])[0] & 0x7f) + 1 for i in range(components)]
+
+    coding_style, progression_order, layers, _, levels, xcb, ycb, _, transform = \
+        struct.unpack('>BBHBBBBBB', cod[:10])
+    precinct_sizes = None
+    if coding_style & 0x01:
+        # one byte per resolution level, lowest resolution first. Kakadu lists them highest resolution first
+        precinct_bytes = struct.unpack('>{0}B'.format(levels + 1), cod[10:11 + levels])
+        precinct_sizes = [(2 ** (b >> 4), 2 ** (b & 0x0f)) for b in reversed(precinct_bytes)]
+
+    return CodestreamInfo(
+        width=x_size - x_offset, height=y_size - y_offset, x_offset=x_offset, y_offset=y_offset,
+        tile_width=tile_width, tile_height=tile_height, tile_x_offset=tile_x_offset, tile_y_offset=tile_y_offset,
+        components=components, bit_depths=bit_depths,
+        progression_order=PROGRESSION_ORDERS[progression_order] if progression_order < len(PROGRESSION_ORDERS)
+        else str(progression_order),
+        layers=layers, levels=levels, code_block_size=(2 ** (ycb + 2), 2 ** (xcb + 2)),
+        precinct_sizes=precinct_sizes, reversible=transform == 1, sop_markers=bool(coding_style & 0x02),
+        eph_markers=bool(coding_style & 0x04))
+
+
+def count_tiles(info):
+    """
+    :param info: :class:`CodestreamInfo`
+    :return: the number of tiles in the codestream
+    """
+    return len(_tile_columns(info, 'x')) * len(_tile_columns(info, 'y'))
+
+
+def count_code_blocks(info):
+    """
+    The number of code-blocks the image is coded in, from the tile, precinct and code-block partitions.
+    Components are assumed not to be subsampled, as is the case for jp2 files created from TIFFs.
+
+    :param info: :class:`CodestreamInfo`
+    :return: the number of code-blocks in the codestream, across all tiles, components and resolutions
+    """
+    code_blocks = 0
+    for x0, x1 in _tile_columns(info, 'x'):
+        for y0, y1 in _tile_columns(info, 'y'):
+            for resolution in range(info.levels + 1):
+                # precinct sizes are listed highest resolution first
+                precinct_height, precinct_width = info.precinct_sizes[info.levels - resolution] \
+                    if info.precinct_sizes else (2 ** 15, 2 ** 15)
+                # code-blocks can't cross precinct boundaries, and subband precincts are half the resolution's size
+                divisor = 1 if resolution == 0 else 2
+                block_width = min(info.code_block_size[1], precinct_width // divisor)
+                block_height = min(info.code_block_size[0], precinct_height // divisor)
+                if resolution == 0:
+                    subbands = [(0, 0, info.levels)]
+                else:
+                    level = info.levels - resolution + 1
+                    subbands = [(1, 0, level), (0, 1, level), (1, 1, level)]
+                for x_band_offset, y_band_offset, level in subbands:
+                    columns = _partitions(_subband_bound(x0, x_band_offset, level),
+                                          _subband_bound(x1, x_band_offset, level), block_width)
+                    rows = _partitions(_subband_bound(y0, y_band_offset, level),
+                                       _subband_bound(y1, y_band_offset, level), block_height)
+                    code_blocks += columns * rows
+    return code_blocks * info.components
+
+
+def _tile_columns(info, axis):
+    """
+    :return: list of the (start, end) coordinates of each tile along the axis, on the reference grid
+    """
+    if axis == 'x':
+        image_start, image_end = info.x_offset, info.x_offset + info.width
+        tile_start, tile_size = info.tile_x_offset, info.tile_width
+    else:
+        image_start, image_end = info.y_offset, info.y_offset + info.height
+        tile_start, tile_size = info.tile_y_offset, info.tile_height
+    tiles = []
+    for index in range((image_end - tile_start + tile_size - 1) // tile_size):
+        start = max(tile_start + index * tile_size, image_start)
+        end = min(tile_start + (index + 1) * tile_size, image_end)
+        if end > start:
+            tiles.append((start, end))
+    return tiles
+
+
+def _subband_bound(coordinate, band_offset, level):
+    # ceil((coordinate - 2^(level - 1) * band_offset) / 2^level), from equation B-15 of the standard
+    return -(-(coordinate - (2 ** (level - 1) if level else 0) * band_offset) // 2 ** level)
+
+
+def _partitions(start, end, size):
+    """
+    :return: the number of cells of a partition anchored at 0 with the given size which overlap [start, end)
+    """
+    if end <= start:
+        return 0
+    return -(-end // size) - start // size
+
+
+def _find_xmp_box(file_obj):
+    """
+    :return: (offset, box length) of the first XMP uuid box, and the offset just after the jp2h box
+    """
+    xmp_box = None
+    header_end = None
+    for box_type, offset, header_length, box_length in iter_boxes(file_obj):
+        if box_type == HEADER_BOX_TYPE:
+            header_end = offset + box_length
+        elif box_type == UUID_BOX_TYPE and xmp_box is None:
+            file_obj.seek(offset + header_length)
+            if file_obj.read(len(XMP_UUID)) == XMP_UUID:
+                xmp_box = (offset, header_length, box_length)
+        elif box_type == CODESTREAM_BOX_TYPE:
+            # the metadata we're interested in is always before the codestream, so don't read past it
+            break
+    return xmp_box, header_end
+
+
+def read_xmp(jp2_filepath):
+    """
+    :param jp2_filepath:
+    :return: the XMP packet in the file's XMP uuid box, as bytes, or None if there isn't one
+    """
+    with open(jp2_filepath, 'rb') as f:
+        xmp_box, _ = _find_xmp_box(f)
+        if xmp_box is None:
+            return None
+        offset, header_length, box_length = xmp_box
+        f.seek(offset + header_length + len(XMP_UUID))
+        return f.read(box_length - header_length - len(XMP_UUID))
+
+
+def pad_xmp_packet(xmp_packet, padding=XMP_PADDING):
+    """
+    Replace the whitespace padding at the end of an XMP packet
+
+    :param xmp_packet: bytes, including the xpacket processing instructions
+    :param padding: whitespace to put before the xpacket end instruction.
+        Defaults to the padding exiftool writes
+    :return: the padded packet
+    """
+    end_index = xmp_packet.rfind(_XPACKET_END)
+    if end_index == -1:
+        raise ImageProcessingError("XMP packet does not have an xpacket end processing instruction")
+    content = xmp_packet[:end_index].rstrip(b' \t\r\n')
+    return content + b'\n' + padding + xmp_packet[end_index:]
+
+
+def _xmp_box(xmp_packet):
+    return struct.pack('>I4s', 8 + len(XMP_UUID) + len(xmp_packet), UUID_BOX_TYPE) + XMP_UUID + xmp_packet
+
+
+def _padding(length):
+    """
+    :return: the first length bytes of :const:`XMP_PADDING` repeated
+    """
+    return (XMP_PADDING * (length // len(XMP_PADDING) + 1))[:length]
+
+
+def reserved_xmp_box(box_length=XMP_RESERVED_BOX_LENGTH):
+    """
+    An XMP uuid box holding an empty packet, padded to reserve room for the XMP that's written into the file later.
+    Pass it to kdu_compress with -jp2_box, and :func:`write_xmp` writes into it in place rather than copying the file.
+
+    :param box_length: the length of the whole box
+    :return: bytes of the box, including its header
+    """
+    padding_length = box_length - len(_xmp_box(pad_xmp_packet(_EMPTY_XMP_PACKET, b'')))
+    if padding_length < 0:
+        raise ValueError("An XMP box can't be shorter than {0} bytes".format(box_length - padding_length))
+    return _xmp_box(pad_xmp_packet(_EMPTY_XMP_PACKET, _padding(padding_length)))
+
+
+def write_xmp(jp2_filepath, xmp_packet, keep_box_size=True):
+    """
+    Write an XMP packet into a JP2 file, replacing its XMP uuid box or adding one after the jp2h box, as exiftool does.
+    The packet is padded the same way as exiftool pads it.
+
+    If the file already has an XMP box and the new one is the same size, or keep_box_size is set and the
+    packet fits into the existing box by changing its padding (e.g. a box from :func:`reserved_xmp_box`), only the box
+    is overwritten. Otherwise the rest of the file has to be moved, so it's written to a new file which replaces the
+    original.
+
+    :param jp2_filepath:
+    :param xmp_packet: bytes of the complete XMP packet, including the xpacket processing instructions
+    :param keep_box_size: if the padded packet isn't the same size as the existing box, adjust the padding so it is,
+        to avoid rewriting the file
+    """
+    padded_packet = pad_xmp_packet(xmp_packet)
+    new_box = _xmp_box(padded_packet)
+    with open(jp2_filepath, 'r+b') as f:
+        xmp_box, header_end = _find_xmp_box(f)
+        if xmp_box is not None:
+            offset, header_length, box_length = xmp_box
+            if len(new_box) != box_length and keep_box_size and header_length == 8:
+                padding_length = len(XMP_PADDING) + box_length - len(new_box)
+                if padding_length >= 0:
+                    new_box = _xmp_box(pad_xmp_packet(xmp_packet, _padding(padding_length)))
+            if len(new_box) == box_length:
+                f.seek(offset)
+                f.write(new_box)
+                return
+            insert_offset, skip_length = offset, box_length
+        elif header_end is not None:
+            insert_offset, skip_length = header_end, 0
+        else:
+            raise ImageProcessingError("No jp2h box found in {0}".format(jp2_filepath))
+
+        f.seek(0, 2)
+        file_length = f.tell()
+        _rewrite_file(f, jp2_filepath, [(0, insert_offset), new_box,
+                                        (insert_offset + skip_length, file_length - insert_offset - skip_length)])
+
+
+def read_metadata_boxes(jp2_filepath):
+    """
+    :param jp2_filepath:
+    :return: list of the top level metadata boxes in the file, including their headers, in the order they appear
+    """
+    boxes = []
+    with open(jp2_filepath, 'rb') as f:
+        for box_type, offset, header_length, box_length in iter_boxes(f):
+            if box_type in METADATA_BOX_TYPES:
+                f.seek(offset)
+                box = f.read(box_length)
+                if struct.unpack('>I', box[:4])[0] == 0:
+                    # it ran to the end of the file, which it won't when it's written elsewhere
+                    box = struct.pack('>I', box_length) + box[4:]
+                boxes.append(box)
+    return boxes
+
+
+def write_metadata_boxes(jp2_filepath, boxes):
+    """
+    Replace the top level metadata boxes in a JP2 file, e.g. with the boxes from another file read by
+    :func:`read_metadata_boxes`. They're written after the jp2h box, as exiftool writes XMP.
+
+    :param jp2_filepath:
+    :param boxes: list of complete boxes, including their headers
+    """
+    header_found = False
+    with open(jp2_filepath, 'rb') as f:
+        pieces = []
+        for box_type, offset, _, box_length in iter_boxes(f):
+            if box_type not in METADATA_BOX_TYPES:
+                pieces.append((offset, box_length))
+            if box_type == HEADER_BOX_TYPE:
+                pieces += boxes
+                header_found = True
+        if not header_found:
+            raise ImageProcessingError("No jp2h box found in {0}".format(jp2_filepath))
+        _rewrite_file(f, jp2_filepath, pieces)
+
+
+def _rewrite_file(f, filepath, pieces):
+    """
+    Write a new version of a file, and replace the original with it
+
+    :param f: the original file, opened for reading
+    :param pieces: list of what to write: either bytes, or (offset, length) of a part of the original file to copy
+    """
+    output_fd, output_filepath = tempfile.mkstemp(prefix='.image-processing_', suffix='.jp2',
+                                                  dir=os.path.dirname(os.path.abspath(filepath)))
+    try:
+        with os.fdopen(output_fd, 'wb') as output_file:
+            for piece in pieces:
+                if isinstance(piece, bytes):
+                    output_file.write(piece)
+                else:
+                    offset, length = piece
+                    f.seek(offset)
+                    _copy_bytes(f, output_file, length)
+        shutil.copymode(filepath, output_filepath)
+        os.rename(output_filepath, filepath)
+    except Exception:
+        os.remove(output_filepath)
+        raise
+
+
+def _copy_bytes(input_file, output_file, length):
+    while length > 0:
+        data = input_file.read(min(length, _COPY_BUFFER_SIZE))
+        if not data:
+            raise ImageProcessingError("Unexpected end of file while copying JP2 boxes")
+        output_file.write(data)
+        length -= len(data)
@@ -2,11 +2,16 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import json
+import math
 import os
+import re
 import subprocess
 import logging
+import time
+from collections import namedtuple
 from image_processing.exceptions import KakaduError
-from image_processing import utils
+from image_processing import utils, jp2
 
 DEFAULT_COMPRESS_OPTIONS = [
     'Clevels=6',
@@ -33,20 +38,255 @@ DEFAULT_LOSSLESS_COMPRESS_OPTIONS = DEFAULT_COMPRESS_OPTIONS + LOSSLESS_OPTIONS
 LOSSY_OPTIONS = ["-rate", '3']
 """:func:`~image_processing.kakadu.Kakadu.kdu_compress` command line options which make the compression lossy"""
 
+DEFAULT_LOSSY_COMPRESS_OPTIONS = DEFAULT_COMPRESS_OPTIONS + LOSSY_OPTIONS
+"""Default lossy command line options for :func:`~image_processing.kakadu.Kakadu.kdu_compress`"""
+
 ALPHA_OPTION = '-jp2_alpha'
 """:func:`~image_processing.kakadu.Kakadu.kdu_compress` command line option for images with alpha channels"""
 
+BOX_OPTION = '-jp2_box'
+""":func:`~image_processing.kakadu.Kakadu.kdu_compress` command line option naming files of complete boxes to write
+into the jp2"""
+
+MIN_LOWEST_RESOLUTION_SIZE = 16
+"""The default policy doesn't use so many resolution levels that the lowest resolution is smaller than this"""
+
+LARGE_IMAGE_PIXELS = 100 * 1000 * 1000
+"""Images with more pixels than this get :const:`LARGE_IMAGE_TILES` from the default policy"""
+
+LARGE_IMAGE_TILES = '{1024,1024}'
+"""Bigger tiles mean fewer tile headers and less per-tile overhead, which adds up on very large rasters"""
+
+MAX_LEVELS = 32
+
+RECIPE_COMMENT_PREFIX = 'image-processing recipe: '
+
+ImageProbe = namedtuple('ImageProbe', ['width', 'height', 'mode', 'bit_depth', 'components'])
+"""What a compress options policy knows about an image: its size, PIL mode, bits per sample and number of bands"""
+
+_MODE_BIT_DEPTHS = {'1': 1, 'I;16': 16, 'I;16B': 16, 'I;16L': 16, 'I': 32, 'F': 32}
+
+STATS_OPTIONS = ['-stats', '-cpu', '0']
+"""Command line options which make kakadu report what it did, for :func:`parse_stats`"""
+
+KakaduStats = namedtuple('KakaduStats', [
+    'command', 'wall_seconds', 'cpu_seconds', 'threads', 'layer_bitrates', 'layer_thresholds', 'codestream_bytes',
+    'bits_per_pixel', 'tile_count', 'tile_part_count', 'code_block_count', 'warnings', 'output'])
+"""
+What a kakadu command did, returned by the :class:`Kakadu` methods when they're called with collect_stats=True.
+Any value kakadu didn't report is None. wall_seconds is measured here, cpu_seconds is kakadu's own end-to-end CPU
+time. The tile and code-block counts are read from the jp2's codestream header, and warnings is a list of the text of
+each warning kakadu printed
+"""
+
+_TILE_PARTS_PATTERN = re.compile(r'Generated ([\d,]+) tile-part\(s\) for a total of ([\d,]+) tile\(s\)')
+_CODESTREAM_BYTES_PATTERN = re.compile(r'Code-stream bytes[^=]*=\s*([\d,]+)(?:\s*=\s*([\d.]+) bits/pel)?')
+_CPU_TIME_PATTERNS = [re.compile(r'End-to-end CPU time[^=]*=\s*([\d.]+)'),
+                      re.compile(r'CPU time[^=]*=\s*([\d.]+)')]
+_THREADS_PATTERN = re.compile(r'(\d+) parallel threads')
+_WARNING_PATTERN = re.compile(r'^Kakadu (?:Core )?Warning:\s*$')
+_NUMBER_PATTERN = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+
+def replace_option(kakadu_options, option_name, value):
+    """
+    Get a copy of the kakadu command line options with one option changed, added or removed.
+
+    :param kakadu_options: command line options, e.g. :const:`DEFAULT_COMPRESS_OPTIONS`
+    :param option_name: either a parameter name, like 'Stiles', or a switch which takes a value, like '-flush_period'
+    :param value: the new value, or None to remove the option
+    :return: the new list of options
+    """
+    new_options = list(kakadu_options)
+    if option_name.startswith('-'):
+        if option_name in new_options:
+            index = new_options.index(option_name)
+            del new_options[index:index + 2]
+        else:
+            index = len(new_options)
+        if value is not None:
+            new_options[index:index] = [option_name, str(value)]
+    else:
+        prefix = option_name + '='
+        indexes = [i for i, option in enumerate(new_options) if option.startswith(prefix)]
+        index = indexes[0] if indexes else len(new_options)
+        new_options = [option for option in new_options if not option.startswith(prefix)]
+        if value is not None:
+            new_options.insert(index, prefix + str(value))
+    return new_options
+
+
+def get_option(kakadu_options, option_name):
+    """
+    :param kakadu_options: command line options
+    :param option_name: either a parameter name, like 'Clevels', or a switch which takes a value, like '-rate'
+    :return: the option's value as a string, or None if it isn't set
+    """
+    if option_name.startswith('-'):
+        if option_name in kakadu_options[:-1]:
+            return kakadu_options[kakadu_options.index(option_name) + 1]
+        return None
+    prefix = option_name + '='
+    values = [option[len(prefix):] for option in kakadu_options if option.startswith(prefix)]
+    return values[-1] if values else None
+
+
+def probe_image(image_pil):
+    """
+    :param image_pil: :class:`PIL.Image` instance. Only its header is read
+    :return: :class:`ImageProbe`
+    """
+    return ImageProbe(width=image_pil.size[0], height=image_pil.size[1], mode=image_pil.mode,
+                      bit_depth=_MODE_BIT_DEPTHS.get(image_pil.mode, 8), components=len(image_pil.getbands()))
+
+
+def default_compress_options_policy(kakadu_options, probe):
+    """
+    Adapt the compress options to the image:
+
+    - the number of resolution levels is lowered for small images, so the lowest resolution isn't smaller than
+      :const:`MIN_LOWEST_RESOLUTION_SIZE`, and raised for very large ones, so the lowest resolution fits in a tile and
+      viewers can show an overview of the whole image from one tile
+    - images with more than :const:`LARGE_IMAGE_PIXELS` pixels get :const:`LARGE_IMAGE_TILES`
+
+    Options for typical page scans are left as they are.
+
+    :param kakadu_options: the generator's kakadu_compress_options
+    :param probe: :class:`ImageProbe`
+    :return: the options for this image
+    """
+    if probe.width * probe.height > LARGE_IMAGE_PIXELS and get_option(kakadu_options, 'Stiles') is not None:
+        kakadu_options = replace_option(kakadu_options, 'Stiles', LARGE_IMAGE_TILES)
+
+    levels = get_option(kakadu_options, 'Clevels')
+    # kakadu's default
+    levels = int(levels) if levels is not None else 5
+    longest_side = max(probe.width, probe.height)
+    tiles = get_option(kakadu_options, 'Stiles')
+    tile_size = max(int(size) for size in tiles.strip('{}').split(',')) if tiles else longest_side
+    new_levels = levels
+    while new_levels < MAX_LEVELS and math.ceil(longest_side / 2 ** new_levels) > tile_size:
+        new_levels += 1
+    while new_levels > 0 and math.ceil(longest_side / 2 ** new_levels) < MIN_LOWEST_RESOLUTION_SIZE:
+        new_levels -= 1
+    if new_levels != levels:
+        kakadu_options = replace_option(kakadu_options, 'Clevels', new_levels)
+    return kakadu_options
+
+
+def recipe_comment(kakadu_options):
+    """
+    :param kakadu_options: the options an image is compressed with
+    :return: the text of the codestream comment recording them, to be read with :func:`read_recipe`
+    """
+    return RECIPE_COMMENT_PREFIX + json.dumps(list(kakadu_options))
+
+
+def recipe_comment_options(kakadu_options):
+    """
+    :param kakadu_options: the options an image is compressed with
+    :return: kdu_compress options which record them in a comment in the codestream, to be read with
+        :func:`read_recipe`
+    """
+    return ['-com', recipe_comment(kakadu_options)]
+
+
+def read_recipe(jp2_filepath):
+    """
+    :return: the list of options a JPEG2000 file was compressed with, as recorded by :func:`recipe_comment_options`,
+        or None if they weren't recorded
+    """
+    for comment in jp2.read_codestream_comments(jp2_filepath):
+        if comment.startswith(RECIPE_COMMENT_PREFIX):
+            return json.loads(comment[len(RECIPE_COMMENT_PREFIX):])
+    return None
+
+
+def region_options(left, top, width, height, image_width, image_height):
+    """
+    :func:`~image_processing.kakadu.Kakadu.kdu_expand` command line options to only decode a region of the image.
+    Kakadu takes the region as fractions of the image size, so the pixel coordinates are nudged a quarter of a pixel
+    inwards to make sure they round to the same pixels.
+
+    :param left: pixel coordinates of the region in the full resolution image
+    :param top:
+    :param width:
+    :param height:
+    :param image_width: size of the full resolution image
+    :param image_height:
+    """
+    return ['-region', '{{{0:.10f},{1:.10f}}},{{{2:.10f},{3:.10f}}}'.format(
+        (top + 0.25) / image_height, (left + 0.25) / image_width,
+        (height - 0.25) / image_height, (width - 0.25) / image_width)]
+
+
+def parse_stats(command, output, wall_seconds=None):
+    """
+    Parse the statistics printed by a kakadu command run with :const:`STATS_OPTIONS`.
+    Kakadu's output isn't a stable format, so anything which isn't recognised is left as None rather than raising an
+    error.
+
+    :param command: e.g. 'kdu_compress'
+    :param output: everything the command printed to stdout and stderr
+    :param wall_seconds: how long the command took
+    :return: :class:`KakaduStats`, without the tile and code-block counts from the codestream header
+    """
+    lines = output.splitlines()
+    values = {'layer_bitrates': None, 'layer_thresholds': None, 'cpu_seconds': None}
+
+    tile_parts_match = _TILE_PARTS_PATTERN.search(output)
+    codestream_bytes_match = _CODESTREAM_BYTES_PATTERN.search(output)
+    threads_match = _THREADS_PATTERN.search(output)
+    for pattern in _CPU_TIME_PATTERNS:
+        cpu_time_match = pattern.search(output)
+        if cpu_time_match:
+            values['cpu_seconds'] = float(cpu_time_match.group(1))
+            break
+
+    warnings = []
+    index = 0
+    while index < len(lines):
+        line = lines[index].strip()
+        if line.startswith('Layer bit-rates') or line.startswith('Layer thresholds'):
+            # the values are on the following lines, e.g. "0.0365, 0.0729, 0.145"
+            numbers = []
+            while index + 1 < len(lines) and _NUMBER_PATTERN.match(lines[index + 1].strip()):
+                index += 1
+                numbers += [float(number) for number in _NUMBER_PATTERN.findall(lines[index])]
+            values['layer_bitrates' if line.startswith('Layer bit-rates') else 'layer_thresholds'] = numbers
+        elif _WARNING_PATTERN.match(line):
+            # the warning's text runs on until a blank line
+            warning_lines = []
+            while index + 1 < len(lines) and lines[index + 1].strip():
+                index += 1
+                warning_lines.append(lines[index].strip())
+            warnings.append(' '.join(warning_lines))
+        index += 1
+
+    return KakaduStats(
+        command=command, wall_seconds=wall_seconds, cpu_seconds=values['cpu_seconds'],
+        threads=int(threads_match.group(1)) if threads_match else None,
+        layer_bitrates=values['layer_bitrates'], layer_thresholds=values['layer_thresholds'],
+        codestream_bytes=int(codestream_bytes_match.group(1).replace(',', '')) if codestream_bytes_match else None,
+        bits_per_pixel=float(codestream_bytes_match.group(2))
+        if codestream_bytes_match and codestream_bytes_match.group(2) else None,
+        tile_count=int(tile_parts_match.group(2).replace(',', '')) if tile_parts_match else None,
+        tile_part_count=int(tile_parts_match.group(1).replace(',', '')) if tile_parts_match else None,
+        code_block_count=None, warnings=warnings, output=output)
+
 
 class Kakadu(object):
     """
     Python wrapper for jp2 compression and expansion functions in Kakadu (http://kakadusoftware.com/)
     """
 
-    def __init__(self, kakadu_base_path):
+    def __init__(self, kakadu_base_path, resource_limits=None):
         """
         :param kakadu_base_path: The location of the kdu_compress and kdu_expand executables
+        :param resource_limits: :class:`~image_processing.utils.ResourceLimits` for the child processes
         """
         self.kakadu_base_path = kakadu_base_path
+        self.resource_limits = resource_limits
         self.log = logging.getLogger(__name__)
         if not utils.cmd_is_executable(self._command_path('kdu_compress')):
             raise OSError("Could not find executable {0}. Check kakadu is installed and kdu_compress exists at the configured path"
@@ -59,7 +299,13 @@ class Kakadu(object):
     def _command_path(self, command):
         return os.path.join(self.kakadu_base_path, command)
 
-    def kdu_compress(self, input_filepaths, output_filepath, kakadu_options):
+    def get_version(self):
+        """
+        :return: the version information printed by kdu_compress -v. Cached for the life of the process
+        """
+        return utils.get_executable_version(self._command_path('kdu_compress'), ['-v'])
+
+    def kdu_compress(self, input_filepaths, output_filepath, kakadu_options, timeout=None, collect_stats=False):
         """
         Converts an image file supported by kakadu to jpeg2000
         Bitonal or greyscale image files are converted to a single channel jpeg2000 file
@@ -68,20 +314,45 @@ class Kakadu(object):
             If given three single channel files, Kakadu will combine them into a single 3 channel image
         :param output_filepath:
         :param kakadu_options: command line arguments
+        :param timeout: seconds to wait before killing the command and raising a
+            :class:`~image_processing.exceptions.CommandTimeoutError`. None waits as long as it takes
+        :param collect_stats: run with :const:`STATS_OPTIONS` and capture the output
+        :return: :class:`KakaduStats` if collect_stats is True, otherwise None
         """
-        self.run_command('kdu_compress', input_filepaths, output_filepath, kakadu_options)
+        return self.run_command('kdu_compress', input_filepaths, output_filepath, kakadu_options, timeout=timeout,
+                                collect_stats=collect_stats)
 
-    def kdu_expand(self, input_filepath, output_filepath, kakadu_options):
+    def kdu_expand(self, input_filepath, output_filepath, kakadu_options, timeout=None, collect_stats=False):
         """
         Converts a jpeg2000 file to tif
 
         :param input_filepath:
         :param output_filepath:
         :param kakadu_options: command line arguments
+        :param timeout: seconds to wait before killing the command and raising a
+            :class:`~image_processing.exceptions.CommandTimeoutError`. None waits as long as it takes
+        :param collect_stats: run with :const:`STATS_OPTIONS` and capture the output
+        :return: :class:`KakaduStats` if collect_stats is True, otherwise None
         """
-        self.run_command('kdu_expand', input_filepath, output_filepath, kakadu_options)
+        return self.run_command('kdu_expand', input_filepath, output_filepath, kakadu_options, timeout=timeout,
+                                collect_stats=collect_stats)
 
-    def run_command(self, command, input_files, output_file, kakadu_options):
+    def kdu_transcode(self, input_filepath, output_filepath, kakadu_options, timeout=None, collect_stats=False):
+        """
+        Rewrites a jpeg2000 file without decoding it, e.g. to discard quality layers or resolution levels
+
+        :param input_filepath:
+        :param output_filepath:
+        :param kakadu_options: command line arguments
+        :param timeout: seconds to wait before killing the command and raising a
+            :class:`~image_processing.exceptions.CommandTimeoutError`. None waits as long as it takes
+        :param collect_stats: run with :const:`STATS_OPTIONS` and capture the output
+        :return: :class:`KakaduStats` if collect_stats is True, otherwise None
+        """
+        return self.run_command('kdu_transcode', input_filepath, output_filepath, kakadu_options, timeout=timeout,
+                                collect_stats=collect_stats)
+
+    def run_command(self, command, input_files, output_file, kakadu_options, timeout=None, collect_stats=False):
         if not isinstance(input_files, list):
             input_files = [input_files]
 
@@ -96,11 +367,31 @@ class Kakadu(object):
         input_option = ",".join(["{0}".format(item) for item in input_files])
 
         command_options = [self._command_path(command), '-i', input_option, '-o', output_file] + kakadu_options
+        if collect_stats:
+            command_options += STATS_OPTIONS
 
         self.log.debug(' '.join(['"{0}"'.format(c) if ('{' in c or ' ' in c) else c for c in command_options]))
 
+        start_time = time.time()
         try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
+            output = utils.run_command(command_options, timeout=timeout, resource_limits=self.resource_limits,
+                                       capture_output=collect_stats)
         except subprocess.CalledProcessError as e:
-            raise KakaduError('Kakadu {0} failed on {1}. Command: {2}, Error: {3}'.
-                              format(command, input_option, ' '.join(command_options), e))
+            raise KakaduError('Kakadu {0} failed on {1}. Command: {2}, Error: {3}{4}'.
+                              format(command, input_option, ' '.join(command_options), e,
+                                     '. Output: {0}'.format(e.output) if e.output else ''))
+        if not collect_stats:
+            return None
+
+        stats = parse_stats(command, output, wall_seconds=time.time() - start_time)
+        # expanding reads the codestream, compressing and transcoding write it
+        jp2_filepath = input_files[0] if command == 'kdu_expand' else output_file
+        try:
+            info = jp2.read_codestream_info(jp2_filepath)
+        except Exception as e:
+            self.log.warning('Could not read the codestream header of {0}: {1!r}'.format(jp2_filepath, e))
+        else:
+            stats = stats._replace(tile_count=jp2.count_tiles(info), code_block_count=jp2.count_code_blocks(info))
+        for warning in stats.warnings:
+            self.log.warning('Kakadu {0} warned about {1}: {2}'.format(command, input_option, warning))
+        return stats
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import ctypes
+import ctypes.util
+import glob
+import os
+
+from image_processing.exceptions import ImageProcessingError
+
+# pixel format descriptors, from lcms2.h
+_PT_GRAY = 3
+_PT_RGB = 4
+_FLAGS_COPY_ALPHA = 0x04000000
+
+
+def _pixel_format(colour_space, channels, extra_channels=0, bytes_per_sample=2):
+    # COLORSPACE_SH(s) | EXTRA_SH(e) | CHANNELS_SH(c) | BYTES_SH(b)
+    return (colour_space << 16) | (extra_channels << 7) | (channels << 3) | bytes_per_sample
+
+
+FORMATS_16_BIT = {
+    'L': _pixel_format(_PT_GRAY, 1),
+    'RGB': _pixel_format(_PT_RGB, 3),
+    'RGBA': _pixel_format(_PT_RGB, 3, extra_channels=1),
+}
+"""LittleCMS pixel formats for 16 bit per channel images, in native byte order, by PIL colour mode"""
+
+_lcms2 = None
+
+
+def _find_library():
+    """
+    Use the system LittleCMS library if there is one, otherwise the one bundled with Pillow's wheels
+    """
+    library_path = ctypes.util.find_library('lcms2')
+    if library_path is not None:
+        return library_path
+    import PIL
+    pil_folder = os.path.dirname(os.path.abspath(PIL.__file__))
+    candidates = glob.glob(os.path.join(pil_folder, os.pardir, 'pillow.libs', 'liblcms2*')) + \
+        glob.glob(os.path.join(pil_folder, os.pardir, 'Pillow.libs', 'liblcms2*')) + \
+        glob.glob(os.path.join(pil_folder, '.dylibs', 'liblcms2*'))
+    if not candidates:
+        raise ImageProcessingError("Could not find the LittleCMS (lcms2) library. Install lcms2 to convert "
+                                   "16 bit images")
+    return candidates[0]
+
+
+def _load_library():
+    global _lcms2
+    if _lcms2 is None:
+        library = ctypes.CDLL(_find_library())
+        library.cmsOpenProfileFromMem.restype = ctypes.c_void_p
+        library.cmsOpenProfileFromMem.argtypes = [ctypes.c_char_p, ctypes.c_uint32]
+        library.cmsCloseProfile.argtypes = [ctypes.c_void_p]
+        library.cmsCreateTransform.restype = ctypes.c_void_p
+        library.cmsCreateTransform.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_uint32,
+                                               ctypes.c_uint32, ctypes.c_uint32]
+        library.cmsDoTransform.restype = None
+        library.cmsDoTransform.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32]
+        library.cmsDeleteTransform.argtypes = [ctypes.c_void_p]
+        _lcms2 = library
+    return _lcms2
+
+
+class Transform16Bit(object):
+    """
+    A LittleCMS colour transform between two ICC profiles for 16 bit per channel pixels.
+    Pillow's ImageCms only supports 8 bit images, so this calls lcms2 directly.
+    """
+
+    def __init__(self, input_icc, output_icc, input_mode, output_mode, rendering_intent):
+        """
+        :param input_icc: bytes of the input ICC profile
+        :param output_icc: bytes of the output ICC profile
+        :param input_mode: 'L', 'RGB' or 'RGBA'
+        :param output_mode: 'L', 'RGB' or 'RGBA'. Alpha channels are copied unchanged
+        :param rendering_intent: an ImageCms intent, e.g. ImageCms.INTENT_PERCEPTUAL
+        """
+        if input_mode not in FORMATS_16_BIT or output_mode not in FORMATS_16_BIT:
+            raise ImageProcessingError("Unsupported colour modes for 16 bit conversion: {0} to {1}"
+                                       .format(input_mode, output_mode))
+        self._lcms2 = _load_library()
+        self.input_mode = input_mode
+        self.output_mode = output_mode
+        self._transform = None
+        input_profile = self._lcms2.cmsOpenProfileFromMem(input_icc, len(input_icc))
+        output_profile = self._lcms2.cmsOpenProfileFromMem(output_icc, len(output_icc))
+        try:
+            if not input_profile or not output_profile:
+                raise ImageProcessingError("Could not read ICC profile")
+            flags = _FLAGS_COPY_ALPHA if input_mode == output_mode == 'RGBA' else 0
+            self._transform = self._lcms2.cmsCreateTransform(
+                input_profile, FORMATS_16_BIT[input_mode], output_profile, FORMATS_16_BIT[output_mode],
+                int(rendering_intent), flags)
+            if not self._transform:
+                raise ImageProcessingError("Could not build a colour transform from {0} to {1}"
+                                           .format(input_mode, output_mode))
+        finally:
+            # the transform doesn't need the profiles once it's built
+            if input_profile:
+                self._lcms2.cmsCloseProfile(input_profile)
+            if output_profile:
+                self._lcms2.cmsCloseProfile(output_profile)
+
+    def apply(self, input_array, output_array):
+        """
+        Transform the pixels in input_array, writing them to output_array
+
+        :param input_array: C-contiguous uint16 numpy array of shape (rows, columns[, channels]), in native byte order
+        :param output_array: C-contiguous uint16 numpy array with the same rows and columns, and the output channels
+        """
+        if not (input_array.flags['C_CONTIGUOUS'] and output_array.flags['C_CONTIGUOUS']):
+            raise ValueError("Arrays must be C-contiguous")
+        pixels = input_array.shape[0] * input_array.shape[1]
+        if output_array.shape[0] * output_array.shape[1] != pixels:
+            raise ValueError("Input and output arrays have different numbers of pixels")
+        self._lcms2.cmsDoTransform(self._transform, input_array.ctypes.data, output_array.ctypes.data, pixels)
+
+    def __del__(self):
+        if self._transform:
+            self._lcms2.cmsDeleteTransform(self._transform)
+            self._transform = None
@@ -0,0 +1,487 @@
+"""
+Migration of the lossless JPEG2000 files already in an archive to a new compression recipe, e.g. after changing
+:const:`~image_processing.kakadu.DEFAULT_COMPRESS_OPTIONS`, working from the jp2 files themselves rather than fetching
+the source TIFFs again. Run it as a script:
+::
+
+    python -m image_processing.migration --kakadu-base-path /opt/kakadu --ledger migration.db --workers 4 \\
+        --set ORGgen_tlm=8 /data/jp2
+
+Each jp2's new options come from the recipe and the compress options policy, as they would for a new TIFF.
+If the recipe recorded in the jp2 (see :func:`~image_processing.kakadu.read_recipe`) only differs in
+:const:`TRANSCODE_PARAMETERS`, which organise the codestream without changing how it's coded, the file is rewritten
+with kdu_transcode without decoding it. Otherwise it's expanded and recompressed.
+For jp2s without a recorded recipe, the :const:`CODESTREAM_PARAMETERS` are read back from the codestream's main header
+and compared instead, so files from before recipes were recorded can still be transcoded.
+Either way, the new file's pixels are checked against the old file's, its metadata boxes are copied over from the old
+file, and it replaces the old file with an atomic rename only once it's been validated.
+Lossy jp2s and jp2s with alpha channels fail without being changed (see :func:`check_can_migrate`).
+
+Progress is recorded in a ledger, an SQLite database like the
+:class:`~image_processing.content_index.ContentIndex`, so a migration which is stopped can be started again, skipping
+the files it has already done.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from image_processing import jp2, kakadu, utils, validation
+from image_processing.content_index import DEFAULT_BUSY_TIMEOUT
+from image_processing.derivative_files_generator import DEFAULT_KAKADU_BASE_PATH, StageTimeouts
+from image_processing.exceptions import ImageProcessingError
+from image_processing.restore import partial_filepath_for
+
+DEFAULT_WORKERS = 2
+
+TRANSCODE_PARAMETERS = ['Corder', 'ORGgen_plt', 'ORGgen_tlm', 'ORGtparts']
+"""Codestream parameters kdu_transcode can change without decoding the image"""
+
+ENCODER_OPTIONS = ['-flush_period', '-num_threads']
+"""kdu_compress options which change how it runs, but not the codestream it writes"""
+
+CODESTREAM_PARAMETERS = ['Clevels', 'Clayers', 'Corder', 'Stiles', 'Cblk', 'Cprecincts', 'Creversible', 'Cuse_sop',
+                         'Cuse_eph']
+"""Codestream parameters which can be read back from the main header, for jp2s without a recorded recipe"""
+
+_KAKADU_DEFAULTS = {'Clevels': '5', 'Clayers': '1', 'Corder': 'LRCP', 'Cblk': '{64,64}', 'Creversible': 'no',
+                    'Cuse_sop': 'no', 'Cuse_eph': 'no'}
+
+_SWITCHES_WITHOUT_VALUES = [kakadu.ALPHA_OPTION]
+
+TRANSCODE = 'transcode'
+REENCODE = 'reencode'
+
+MIGRATED = 'migrated'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS migrations (
+    filepath TEXT NOT NULL,
+    recipe TEXT NOT NULL,
+    status TEXT NOT NULL,
+    method TEXT,
+    checksum TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (filepath, recipe)
+)
+"""
+
+MigratedFile = namedtuple('MigratedFile', ['jp2_filepath', 'status', 'method', 'error'])
+"""
+The outcome of migrating one jp2: :const:`MIGRATED` with the method (:const:`TRANSCODE` or :const:`REENCODE`),
+:const:`UNCHANGED` if it already had the new recipe, :const:`SKIPPED` if the ledger says it's already been done,
+or :const:`FAILED` with the error message.
+"""
+
+
+def _parse_options(kakadu_options):
+    """
+    :return: dict of option name: value, where switches without values have the value None
+    """
+    parsed = {}
+    index = 0
+    while index < len(kakadu_options):
+        option = kakadu_options[index]
+        if option.startswith('-'):
+            if option in _SWITCHES_WITHOUT_VALUES or index + 1 == len(kakadu_options):
+                parsed[option] = None
+                index += 1
+            else:
+                parsed[option] = kakadu_options[index + 1]
+                index += 2
+        else:
+            name, _, value = option.partition('=')
+            parsed[name] = value
+            index += 1
+    return parsed
+
+
+def _sizes(value):
+    """
+    :param value: a kakadu size option value, e.g. '{256,256},{128,128}'
+    :return: list of (height, width)
+    """
+    numbers = [int(number) for number in re.findall(r'\d+', value)]
+    return list(zip(numbers[0::2], numbers[1::2]))
+
+
+def _codestream_options(info):
+    """
+    :return: dict of the :const:`CODESTREAM_PARAMETERS` of the codestream, in the form :func:`_normalise_option` gives
+    """
+    tiled = info.tile_width < info.x_offset + info.width or info.tile_height < info.y_offset + info.height
+    return {
+        'Clevels': info.levels,
+        'Clayers': info.layers,
+        'Corder': info.progression_order.lower(),
+        'Stiles': (info.tile_height, info.tile_width) if tiled else None,
+        'Cblk': info.code_block_size,
+        'Cprecincts': info.precinct_sizes,
+        'Creversible': 'yes' if info.reversible else 'no',
+        'Cuse_sop': 'yes' if info.sop_markers else 'no',
+        'Cuse_eph': 'yes' if info.eph_markers else 'no',
+    }
+
+
+def _normalise_option(name, value, info):
+    """
+    :return: the value of one of the :const:`CODESTREAM_PARAMETERS` in the form it has in the codestream's main header
+    """
+    if value is None:
+        return None
+    if name == 'Stiles':
+        tile_size = _sizes(value)[0]
+        # tiles covering the whole image are the same as no tiles
+        if tile_size[0] >= info.y_offset + info.height and tile_size[1] >= info.x_offset + info.width:
+            return None
+        return tile_size
+    if name == 'Cblk':
+        return _sizes(value)[0]
+    if name == 'Cprecincts':
+        # the last size given is used for the rest of the resolution levels
+        precinct_sizes = _sizes(value)
+        return precinct_sizes + precinct_sizes[-1:] * (info.levels + 1 - len(precinct_sizes))
+    if name in ['Clevels', 'Clayers']:
+        return int(value)
+    return value.lower()
+
+
+def _plan_from_codestream(info, new_options):
+    """
+    Like :func:`plan_migration`, comparing the options with what the codestream's main header records
+    """
+    if any(name not in CODESTREAM_PARAMETERS + TRANSCODE_PARAMETERS + ENCODER_OPTIONS and
+           not (name == '-rate' and new_options[name] == '-') for name in new_options):
+        # they can't be compared with the codestream
+        return REENCODE
+    old_options = _codestream_options(info)
+    changed = [name for name in CODESTREAM_PARAMETERS
+               if old_options[name] != _normalise_option(name, new_options.get(name, _KAKADU_DEFAULTS.get(name)), info)]
+    if not all(name in TRANSCODE_PARAMETERS for name in changed):
+        return REENCODE
+    # markers like PLT aren't recorded in the main header, so they're written whenever the options ask for them.
+    # That also records the recipe, so the file isn't transcoded again
+    if changed or any(name in TRANSCODE_PARAMETERS and name not in CODESTREAM_PARAMETERS for name in new_options):
+        return TRANSCODE
+    return None
+
+
+def plan_migration(recipe, kakadu_options, info=None):
+    """
+    :param recipe: the options the jp2 was compressed with, or None if they weren't recorded
+    :param kakadu_options: the options it should have been compressed with
+    :param info: :class:`~image_processing.jp2.CodestreamInfo` of the jp2. Without a recipe, its
+        :const:`CODESTREAM_PARAMETERS` are compared with the options instead. Without either, the jp2 is re-encoded
+    :return: None if the codestream would be the same, :const:`TRANSCODE` if only :const:`TRANSCODE_PARAMETERS`
+        are changed or added, otherwise :const:`REENCODE`
+    """
+    new_options = _parse_options(kakadu_options)
+    if recipe is None:
+        return _plan_from_codestream(info, new_options) if info is not None else REENCODE
+    old_options = _parse_options(recipe)
+    changed = set(name for name in set(old_options) | set(new_options)
+                  if name not in ENCODER_OPTIONS and
+                  (name not in old_options or name not in new_options or old_options[name] != new_options[name]))
+    if not changed:
+        return None
+    if all(name in TRANSCODE_PARAMETERS and name in new_options for name in changed):
+        return TRANSCODE
+    return REENCODE
+
+
+def probe_codestream(info):
+    """
+    :param info: :class:`~image_processing.jp2.CodestreamInfo`
+    :return: :class:`~image_processing.kakadu.ImageProbe` of the image the codestream was compressed from, for the
+        compress options policy
+    """
+    bit_depth = max(info.bit_depths)
+    if bit_depth == 1 and info.components == 1:
+        mode = '1'
+    elif bit_depth == 16 and info.components == 1:
+        mode = 'I;16'
+    else:
+        mode = _MODES.get(info.components, 'RGB')
+    return kakadu.ImageProbe(width=info.width, height=info.height, mode=mode, bit_depth=bit_depth,
+                             components=info.components)
+
+
+def check_can_migrate(info):
+    """
+    Raises an :class:`~image_processing.exceptions.ImageProcessingError` if the jp2 can't be migrated losslessly:
+    if it was compressed lossily, as the migrated file would be lossless, or if it has an alpha channel, as that's
+    lost when it's expanded to a TIFF to compress again or check the pixels
+
+    :param info: :class:`~image_processing.jp2.CodestreamInfo` of the jp2
+    """
+    if not info.reversible:
+        raise ImageProcessingError("Lossy jp2 files can't be migrated to a lossless recipe")
+    if info.components in [2, 4]:
+        raise ImageProcessingError("jp2 files with alpha channels can't be migrated, as the alpha channel "
+                                   "wouldn't be checked")
+
+
+class MigrationLedger(object):
+    """
+    Records which files have been migrated to which recipe.
+    Thread safe: each thread uses its own connection to the database.
+    """
+
+    def __init__(self, database_filepath, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        """
+        :param database_filepath: the SQLite database, which is created if it doesn't exist
+        :param busy_timeout: seconds to wait for another worker's write to finish
+        """
+        self.database_filepath = database_filepath
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_filepath, timeout=self.busy_timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def record(self, jp2_filepath, recipe, status, method=None, checksum=None, error=None):
+        """
+        :param jp2_filepath:
+        :param recipe: the options the file is being migrated to
+        :param status: :const:`MIGRATED`, :const:`UNCHANGED` or :const:`FAILED`
+        :param method: :const:`TRANSCODE` or :const:`REENCODE`
+        :param checksum: the sha256 of the migrated file
+        :param error: why it failed
+        """
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO migrations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (os.path.abspath(jp2_filepath), json.dumps(list(recipe)), status, method, checksum,
+                                error, time.time()))
+
+    def status(self, jp2_filepath, recipe):
+        """
+        :return: the status recorded for migrating the file to the recipe, or None if it hasn't been tried
+        """
+        row = self._connection().execute('SELECT status FROM migrations WHERE filepath = ? AND recipe = ?',
+                                         (os.path.abspath(jp2_filepath), json.dumps(list(recipe)))).fetchone()
+        return row[0] if row is not None else None
+
+    def counts(self):
+        """
+        :return: dict of status: the number of files recorded with it
+        """
+        return dict(self._connection().execute('SELECT status, COUNT(*) FROM migrations GROUP BY status'))
+
+    def close(self):
+        """
+        Close the calling thread's connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class Migrator(object):
+    """
+    Migrates jp2 files to a new recipe in place, several at a time.
+    """
+
+    def __init__(self, kakadu_base_path=DEFAULT_KAKADU_BASE_PATH,
+                 kakadu_compress_options=kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS,
+                 compress_options_policy=kakadu.default_compress_options_policy, ledger=None,
+                 workers=DEFAULT_WORKERS, timeouts=None):
+        """
+        :param kakadu_base_path: the location of the kakadu executables
+        :param kakadu_compress_options: the new recipe. It has to be lossless
+        :param compress_options_policy: adapts the recipe to each image, as in
+            :class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator`
+        :param ledger: :class:`MigrationLedger`. Without one, files are only skipped if they already have the recipe
+        :param workers: the number of files to migrate at the same time
+        :param timeouts: :class:`~image_processing.derivative_files_generator.StageTimeouts` for the kakadu commands
+        """
+        if kakadu.get_option(kakadu_compress_options, 'Creversible') != 'yes':
+            raise ValueError('Files can only be migrated to a lossless recipe, not {0}'
+                             .format(' '.join(kakadu_compress_options)))
+        self.kakadu = kakadu.Kakadu(kakadu_base_path)
+        self.kakadu_compress_options = kakadu_compress_options
+        self.compress_options_policy = compress_options_policy
+        self.ledger = ledger
+        self.workers = workers
+        self.timeouts = timeouts or StageTimeouts()
+        self.log = logging.getLogger(__name__)
+
+    def get_compress_options(self, info):
+        """
+        :param info: :class:`~image_processing.jp2.CodestreamInfo` of the jp2
+        :return: the options the jp2 should be compressed with
+        """
+        kakadu_options = list(self.kakadu_compress_options)
+        if self.compress_options_policy is not None:
+            kakadu_options = list(self.compress_options_policy(kakadu_options, probe_codestream(info)))
+        return kakadu_options
+
+    def migrate(self, jp2_filepaths):
+        """
+        :param jp2_filepaths: list of jp2 files
+        :return: list of :class:`MigratedFile`, in the same order
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(self._migrate_safely, jp2_filepaths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _migrate_safely(self, jp2_filepath):
+        try:
+            return self.migrate_file(jp2_filepath)
+        except Exception as e:
+            self.log.error('Failed to migrate {0}: {1}'.format(jp2_filepath, e))
+            self.log.debug(traceback.format_exc())
+            return MigratedFile(jp2_filepath, FAILED, None, str(e))
+
+    def migrate_file(self, jp2_filepath):
+        """
+        Migrate one jp2, unless the ledger says it's already been migrated.
+        Raises a :class:`~image_processing.exceptions.ValidationError` if the new file isn't valid or its pixels don't
+        match, or an :class:`~image_processing.exceptions.ImageProcessingError` if the jp2 can't be migrated (see
+        :func:`check_can_migrate`), and leaves the old file as it was.
+
+        :param jp2_filepath:
+        :return: :class:`MigratedFile`
+        """
+        info = jp2.read_codestream_info(jp2_filepath)
+        kakadu_options = self.get_compress_options(info)
+        if self.ledger is not None and self.ledger.status(jp2_filepath, kakadu_options) in [MIGRATED, UNCHANGED]:
+            return MigratedFile(jp2_filepath, SKIPPED, None, None)
+        try:
+            check_can_migrate(info)
+        except ImageProcessingError as e:
+            self._record(jp2_filepath, kakadu_options, FAILED, error=str(e))
+            raise
+
+        method = plan_migration(kakadu.read_recipe(jp2_filepath), kakadu_options, info)
+        if method is None:
+            self._record(jp2_filepath, kakadu_options, UNCHANGED)
+            return MigratedFile(jp2_filepath, UNCHANGED, None, None)
+
+        partial_filepath = partial_filepath_for(jp2_filepath)
+        try:
+            self._migrate_to(jp2_filepath, partial_filepath, info, kakadu_options, method)
+            os.rename(partial_filepath, jp2_filepath)
+        except Exception as e:
+            if os.path.exists(partial_filepath):
+                os.remove(partial_filepath)
+            self._record(jp2_filepath, kakadu_options, FAILED, method=method, error=str(e))
+            raise
+        self._record(jp2_filepath, kakadu_options, MIGRATED, method=method,
+                     checksum=utils.file_checksum(jp2_filepath))
+        self.log.info('Migrated {0} with {1}'.format(jp2_filepath, method))
+        return MigratedFile(jp2_filepath, MIGRATED, method, None)
+
+    def _migrate_to(self, jp2_filepath, new_jp2_filepath, info, kakadu_options, method):
+        """
+        Write the migrated jp2 to new_jp2_filepath, and check it
+        """
+        with tempfile.NamedTemporaryFile(prefix='jp2_migrate_', suffix='.tif') as expanded_file_obj, \
+                tempfile.NamedTemporaryFile(prefix='jp2_migrate_check_', suffix='.tif') as check_file_obj:
+            expanded_filepath = expanded_file_obj.name
+            self.kakadu.kdu_expand(jp2_filepath, expanded_filepath, kakadu_options=[],
+                                   timeout=self._timeout('kdu_expand', info))
+            if method == TRANSCODE:
+                transcode_options = [option for option in kakadu_options
+                                     if option.partition('=')[0] in TRANSCODE_PARAMETERS]
+                self.kakadu.kdu_transcode(jp2_filepath, new_jp2_filepath, kakadu_options=transcode_options,
+                                          timeout=self._timeout('kdu_transcode', info))
+                # kdu_transcode may carry over the old recipe comment, so it's replaced rather than added to
+                jp2.write_codestream_comment(new_jp2_filepath, kakadu.recipe_comment(kakadu_options),
+                                             replace_prefix=kakadu.RECIPE_COMMENT_PREFIX)
+            else:
+                # kdu_compress reads the TIFF a strip at a time, and -flush_period writes out the codestream as it
+                # goes, so neither image is held in memory whole
+                self.kakadu.kdu_compress(expanded_filepath, new_jp2_filepath,
+                                         kakadu_options=kakadu_options + kakadu.recipe_comment_options(kakadu_options),
+                                         timeout=self._timeout('kdu_compress', info))
+            jp2.write_metadata_boxes(new_jp2_filepath, jp2.read_metadata_boxes(jp2_filepath))
+
+            validation.validate_jp2(new_jp2_filepath)
+            check_filepath = check_file_obj.name
+            self.kakadu.kdu_expand(new_jp2_filepath, check_filepath, kakadu_options=['-fussy'],
+                                   timeout=self._timeout('kdu_expand', info))
+            # also checks the ICC profile was carried over
+            validation.check_visually_identical(expanded_filepath, check_filepath)
+
+    def _timeout(self, command, info):
+        return self.timeouts.kakadu_timeout(command, info.width, info.height)
+
+    def _record(self, jp2_filepath, kakadu_options, status, method=None, checksum=None, error=None):
+        if self.ledger is not None:
+            self.ledger.record(jp2_filepath, kakadu_options, status, method=method, checksum=checksum, error=error)
+
+
+def find_jp2_files(folder):
+    """
+    :return: sorted list of the jp2 files in the folder and its subfolders, leaving out hidden files such as the
+        partial files of a migration which was stopped
+    """
+    jp2_filepaths = []
+    for parent_folder, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if filename.lower().endswith('.jp2') and not filename.startswith('.'):
+                jp2_filepaths.append(os.path.join(parent_folder, filename))
+    return sorted(jp2_filepaths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate lossless JPEG2000 files to a new compression recipe')
+    parser.add_argument('jp2_folders', nargs='+')
+    parser.add_argument('--ledger', required=True, help='SQLite database recording progress, to resume from')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='change an option of the default lossless recipe, e.g. ORGgen_tlm=8 or -flush_period=512')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--kakadu-base-path', default=DEFAULT_KAKADU_BASE_PATH)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    kakadu_options = kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS
+    for setting in args.set:
+        option_name, _, value = setting.partition('=')
+        kakadu_options = kakadu.replace_option(kakadu_options, option_name, value or None)
+    ledger = MigrationLedger(args.ledger)
+    migrator = Migrator(kakadu_base_path=args.kakadu_base_path, kakadu_compress_options=kakadu_options,
+                        ledger=ledger, workers=args.workers)
+    jp2_filepaths = [filepath for folder in args.jp2_folders for filepath in find_jp2_files(folder)]
+    results = migrator.migrate(jp2_filepaths)
+    for status in [MIGRATED, UNCHANGED, SKIPPED, FAILED]:
+        print('{0}: {1}'.format(status, sum(1 for result in results if result.status == status)))
+    for result in results:
+        if result.status == FAILED:
+            print('{0}: {1}'.format(result.jp2_filepath, result.error))
+    return 0 if all(result.status != FAILED for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,8 +3,11 @@ from __future__ import print_function
 from __future__ import division
 
 import os
+import re
 import subprocess
 import logging
+import time
+from collections import namedtuple
 from image_processing.exceptions import OpenJPEGError
 from image_processing import utils
 
@@ -12,16 +15,44 @@ LOSSLESS_COMPRESS_OPTIONS = [
     "-t", "512,512", "-TP", "R", "-b", "64,64", "-n", "6", "-c", "[256,256],[256,256],[128,128]", "-p", "RPCL", "-SOP"
 ]
 
+OpenJPEGStats = namedtuple('OpenJPEGStats', ['command', 'wall_seconds', 'codec_seconds', 'warnings', 'output'])
+"""
+What an OpenJPEG command did, returned by the :class:`OpenJPEG` methods when they're called with collect_stats=True.
+OpenJPEG always prints its encode or decode time, which is codec_seconds, and has no other statistics to ask for.
+wall_seconds is measured here, and warnings is a list of the text of each warning it printed
+"""
+
+_CODEC_TIME_PATTERN = re.compile(r'(?:encode|decode) time:\s*([\d.]+)\s*ms')
+_WARNING_PATTERN = re.compile(r'^\[WARNING\]\s*(.*)$')
+
+
+def parse_stats(command, output, wall_seconds=None):
+    """
+    :param command: e.g. 'opj_compress'
+    :param output: everything the command printed to stdout and stderr
+    :param wall_seconds: how long the command took
+    :return: :class:`OpenJPEGStats`
+    """
+    # the time is printed per image, so add them up in case a directory was converted
+    codec_times = [float(milliseconds) / 1000 for milliseconds in _CODEC_TIME_PATTERN.findall(output)]
+    warnings = [match.group(1).strip() for match in
+                (_WARNING_PATTERN.match(line.strip()) for line in output.splitlines()) if match]
+    return OpenJPEGStats(command=command, wall_seconds=wall_seconds,
+                         codec_seconds=sum(codec_times) if codec_times else None, warnings=warnings, output=output)
+
+
 class OpenJPEG(object):
     """
     Python wrapper for jp2 compression and expansion functions in OpenJPEG
     """
 
-    def __init__(self, openjpeg_base_path):
+    def __init__(self, openjpeg_base_path, resource_limits=None):
         """
         :param openjpeg_base_path: The location of the opj_compress and opj_decompress executables
+        :param resource_limits: :class:`~image_processing.utils.ResourceLimits` for the child processes
         """
         self.openjpeg_base_path = openjpeg_base_path
+        self.resource_limits = resource_limits
         self.log = logging.getLogger(__name__)
         if not utils.cmd_is_executable(self._command_path('opj_compress')):
             raise OSError("Could not find executable {0}. Check OpenJPEG is installed and opj_compress exists at the configured path"
@@ -34,27 +65,37 @@ class OpenJPEG(object):
     def _command_path(self, command):
         return os.path.join(self.openjpeg_base_path, command)
 
-    def opj_compress(self, input_filepaths, output_filepath, openjpeg_options):
+    def opj_compress(self, input_filepaths, output_filepath, openjpeg_options, timeout=None, collect_stats=False):
         """
         Converts an image file supported by OpenJPEG to jpeg2000
 
         :param input_filepaths: A single filepath.
         :param output_filepath:
         :param openjpeg_options: command line arguments
+        :param timeout: seconds to wait before killing the command and raising a
+            :class:`~image_processing.exceptions.CommandTimeoutError`. None waits as long as it takes
+        :param collect_stats: capture the output
+        :return: :class:`OpenJPEGStats` if collect_stats is True, otherwise None
         """
-        self.run_command('opj_compress', input_filepaths, output_filepath, openjpeg_options)
+        return self.run_command('opj_compress', input_filepaths, output_filepath, openjpeg_options, timeout=timeout,
+                                collect_stats=collect_stats)
 
-    def opj_decompress(self, input_filepath, output_filepath, openjpeg_options):
+    def opj_decompress(self, input_filepath, output_filepath, openjpeg_options, timeout=None, collect_stats=False):
         """
         Converts a jpeg2000 file to tiff
 
         :param input_filepath:
         :param output_filepath:
         :param openjpeg_options: command line arguments
+        :param timeout: seconds to wait before killing the command and raising a
+            :class:`~image_processing.exceptions.CommandTimeoutError`. None waits as long as it takes
+        :param collect_stats: capture the output
+        :return: :class:`OpenJPEGStats` if collect_stats is True, otherwise None
         """
-        self.run_command('opj_decompress', input_filepath, output_filepath, openjpeg_options)
+        return self.run_command('opj_decompress', input_filepath, output_filepath, openjpeg_options, timeout=timeout,
+                                collect_stats=collect_stats)
 
-    def run_command(self, command, input_files, output_file, openjpeg_options):
+    def run_command(self, command, input_files, output_file, openjpeg_options, timeout=None, collect_stats=False):
         if not isinstance(input_files, list):
             input_files = [input_files]
 
@@ -72,8 +113,18 @@ class OpenJPEG(object):
 
         self.log.debug(' '.join(['"{0}"'.format(c) if ('{' in c or ' ' in c) else c for c in command_options]))
 
+        start_time = time.time()
         try:
-            subprocess.check_call(command_options, stderr=subprocess.STDOUT)
+            output = utils.run_command(command_options, timeout=timeout, resource_limits=self.resource_limits,
+                                       capture_output=collect_stats)
         except subprocess.CalledProcessError as e:
-            raise OpenJPEGError('OpenJPEG {0} failed on {1}. Command: {2}, Error: {3}'.
-                              format(command, input_option, ' '.join(command_options), e))
+            raise OpenJPEGError('OpenJPEG {0} failed on {1}. Command: {2}, Error: {3}{4}'.
+                              format(command, input_option, ' '.join(command_options), e,
+                                     '. Output: {0}'.format(e.output) if e.output else ''))
+        if not collect_stats:
+            return None
+
+        stats = parse_stats(command, output, wall_seconds=time.time() - start_time)
+        for warning in stats.warnings:
+            self.log.warning('OpenJPEG {0} warned about {1}: {2}'.format(command, input_option, warning))
+        return stats
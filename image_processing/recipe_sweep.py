@@ -0,0 +1,257 @@
+"""
+Measure how different kdu_compress recipes perform on a sample of source images, to help choose
+the kakadu_compress_options for :class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator`.
+
+Each variant is encoded losslessly, checked against the source, and timed for a full decode, a decode at a reduced
+resolution level and a decode of a random region. Run it as a script:
+::
+
+    python -m image_processing.recipe_sweep --kakadu-base-path /opt/kakadu --grid grid.json \\
+        --recipe-output recipe.json sample1.tif sample2.tif
+
+where grid.json maps kakadu options to the values to try, e.g. ``{"Stiles": ["{512,512}", "{1024,1024}"],
+"Corder": ["RPCL", "PCRL"], "-flush_period": ["1024", "2048"]}``. The best recipe is written to recipe.json as a
+list of options that can be passed straight into kakadu_compress_options.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from timeit import default_timer
+
+from PIL import Image
+
+from image_processing import kakadu, validation, jp2
+from image_processing.exceptions import ValidationError
+
+DEFAULT_REDUCE_LEVELS = 2
+DEFAULT_REGION_SIZE = 1024
+
+SweepResult = namedtuple('SweepResult', [
+    'variant', 'kakadu_options', 'source_file', 'lossless', 'encode_seconds', 'encode_peak_memory_kb',
+    'output_bytes', 'full_decode_seconds', 'reduced_decode_seconds', 'region_decode_seconds'])
+"""The measurements for encoding one source file with one recipe variant"""
+
+METRICS = ['encode_seconds', 'encode_peak_memory_kb', 'output_bytes',
+           'full_decode_seconds', 'reduced_decode_seconds', 'region_decode_seconds']
+
+DEFAULT_RANKING_WEIGHTS = dict((metric, 1.0) for metric in METRICS)
+"""Relative importance of each measurement when ranking the variants"""
+
+
+def option_variants(grid, base_options=kakadu.DEFAULT_COMPRESS_OPTIONS):
+    """
+    Every combination of the option values in the grid, applied to the base options.
+
+    :param grid: dict of kakadu option name (e.g. 'Stiles' or '-flush_period') to a list of values to try.
+        None as a value removes the option.
+    :param base_options: the options the variants are based on. Should not include lossless or lossy options
+    :return: list of (variant, kakadu options) tuples, where variant is a dict of the option values used
+    """
+    option_names = sorted(grid)
+    variants = []
+    for values in itertools.product(*[grid[name] for name in option_names]):
+        variant = dict(zip(option_names, values))
+        kakadu_options = list(base_options)
+        for name in option_names:
+            kakadu_options = kakadu.replace_option(kakadu_options, name, variant[name])
+        variants.append((variant, kakadu_options))
+    return variants
+
+
+def measure_variant(kakadu_base_path, source_file, variant, kakadu_options, reduce_levels=DEFAULT_REDUCE_LEVELS,
+                    region_size=DEFAULT_REGION_SIZE, seed=0):
+    """
+    Encode the source file losslessly with the given options and measure it.
+
+    .. note:: The peak memory is read from the resource usage of this process's children, so this should run in a
+        fresh process (as :func:`run_sweep` does) to only measure kdu_compress.
+
+    :param kakadu_base_path:
+    :param source_file: TIFF file
+    :param variant: dict describing the variant, included in the result
+    :param kakadu_options: kdu_compress options, without lossless options. The alpha option is added for RGBA sources
+    :param reduce_levels: how many resolution levels to discard for the reduced decode
+    :param region_size: width and height of the random region to decode
+    :param seed: seed for choosing the random region
+    :return: :class:`SweepResult`, whose kakadu_options are the variant's lossless options, without the alpha option
+    """
+    kdu = kakadu.Kakadu(kakadu_base_path)
+    kakadu_options = list(kakadu_options) + kakadu.LOSSLESS_OPTIONS
+    # the alpha option depends on the source, not the variant, so it's left out of the result
+    compress_options = list(kakadu_options)
+    with Image.open(source_file) as source_pil:
+        if source_pil.mode == 'RGBA':
+            compress_options += [kakadu.ALPHA_OPTION]
+
+    scratch_folder = tempfile.mkdtemp(prefix='image-processing_sweep_')
+    try:
+        jp2_filepath = os.path.join(scratch_folder, 'sweep.jp2')
+        start = default_timer()
+        kdu.kdu_compress(source_file, jp2_filepath, kakadu_options=compress_options)
+        encode_seconds = default_timer() - start
+        encode_peak_memory_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        full_tiff_filepath = os.path.join(scratch_folder, 'full.tif')
+        full_decode_seconds = _time_expand(kdu, jp2_filepath, full_tiff_filepath, [])
+        try:
+            validation.check_visually_identical(source_file, full_tiff_filepath)
+            lossless = True
+        except ValidationError:
+            lossless = False
+
+        info = jp2.read_codestream_info(jp2_filepath)
+        reduced_decode_seconds = _time_expand(kdu, jp2_filepath, os.path.join(scratch_folder, 'reduced.tif'),
+                                              ['-reduce', str(min(reduce_levels, info.levels))])
+
+        rng = random.Random(seed)
+        width, height = min(region_size, info.width), min(region_size, info.height)
+        left, top = rng.randint(0, info.width - width), rng.randint(0, info.height - height)
+        region_decode_seconds = _time_expand(kdu, jp2_filepath, os.path.join(scratch_folder, 'region.tif'),
+                                             kakadu.region_options(left, top, width, height, info.width, info.height))
+
+        return SweepResult(variant=variant, kakadu_options=kakadu_options, source_file=source_file,
+                           lossless=lossless, encode_seconds=encode_seconds,
+                           encode_peak_memory_kb=encode_peak_memory_kb, output_bytes=os.path.getsize(jp2_filepath),
+                           full_decode_seconds=full_decode_seconds, reduced_decode_seconds=reduced_decode_seconds,
+                           region_decode_seconds=region_decode_seconds)
+    finally:
+        shutil.rmtree(scratch_folder)
+
+
+def _time_expand(kdu, jp2_filepath, output_filepath, kakadu_options):
+    start = default_timer()
+    kdu.kdu_expand(jp2_filepath, output_filepath, kakadu_options=kakadu_options)
+    return default_timer() - start
+
+
+def _measure_variant_task(args):
+    return measure_variant(*args)
+
+
+def run_sweep(kakadu_base_path, source_files, grid, base_options=kakadu.DEFAULT_COMPRESS_OPTIONS,
+              reduce_levels=DEFAULT_REDUCE_LEVELS, region_size=DEFAULT_REGION_SIZE, seed=0):
+    """
+    Measure every variant in the grid against every source file.
+    Measurements are run one at a time, each in a fresh process, so they don't interfere with each other.
+
+    :param kakadu_base_path:
+    :param source_files: list of TIFF files, which should be representative of the images being converted
+    :param grid: see :func:`option_variants`
+    :param base_options: see :func:`option_variants`
+    :param reduce_levels: see :func:`measure_variant`
+    :param region_size: see :func:`measure_variant`
+    :param seed: see :func:`measure_variant`
+    :return: list of :class:`SweepResult`
+    """
+    logger = logging.getLogger(__name__)
+    tasks = [(kakadu_base_path, source_file, variant, kakadu_options, reduce_levels, region_size, seed)
+             for variant, kakadu_options in option_variants(grid, base_options)
+             for source_file in source_files]
+    logger.info('Measuring {0} recipe variants over {1} source files'.format(len(tasks) // len(source_files),
+                                                                           len(source_files)))
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+        return pool.map(_measure_variant_task, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def rank_variants(results, weights=DEFAULT_RANKING_WEIGHTS):
+    """
+    Combine the results for each variant over all the source files, and rank them.
+    Results are grouped by variant, so the summaries include every source file, whatever its mode.
+    Each measurement is scaled relative to the best variant's, and the score is the weighted sum of these, so a
+    variant which is best at everything scores the sum of the weights. Variants which weren't lossless for every
+    source file aren't ranked.
+
+    :param results: list of :class:`SweepResult`
+    :param weights: dict of measurement name to weight
+    :return: list of dicts with the variant, kakadu_options, the summed measurements and score, best first
+    """
+    summaries = []
+    for result in results:
+        summary = next((s for s in summaries if s['variant'] == result.variant), None)
+        if summary is None:
+            summary = dict((metric, 0) for metric in METRICS)
+            # the recipe is used for every image, so it mustn't carry a source's alpha option
+            kakadu_options = [option for option in result.kakadu_options if option != kakadu.ALPHA_OPTION]
+            summary.update(variant=result.variant, kakadu_options=kakadu_options, lossless=True)
+            summaries.append(summary)
+        summary['lossless'] = summary['lossless'] and result.lossless
+        for metric in METRICS:
+            if metric == 'encode_peak_memory_kb':
+                summary[metric] = max(summary[metric], getattr(result, metric))
+            else:
+                summary[metric] += getattr(result, metric)
+
+    summaries = [summary for summary in summaries if summary['lossless']]
+    for summary in summaries:
+        summary['score'] = 0
+        for metric, weight in weights.items():
+            best = min(s[metric] for s in summaries)
+            summary['score'] += weight * (summary[metric] / best if best else 1)
+    return sorted(summaries, key=lambda s: s['score'])
+
+
+def format_table(ranked_variants):
+    """
+    :param ranked_variants: output of :func:`rank_variants`
+    :return: the ranked variants as a plain text table
+    """
+    headings = ['rank', 'score'] + METRICS + ['variant']
+    rows = [headings]
+    for rank, summary in enumerate(ranked_variants, start=1):
+        rows.append([str(rank), '{0:.3f}'.format(summary['score'])] +
+                    ['{0:.3f}'.format(summary[metric]) if isinstance(summary[metric], float) else str(summary[metric])
+                     for metric in METRICS] +
+                    [' '.join('{0}={1}'.format(k, v) for k, v in sorted(summary['variant'].items()))])
+    column_widths = [max(len(row[i]) for row in rows) for i in range(len(headings))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, column_widths)).rstrip()
+                     for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure kdu_compress recipe variants on sample images')
+    parser.add_argument('source_files', nargs='+', help='sample TIFF files')
+    parser.add_argument('--grid', required=True,
+                        help='JSON file mapping kakadu option names to lists of values to try')
+    parser.add_argument('--kakadu-base-path', default='', help='location of kdu_compress and kdu_expand')
+    parser.add_argument('--reduce-levels', type=int, default=DEFAULT_REDUCE_LEVELS)
+    parser.add_argument('--region-size', type=int, default=DEFAULT_REGION_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--recipe-output', help='write the best recipe to this file as a JSON list')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.grid) as grid_file:
+        grid = json.load(grid_file)
+    results = run_sweep(args.kakadu_base_path, args.source_files, grid, reduce_levels=args.reduce_levels,
+                        region_size=args.region_size, seed=args.seed)
+    ranked_variants = rank_variants(results)
+    print(format_table(ranked_variants))
+    if not ranked_variants:
+        print('No variant was lossless for every source file')
+        return 1
+    print('Best recipe: {0}'.format(json.dumps(ranked_variants[0]['kakadu_options'])))
+    if args.recipe_output:
+        with open(args.recipe_output, 'w') as recipe_file:
+            json.dump(ranked_variants[0]['kakadu_options'], recipe_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
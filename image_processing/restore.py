@@ -0,0 +1,242 @@
+"""
+Bulk restoration of TIFFs from archived lossless JPEG2000 files, e.g. after losing the source TIFFs.
+Run it as a script:
+::
+
+    python -m image_processing.restore --kakadu-base-path /opt/kakadu --manifest checksums.txt \\
+        --workers 4 --kakadu-threads 2 jp2_folder/ tiff_folder/
+
+The manifest lists the pixel checksum (from :func:`~image_processing.validation.generate_pixel_checksum`) recorded
+for each source TIFF at ingest, in the same format as sha256sum output, with the jp2 filepaths relative to the jp2
+folder:
+::
+
+    3b5d3c7d207e37dceeedd301e35e2e58...  volume1/page0001.jp2
+
+Each jp2 in the manifest is expanded with kdu_expand to a hidden partial file next to its TIFF, its XMP is copied
+back in with a single exiftool command, and its pixels are checked against the manifest. Only then is it renamed into
+place, so a TIFF which exists has been verified, and a run which is stopped can be started again, skipping the
+TIFFs already restored.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import traceback
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+from image_processing import conversion, jp2, kakadu, validation
+from image_processing.derivative_files_generator import DEFAULT_EXIFTOOL_PATH, DEFAULT_KAKADU_BASE_PATH, \
+    StageTimeouts
+from image_processing.exceptions import ImageProcessingError, ValidationError
+from PIL import Image
+
+DEFAULT_WORKERS = 2
+PARTIAL_SUFFIX = '.partial'
+
+RESTORED = 'restored'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+RestoredFile = namedtuple('RestoredFile', ['jp2_filepath', 'tiff_filepath', 'status', 'error'])
+"""
+The outcome of restoring one TIFF: :const:`RESTORED`, :const:`SKIPPED` if it had already been restored, or
+:const:`FAILED` with the error message.
+"""
+
+
+def read_manifest(manifest_filepath):
+    """
+    :param manifest_filepath: lines of pixel checksum and jp2 filepath, separated by whitespace.
+        Blank lines and lines starting with # are ignored
+    :return: OrderedDict of jp2 filepath: pixel checksum, in the order of the manifest
+    """
+    manifest = OrderedDict()
+    with open(manifest_filepath) as manifest_file:
+        for line_number, line in enumerate(manifest_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise ImageProcessingError('Line {0} of {1} is not a checksum and filepath: {2}'
+                                           .format(line_number, manifest_filepath, line))
+            pixel_checksum, jp2_filepath = parts
+            # sha256sum marks files read in binary mode with *
+            manifest[jp2_filepath.lstrip('*')] = pixel_checksum.lower()
+    return manifest
+
+
+def tiff_filepath_for(jp2_filepath, jp2_folder, tiff_folder):
+    """
+    :return: where the TIFF restored from the jp2 goes: the same path relative to tiff_folder, with a .tif extension
+    """
+    relative_filepath = os.path.relpath(jp2_filepath, jp2_folder)
+    return os.path.join(tiff_folder, os.path.splitext(relative_filepath)[0] + '.tif')
+
+
+def partial_filepath_for(tiff_filepath):
+    """
+    :return: the hidden file the TIFF is written to before it's verified. It's in the same folder, so it can be
+        renamed into place atomically
+    """
+    folder, filename = os.path.split(tiff_filepath)
+    name, extension = os.path.splitext(filename)
+    return os.path.join(folder, '.{0}{1}{2}'.format(name, PARTIAL_SUFFIX, extension))
+
+
+class Restorer(object):
+    """
+    Restores TIFFs from lossless jp2 files in parallel.
+    Each kdu_expand runs with kakadu_threads threads, and workers of them run at once, so workers * kakadu_threads
+    should be about the number of cores. Many workers with few threads each is best for many small images, as each
+    kdu_expand spends part of its time single threaded reading the file and writing the TIFF; few workers with many
+    threads each is best for a few very large images, as it needs less memory.
+    """
+
+    def __init__(self, kakadu_base_path=DEFAULT_KAKADU_BASE_PATH, exiftool_path=DEFAULT_EXIFTOOL_PATH,
+                 workers=DEFAULT_WORKERS, kakadu_threads=None, timeouts=None, verify_existing=False):
+        """
+        :param kakadu_base_path: the location of the kdu_expand executable
+        :param exiftool_path: path to the exiftool executable
+        :param workers: the number of TIFFs to restore at the same time
+        :param kakadu_threads: the number of threads each kdu_expand uses.
+            Defaults to sharing the cores between the workers
+        :param timeouts: :class:`~image_processing.derivative_files_generator.StageTimeouts` for kdu_expand and
+            exiftool. Defaults to the generator's defaults
+        :param verify_existing: check the pixels of TIFFs which have already been restored, rather than skipping them
+        """
+        self.timeouts = timeouts or StageTimeouts()
+        self.kakadu = kakadu.Kakadu(kakadu_base_path)
+        self.converter = conversion.Converter(exiftool_path=exiftool_path, exiftool_timeout=self.timeouts.exiftool)
+        self.workers = workers
+        self.kakadu_threads = kakadu_threads or max(1, multiprocessing.cpu_count() // workers)
+        self.verify_existing = verify_existing
+        self.log = logging.getLogger(__name__)
+
+    def restore(self, manifest, jp2_folder, tiff_folder):
+        """
+        :param manifest: dict of jp2 filepath relative to jp2_folder: pixel checksum, e.g. from :func:`read_manifest`
+        :param jp2_folder:
+        :param tiff_folder: the TIFFs are restored to the same relative paths in this folder
+        :return: list of :class:`RestoredFile`, in the order of the manifest
+        """
+        jobs = [(os.path.join(jp2_folder, relative_filepath),
+                 tiff_filepath_for(os.path.join(jp2_folder, relative_filepath), jp2_folder, tiff_folder),
+                 pixel_checksum)
+                for relative_filepath, pixel_checksum in manifest.items()]
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(lambda job: self._restore_safely(*job), jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _restore_safely(self, jp2_filepath, tiff_filepath, pixel_checksum):
+        try:
+            return self.restore_file(jp2_filepath, tiff_filepath, pixel_checksum)
+        except Exception as e:
+            self.log.error('Failed to restore {0}: {1}'.format(jp2_filepath, e))
+            self.log.debug(traceback.format_exc())
+            return RestoredFile(jp2_filepath, tiff_filepath, FAILED, str(e))
+
+    def restore_file(self, jp2_filepath, tiff_filepath, pixel_checksum):
+        """
+        Restore one TIFF, unless it has already been restored.
+        Raises a :class:`~image_processing.exceptions.ValidationError` if its pixels don't match the checksum
+
+        :param jp2_filepath:
+        :param tiff_filepath:
+        :param pixel_checksum: of the source TIFF, recorded at ingest
+        :return: :class:`RestoredFile`
+        """
+        if os.path.exists(tiff_filepath):
+            if self.verify_existing:
+                self._check_pixels(tiff_filepath, pixel_checksum)
+            return RestoredFile(jp2_filepath, tiff_filepath, SKIPPED, None)
+
+        tiff_folder = os.path.dirname(tiff_filepath)
+        if tiff_folder and not os.path.isdir(tiff_folder):
+            try:
+                os.makedirs(tiff_folder)
+            except OSError:
+                # another worker created it first
+                if not os.path.isdir(tiff_folder):
+                    raise
+
+        # the partial file of a run which was stopped is overwritten
+        partial_filepath = partial_filepath_for(tiff_filepath)
+        try:
+            info = jp2.read_codestream_info(jp2_filepath)
+            self.kakadu.kdu_expand(jp2_filepath, partial_filepath,
+                                   kakadu_options=['-num_threads', str(self.kakadu_threads)],
+                                   timeout=self.timeouts.kakadu_timeout('kdu_expand', info.width, info.height))
+            if max(info.bit_depths) == 1:
+                _save_as_bitonal(partial_filepath)
+            if jp2.read_xmp(jp2_filepath) is not None:
+                self.converter.copy_over_embedded_metadata(jp2_filepath, partial_filepath, write_only_xmp=True)
+            # check the file exactly as it will be published
+            self._check_pixels(partial_filepath, pixel_checksum)
+            os.rename(partial_filepath, tiff_filepath)
+        except Exception:
+            if os.path.exists(partial_filepath):
+                os.remove(partial_filepath)
+            raise
+        self.log.info('Restored {0} from {1}'.format(tiff_filepath, jp2_filepath))
+        return RestoredFile(jp2_filepath, tiff_filepath, RESTORED, None)
+
+    def _check_pixels(self, tiff_filepath, pixel_checksum):
+        restored_checksum = validation.generate_pixel_checksum(tiff_filepath)
+        if restored_checksum != pixel_checksum:
+            raise ValidationError('Pixel checksum {0} of {1} does not match the checksum {2} recorded at ingest'
+                                  .format(restored_checksum, tiff_filepath, pixel_checksum))
+
+
+def _save_as_bitonal(tiff_filepath):
+    """
+    kdu_expand writes bitonal images as 8 bit greyscale, so save them as bitonal again, like the masters they came from.
+    No information is lost, as the greyscale pixels are all black or white
+    """
+    with Image.open(tiff_filepath) as tiff_pil:
+        # thresholded rather than dithered, so the black and white pixels come back exactly
+        bitonal_pil = tiff_pil.convert(validation.BITONAL, dither=Image.NONE)
+        dpi = tiff_pil.info.get('dpi')
+    if dpi:
+        bitonal_pil.save(tiff_filepath, 'TIFF', dpi=dpi)
+    else:
+        bitonal_pil.save(tiff_filepath, 'TIFF')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Restore TIFFs from lossless JPEG2000 files')
+    parser.add_argument('jp2_folder')
+    parser.add_argument('tiff_folder')
+    parser.add_argument('--manifest', required=True, help='pixel checksums of the jp2 files, as sha256sum output')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--kakadu-threads', type=int, help='threads for each kdu_expand')
+    parser.add_argument('--verify-existing', action='store_true', help='check TIFFs already restored')
+    parser.add_argument('--kakadu-base-path', default=DEFAULT_KAKADU_BASE_PATH)
+    parser.add_argument('--exiftool-path', default=DEFAULT_EXIFTOOL_PATH)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    restorer = Restorer(kakadu_base_path=args.kakadu_base_path, exiftool_path=args.exiftool_path,
+                        workers=args.workers, kakadu_threads=args.kakadu_threads,
+                        verify_existing=args.verify_existing)
+    results = restorer.restore(read_manifest(args.manifest), args.jp2_folder, args.tiff_folder)
+    for status in [RESTORED, SKIPPED, FAILED]:
+        print('{0}: {1}'.format(status, sum(1 for result in results if result.status == status)))
+    for result in results:
+        if result.status == FAILED:
+            print('{0}: {1}'.format(result.jp2_filepath, result.error))
+    return 0 if all(result.status != FAILED for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
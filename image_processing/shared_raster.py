@@ -0,0 +1,279 @@
+"""
+Decoding a source image once into a shared memory block, so that stages running in other processes (e.g. making the
+jpg, checksumming the pixels or converting the ICC profile) can all read the pixels without decoding the file again.
+
+The block holds a small header describing the image (mode, size, ICC profile, ...) followed by the pixels in the same
+layout as :func:`PIL.Image.tobytes`. Any process can attach to it by name, and get a NumPy array or PIL image backed
+directly by the shared memory.
+The block is reference counted: each :class:`SharedRaster` (including the one which created it) holds one reference,
+and the block is removed when the last one is released.
+
+Needs Python 3.8 or later for :mod:`multiprocessing.shared_memory`, and numpy for :func:`SharedRaster.as_array`.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import base64
+import json
+import os
+import struct
+import tempfile
+from hashlib import sha256
+
+from PIL import Image
+
+from image_processing.exceptions import ImageProcessingError
+
+MAGIC = b'IPRASTR1'
+_COUNT_FORMAT = '<Q'
+_HEADER_LENGTH_FORMAT = '<I'
+_COUNT_OFFSET = len(MAGIC)
+_HEADER_LENGTH_OFFSET = _COUNT_OFFSET + struct.calcsize(_COUNT_FORMAT)
+_HEADER_OFFSET = _HEADER_LENGTH_OFFSET + struct.calcsize(_HEADER_LENGTH_FORMAT)
+PIXELS_ALIGNMENT = 64
+
+DEFAULT_BAND_HEIGHT = 256
+
+NUMPY_LAYOUTS = {
+    'L': ('uint8', None), 'P': ('uint8', None), 'LA': ('uint8', 2), 'RGB': ('uint8', 3), 'RGBA': ('uint8', 4),
+    'CMYK': ('uint8', 4), 'YCbCr': ('uint8', 3), 'LAB': ('uint8', 3), 'I;16': ('<u2', None),
+    'I;16B': ('>u2', None), 'I': ('<i4', None), 'F': ('<f4', None),
+}
+"""numpy dtype and number of channels (None for a 2D array) of the pixels of each PIL mode"""
+
+
+def _shared_memory_module():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise ImageProcessingError("Shared memory rasters need Python 3.8 or later")
+    return shared_memory
+
+
+def _lock_filepath(name):
+    return os.path.join(tempfile.gettempdir(), '{0}.lock'.format(name.lstrip('/')))
+
+
+def _open_shared_memory(name=None, create=False, size=0):
+    shared_memory = _shared_memory_module()
+    try:
+        # Python 3.13+: the lifetime is managed by the reference count, not by whichever process exits first
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name=name, create=create, size=size)
+        # otherwise each process's resource tracker would remove the block (and warn about a leak) when it exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+def _image_header(image_pil, source_filepath):
+    icc_profile = image_pil.info.get('icc_profile')
+    dpi = image_pil.info.get('dpi')
+    return {
+        'mode': image_pil.mode,
+        'width': image_pil.size[0],
+        'height': image_pil.size[1],
+        'format': image_pil.format,
+        'icc_profile': base64.b64encode(icc_profile).decode('ascii') if icc_profile else None,
+        'dpi': [float(d) for d in dpi] if dpi else None,
+        'source': source_filepath,
+    }
+
+
+class SharedRaster(object):
+    """
+    A decoded image in shared memory. Create one from an image file with :func:`create`, pass its :attr:`name` to
+    other processes, and attach to it there with :func:`attach`.
+    Release each instance (or use it as a context manager) once it's no longer needed. Arrays and images from
+    :func:`as_array` and :func:`as_image` are views of the shared memory, so they shouldn't be used after that.
+    """
+
+    def __init__(self, shared_memory_block):
+        self._block = shared_memory_block
+        self.name = shared_memory_block.name
+        header_length = struct.unpack_from(_HEADER_LENGTH_FORMAT, self._block.buf, _HEADER_LENGTH_OFFSET)[0]
+        self.header = json.loads(bytes(self._block.buf[_HEADER_OFFSET:_HEADER_OFFSET + header_length])
+                                 .decode('utf-8'))
+        self.pixels_offset = _pixels_offset(header_length)
+        self.pixels_length = self.header['pixels_length']
+
+    @classmethod
+    def create(cls, image_filepath, band_height=DEFAULT_BAND_HEIGHT):
+        """
+        Decode an image file into a new shared memory block
+
+        :param image_filepath:
+        :param band_height: the pixels are copied in bands of this many rows, so the image is only held in memory
+            once by Pillow and once in the block, rather than also as one big bytes object
+        :return: :class:`SharedRaster`, holding the first reference to the block
+        """
+        with Image.open(image_filepath) as image_pil:
+            image_pil.load()
+            header = _image_header(image_pil, image_filepath)
+            width, height = image_pil.size
+            row_length = len(image_pil.crop((0, 0, width, 1)).tobytes()) if height else 0
+            header['pixels_length'] = row_length * height
+            header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+            pixels_offset = _pixels_offset(len(header_bytes))
+
+            block = _open_shared_memory(create=True, size=max(pixels_offset + header['pixels_length'], 1))
+            try:
+                block.buf[:len(MAGIC)] = MAGIC
+                struct.pack_into(_COUNT_FORMAT, block.buf, _COUNT_OFFSET, 1)
+                struct.pack_into(_HEADER_LENGTH_FORMAT, block.buf, _HEADER_LENGTH_OFFSET, len(header_bytes))
+                block.buf[_HEADER_OFFSET:_HEADER_OFFSET + len(header_bytes)] = header_bytes
+                position = pixels_offset
+                for top in range(0, height, band_height):
+                    band = image_pil.crop((0, top, width, min(top + band_height, height))).tobytes()
+                    block.buf[position:position + len(band)] = band
+                    position += len(band)
+                # only create the lock file once the block is complete, so a failure doesn't leave it behind
+                open(_lock_filepath(block.name), 'a').close()
+            except BaseException:
+                block.close()
+                block.unlink()
+                raise
+        return cls(block)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to an existing shared raster, e.g. in another process
+
+        :param name: the :attr:`name` of the shared raster
+        :return: :class:`SharedRaster`, holding a new reference to the block
+        """
+        block = _open_shared_memory(name=name)
+        if bytes(block.buf[:len(MAGIC)]) != MAGIC:
+            block.close()
+            raise ImageProcessingError("Shared memory block {0} is not a shared raster".format(name))
+        try:
+            with _RefcountLock(name):
+                count = struct.unpack_from(_COUNT_FORMAT, block.buf, _COUNT_OFFSET)[0]
+                if count == 0:
+                    raise ImageProcessingError("Shared raster {0} has already been released".format(name))
+                struct.pack_into(_COUNT_FORMAT, block.buf, _COUNT_OFFSET, count + 1)
+        except BaseException:
+            block.close()
+            raise
+        return cls(block)
+
+    @property
+    def mode(self):
+        return self.header['mode']
+
+    @property
+    def size(self):
+        return self.header['width'], self.header['height']
+
+    @property
+    def icc_profile(self):
+        """
+        :return: bytes of the image's ICC profile, or None
+        """
+        icc_profile = self.header.get('icc_profile')
+        return base64.b64decode(icc_profile) if icc_profile else None
+
+    @property
+    def reference_count(self):
+        with _RefcountLock(self.name):
+            return struct.unpack_from(_COUNT_FORMAT, self._block.buf, _COUNT_OFFSET)[0]
+
+    def pixels(self):
+        """
+        :return: a read-only memoryview of the pixels, laid out as :func:`PIL.Image.tobytes`
+        """
+        return self._block.buf[self.pixels_offset:self.pixels_offset + self.pixels_length].toreadonly()
+
+    def as_array(self):
+        """
+        :return: a read-only numpy array of the pixels, of shape (height, width) or (height, width, channels),
+            backed by the shared memory
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImageProcessingError("numpy is needed for array views of shared rasters")
+        if self.mode not in NUMPY_LAYOUTS:
+            raise ImageProcessingError("Can't make an array view of a {0} image".format(self.mode))
+        dtype, channels = NUMPY_LAYOUTS[self.mode]
+        width, height = self.size
+        shape = (height, width) if channels is None else (height, width, channels)
+        return numpy.frombuffer(self.pixels(), dtype=dtype).reshape(shape)
+
+    def as_image(self):
+        """
+        :return: a PIL image of the pixels, with the ICC profile. For modes Pillow can map directly (e.g. L, RGBA and
+            CMYK) it's backed by the shared memory; for others, including RGB, Pillow makes a copy
+        """
+        image_pil = Image.frombuffer(self.mode, self.size, self.pixels(), 'raw', self.mode, 0, 1)
+        if self.icc_profile:
+            image_pil.info['icc_profile'] = self.icc_profile
+        if self.header.get('dpi'):
+            image_pil.info['dpi'] = tuple(self.header['dpi'])
+        return image_pil
+
+    def pixel_checksum(self):
+        """
+        :return: the same checksum as :func:`~image_processing.validation.generate_pixel_checksum` gives for the
+            source file, without decoding it again
+        """
+        return sha256(self.pixels()).hexdigest()
+
+    def release(self):
+        """
+        Give up this reference to the block. The block is removed once every reference has been released
+        """
+        if self._block is None:
+            return
+        block = self._block
+        with _RefcountLock(self.name):
+            count = struct.unpack_from(_COUNT_FORMAT, block.buf, _COUNT_OFFSET)[0] - 1
+            struct.pack_into(_COUNT_FORMAT, block.buf, _COUNT_OFFSET, count)
+            if count == 0:
+                block.unlink()
+                os.remove(_lock_filepath(self.name))
+        self._block = None
+        try:
+            block.close()
+        except BufferError:
+            # views of the pixels are still in use. The memory is unmapped once they've been garbage collected
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _pixels_offset(header_length):
+    end_of_header = _HEADER_OFFSET + header_length
+    return -(-end_of_header // PIXELS_ALIGNMENT) * PIXELS_ALIGNMENT
+
+
+class _RefcountLock(object):
+    """
+    An exclusive flock on the raster's lock file, held while its reference count is read or changed
+    """
+
+    def __init__(self, name):
+        self.lock_filepath = _lock_filepath(name)
+        self.lock_file = None
+
+    def __enter__(self):
+        import fcntl
+        try:
+            self.lock_file = open(self.lock_filepath, 'r')
+        except IOError:
+            raise ImageProcessingError("Shared raster lock file {0} is missing: the raster has already been "
+                                       "released".format(self.lock_filepath))
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import fcntl
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
@@ -0,0 +1,214 @@
+"""
+Storage adapters for reading source images from, and writing derivatives to, somewhere other than a local folder.
+:class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator` uses them in
+:func:`~image_processing.derivative_files_generator.DerivativeFilesGenerator.generate_derivatives_from_stored_tiff`.
+
+Objects are identified by keys: '/' separated paths relative to the root of the storage.
+:class:`S3Storage` needs boto3, which is an optional dependency.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import io
+import os
+import tempfile
+
+from image_processing import utils
+from image_processing.exceptions import ImageProcessingError
+
+DEFAULT_READ_BUFFER_SIZE = 256 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_TRANSFER_CONCURRENCY = 4
+
+
+def join_key(prefix, name):
+    """
+    :param prefix: a key prefix, with or without a trailing '/'. Can be empty
+    :param name:
+    :return: the key of name under prefix
+    """
+    prefix = prefix.rstrip('/')
+    return '{0}/{1}'.format(prefix, name) if prefix else name
+
+
+class Storage(object):
+    """
+    The operations a storage adapter needs to support
+    """
+
+    def open(self, key):
+        """
+        :param key:
+        :return: a seekable binary file object for reading the object. Reading the start of it (e.g. to check an
+            image's header) shouldn't need the whole object to be fetched
+        """
+        raise NotImplementedError()
+
+    def size(self, key):
+        """
+        :return: the size of the object in bytes
+        """
+        raise NotImplementedError()
+
+    def download(self, key, local_filepath):
+        """
+        Copy the object to a local file
+        """
+        raise NotImplementedError()
+
+    def upload(self, local_filepath, key):
+        """
+        Copy a local file to the object, replacing it if it exists. The object must never be visible half written
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+class LocalStorage(Storage):
+    """
+    Objects are files under a root folder
+    """
+
+    def __init__(self, root_folder):
+        self.root_folder = os.path.abspath(root_folder)
+
+    def filepath(self, key):
+        """
+        :return: the path of the file the key refers to
+        """
+        filepath = os.path.normpath(os.path.join(self.root_folder, *key.split('/')))
+        if not filepath.startswith(self.root_folder + os.sep):
+            raise ValueError("Key {0} is outside the storage root {1}".format(key, self.root_folder))
+        return filepath
+
+    def open(self, key):
+        return open(self.filepath(key), 'rb')
+
+    def size(self, key):
+        return os.path.getsize(self.filepath(key))
+
+    def download(self, key, local_filepath):
+        utils.place_file(self.filepath(key), local_filepath)
+
+    def upload(self, local_filepath, key):
+        filepath = self.filepath(key)
+        folder = os.path.dirname(filepath)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by another upload at the same time
+                if not os.path.isdir(folder):
+                    raise
+        # copy next to the destination, then rename it into place, so it's never seen half written
+        temp_fd, temp_filepath = tempfile.mkstemp(prefix='.image-processing_upload_', dir=folder)
+        os.close(temp_fd)
+        try:
+            utils.place_file(local_filepath, temp_filepath)
+            os.rename(temp_filepath, filepath)
+        except Exception:
+            os.remove(temp_filepath)
+            raise
+
+    def delete(self, key):
+        os.remove(self.filepath(key))
+
+
+class RangedReader(io.RawIOBase):
+    """
+    A read-only file object over an S3 object, where each read is a ranged GET request.
+    Wrap it in an io.BufferedReader so small reads are served from a buffer, as :func:`S3Storage.open` does.
+    """
+
+    def __init__(self, client, bucket, key, size):
+        super(RangedReader, self).__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.object_size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.object_size + offset
+        else:
+            raise ValueError("Invalid whence {0}".format(whence))
+        if self.position < 0:
+            raise ValueError("Negative seek position {0}".format(self.position))
+        return self.position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.object_size - self.position)
+        if length <= 0:
+            return 0
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                           Range='bytes={0}-{1}'.format(self.position, self.position + length - 1))
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class S3Storage(Storage):
+    """
+    Objects in a bucket of an S3 compatible object store (e.g. AWS S3, MinIO or Ceph).
+    Downloads are made with parallel ranged requests, and files above multipart_threshold are uploaded in parts.
+    """
+
+    def __init__(self, bucket, client=None, endpoint_url=None, read_buffer_size=DEFAULT_READ_BUFFER_SIZE,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, multipart_chunk_size=DEFAULT_MULTIPART_CHUNK_SIZE,
+                 max_concurrency=DEFAULT_TRANSFER_CONCURRENCY):
+        """
+        :param bucket:
+        :param client: a boto3 S3 client. If not given, one is created with the default credentials
+        :param endpoint_url: the URL of the object store, if it isn't AWS S3. Only used if client isn't given
+        :param read_buffer_size: the size of the ranged requests made when reading through :func:`open`
+        :param multipart_threshold: files larger than this are uploaded and downloaded in parts
+        :param multipart_chunk_size: the size of each part
+        :param max_concurrency: the most parts to transfer at once
+        """
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise ImageProcessingError("boto3 is needed to use S3 storage. Install it with pip install boto3")
+        self.bucket = bucket
+        self.client = client if client is not None else boto3.client('s3', endpoint_url=endpoint_url)
+        self.read_buffer_size = read_buffer_size
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunk_size,
+                                              max_concurrency=max_concurrency)
+
+    def open(self, key):
+        return io.BufferedReader(RangedReader(self.client, self.bucket, key, self.size(key)),
+                                 buffer_size=self.read_buffer_size)
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def download(self, key, local_filepath):
+        self.client.download_file(self.bucket, key, local_filepath, Config=self.transfer_config)
+
+    def upload(self, local_filepath, key):
+        # objects only become visible once the upload (or every part of a multipart upload) has completed
+        self.client.upload_file(local_filepath, self.bucket, key, Config=self.transfer_config)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
@@ -1,4 +1,36 @@
+import errno
+import hashlib
 import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+
+from image_processing.exceptions import CommandTimeoutError
+
+# ioctl request number to clone a file's extents on Linux filesystems with copy on write (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+STAGING_FOLDER_PREFIX = '.image-processing_staging_'
+
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+# seconds between the soft CPU time limit (SIGXCPU) and the hard one (SIGKILL)
+CPU_LIMIT_GRACE_SECONDS = 5
+
+ResourceLimits = namedtuple('ResourceLimits', ['max_memory_bytes', 'max_cpu_seconds'])
+ResourceLimits.__new__.__defaults__ = (None, None)
+"""
+Limits applied to external commands with setrlimit: address space (RLIMIT_AS) in bytes, and CPU time (RLIMIT_CPU)
+in seconds. None means unlimited
+"""
+
+_executable_paths = {}
+_executable_versions = {}
+_cache_lock = threading.Lock()
 
 
 def cmd_is_executable(cmd):
@@ -6,11 +38,323 @@ def cmd_is_executable(cmd):
     :param cmd: filepath to an executable.
     :return: True if the command exists (including if it is on the PATH) and can be executed
     """
+    return resolve_executable(cmd) is not None
+
+
+def resolve_executable(cmd):
+    """
+    Find the executable the command refers to.
+    The result is cached for the life of the process (as long as PATH doesn't change), so repeatedly creating
+    wrappers for the same tools doesn't rescan the PATH. Use :func:`clear_executable_cache` if executables have been
+    installed or removed since.
+
+    :param cmd: filepath to an executable.
+    :return: the path of the executable, or None if it doesn't exist or can't be executed
+    """
+    search_path = os.environ.get("PATH", "")
+    key = (cmd, search_path)
+    with _cache_lock:
+        if key in _executable_paths:
+            return _executable_paths[key]
+
     if os.path.isabs(cmd):
         paths = [""]
     else:
-        paths = [""] + os.environ["PATH"].split(os.pathsep)
+        paths = [""] + search_path.split(os.pathsep)
     cmd_paths = [os.path.join(path, cmd) for path in paths]
-    return any(
-        os.path.isfile(cmd_path) and os.access(cmd_path, os.X_OK) for cmd_path in cmd_paths
-    )
\ No newline at end of file
+    executable_path = next(
+        (cmd_path for cmd_path in cmd_paths if os.path.isfile(cmd_path) and os.access(cmd_path, os.X_OK)), None
+    )
+    with _cache_lock:
+        _executable_paths[key] = executable_path
+    return executable_path
+
+
+def get_executable_version(cmd, version_options):
+    """
+    Run the command to get its version output. The output is cached for the life of the process, see
+    :func:`clear_executable_cache`
+
+    :param cmd: filepath to an executable.
+    :param version_options: command line options which make the executable print its version, e.g. ['-ver']
+    :return: the stripped output of the command, or None if it could not be run
+    """
+    key = (resolve_executable(cmd), tuple(version_options))
+    with _cache_lock:
+        if key in _executable_versions:
+            return _executable_versions[key]
+
+    version = None
+    if key[0] is not None:
+        try:
+            process = subprocess.Popen([key[0]] + list(version_options), stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            version = process.communicate()[0].decode('utf-8', 'replace').strip()
+        except OSError:
+            version = None
+    with _cache_lock:
+        _executable_versions[key] = version
+    return version
+
+
+def clear_executable_cache():
+    """
+    Forget the cached executable locations and versions, e.g. after installing a new version of a tool
+    """
+    with _cache_lock:
+        _executable_paths.clear()
+        _executable_versions.clear()
+
+
+def run_command(command_options, timeout=None, resource_limits=None, capture_output=False):
+    """
+    Run a command like subprocess.check_call, but in its own process group, so that if it has to be killed, any
+    processes it started are killed too.
+    Anything still running in the group when the command exits is also killed, so no stray children are left behind.
+
+    :param command_options: the command and its arguments
+    :param timeout: seconds to wait before killing the command. None waits as long as it takes
+    :param resource_limits: :class:`ResourceLimits` for the command. A command over its memory limit fails to
+        allocate memory and exits with an error; one over its CPU time limit is killed, as if it had timed out
+    :param capture_output: return what the command writes to stdout and stderr, instead of letting it through to
+        this process's stdout
+    :return: the command's output as text, if capture_output is True
+    :raises: :class:`~image_processing.exceptions.CommandTimeoutError` if the command timed out or used up its CPU
+        time, subprocess.CalledProcessError if it exited with an error
+    """
+    popen_kwargs = {'stderr': subprocess.STDOUT}
+    if capture_output:
+        popen_kwargs['stdout'] = subprocess.PIPE
+    if resource_limits is not None and any(limit is not None for limit in resource_limits):
+        popen_kwargs['preexec_fn'] = lambda: _start_limited_session(resource_limits)
+    elif sys.version_info[0] >= 3:
+        # unlike preexec_fn, this is safe to use when other threads are running
+        popen_kwargs['start_new_session'] = True
+    else:
+        popen_kwargs['preexec_fn'] = os.setsid
+    process = subprocess.Popen(command_options, **popen_kwargs)
+
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        _kill_process_group(process.pid)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill_on_timeout)
+        timer.daemon = True
+        timer.start()
+    output = None
+    try:
+        if capture_output:
+            # the pipe is closed when the process group is killed, so this doesn't outlast the timeout either
+            output = process.communicate()[0].decode('utf-8', 'replace')
+            return_code = process.returncode
+        else:
+            return_code = process.wait()
+    except BaseException:
+        # e.g. KeyboardInterrupt: don't leave the command running unsupervised
+        _kill_process_group(process.pid)
+        process.wait()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+        _kill_process_group(process.pid)
+
+    if timed_out.is_set():
+        raise CommandTimeoutError('Command timed out after {0} seconds: {1}'.format(timeout, ' '.join(command_options)),
+                                  command=command_options, timeout=timeout)
+    if return_code == -signal.SIGXCPU and resource_limits is not None \
+            and resource_limits.max_cpu_seconds is not None:
+        raise CommandTimeoutError('Command exceeded its CPU time limit of {0} seconds: {1}'
+                                  .format(resource_limits.max_cpu_seconds, ' '.join(command_options)),
+                                  command=command_options, timeout=resource_limits.max_cpu_seconds)
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command_options, output=output)
+    return output
+
+
+def _start_limited_session(resource_limits):
+    """
+    Runs in the child process before the command is executed
+    """
+    import resource
+    os.setsid()
+    if resource_limits.max_memory_bytes is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (resource_limits.max_memory_bytes, resource_limits.max_memory_bytes))
+    if resource_limits.max_cpu_seconds is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (resource_limits.max_cpu_seconds,
+                                                 resource_limits.max_cpu_seconds + CPU_LIMIT_GRACE_SECONDS))
+
+
+def _kill_process_group(process_group_id):
+    try:
+        os.killpg(process_group_id, signal.SIGKILL)
+    except OSError as e:
+        # the group has already exited
+        if e.errno not in (errno.ESRCH, errno.EPERM):
+            raise
+
+
+def file_checksum(filepath, algorithm='sha256'):
+    """
+    :param filepath:
+    :param algorithm: a hashlib algorithm name
+    :return: the hex digest of the file's contents
+    """
+    hash_alg = hashlib.new(algorithm)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''):
+            hash_alg.update(block)
+    return hash_alg.hexdigest()
+
+
+def place_file(source_filepath, destination_filepath, allow_hardlink=False):
+    """
+    Copy a file as cheaply as the filesystem allows: as a reflink (sharing the data blocks until either file is
+    changed), then a hardlink if allowed, then with copy_file_range so the data doesn't pass through user space, and
+    finally with an ordinary copy. The file mode is copied as well.
+    The copy is made in a hidden file next to the destination, which is then renamed over it, so the destination is
+    never seen half written, and a destination which is a hardlink of the source is never truncated.
+
+    :param source_filepath:
+    :param destination_filepath: overwritten if it already exists
+    :param allow_hardlink: hardlinked files share their contents, so changes to either file will affect both.
+        Only use this when the source is never modified in place
+    :return: the method used: 'reflink', 'hardlink', 'copy_file_range' or 'copy'
+    """
+    if allow_hardlink and os.path.exists(destination_filepath) and \
+            os.path.samefile(source_filepath, destination_filepath):
+        # renaming a hardlink over another link to the same file does nothing, so there's nothing to do
+        return 'hardlink'
+    file_descriptor, partial_filepath = tempfile.mkstemp(
+        prefix='.{0}.'.format(os.path.basename(destination_filepath)), suffix='.partial',
+        dir=os.path.dirname(os.path.abspath(destination_filepath)))
+    os.close(file_descriptor)
+    try:
+        method = _copy_file(source_filepath, partial_filepath, allow_hardlink)
+        os.rename(partial_filepath, destination_filepath)
+    except BaseException:
+        if os.path.lexists(partial_filepath):
+            os.remove(partial_filepath)
+        raise
+    return method
+
+
+def _copy_file(source_filepath, destination_filepath, allow_hardlink):
+    if _reflink(source_filepath, destination_filepath):
+        method = 'reflink'
+    elif allow_hardlink and _hardlink(source_filepath, destination_filepath):
+        return 'hardlink'
+    elif _copy_file_range(source_filepath, destination_filepath):
+        method = 'copy_file_range'
+    else:
+        shutil.copyfile(source_filepath, destination_filepath)
+        method = 'copy'
+    shutil.copymode(source_filepath, destination_filepath)
+    return method
+
+
+def _reflink(source_filepath, destination_filepath):
+    try:
+        import fcntl
+    except ImportError:  # not on a POSIX platform
+        return False
+    with open(source_filepath, 'rb') as source_file:
+        with open(destination_filepath, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                return True
+            except (IOError, OSError):
+                return False
+
+
+def _hardlink(source_filepath, destination_filepath):
+    try:
+        if os.path.lexists(destination_filepath):
+            os.remove(destination_filepath)
+        os.link(source_filepath, destination_filepath)
+        return True
+    except (IOError, OSError, AttributeError):
+        return False
+
+
+def _copy_file_range(source_filepath, destination_filepath):
+    if not hasattr(os, 'copy_file_range'):  # python < 3.8, or not Linux
+        return False
+    with open(source_filepath, 'rb') as source_file:
+        with open(destination_filepath, 'wb') as destination_file:
+            remaining = os.fstat(source_file.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError:
+                # e.g. not supported between these filesystems, so start again with an ordinary copy
+                destination_file.truncate(0)
+                return False
+    return True
+
+
+class StagingFolder(object):
+    """
+    A hidden folder inside an output folder for writing files into, so they only appear in the output folder once
+    they're complete. Files are published with an atomic rename, and anything left unpublished (e.g. because
+    generating or validating it failed) is deleted when the staging folder is closed.
+    Use as a context manager:
+    ::
+
+        with StagingFolder(output_folder) as staging_folder:
+            staged_filepath = staging_folder.filepath('full.jp2')
+            ...
+            output_filepaths = staging_folder.publish([staged_filepath])
+    """
+
+    def __init__(self, output_folder):
+        """
+        :param output_folder: the folder files will be published to. The staging folder is created inside it, so
+            it's on the same filesystem and renames are atomic
+        """
+        self.output_folder = output_folder
+        self.staging_folder = None
+
+    def __enter__(self):
+        self.staging_folder = tempfile.mkdtemp(prefix=STAGING_FOLDER_PREFIX, dir=self.output_folder)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        shutil.rmtree(self.staging_folder, ignore_errors=True)
+        self.staging_folder = None
+
+    def filepath(self, filename):
+        """
+        :param filename:
+        :return: the path to write the file to before it's published
+        """
+        return os.path.join(self.staging_folder, filename)
+
+    def publish(self, staged_filepaths):
+        """
+        Move the staged files into the output folder, replacing any existing files with the same names
+
+        :param staged_filepaths: files (or folders) in the staging folder, in the order they should be published
+        :return: the published filepaths, in the same order
+        """
+        published_filepaths = []
+        for staged_filepath in staged_filepaths:
+            published_filepath = os.path.join(self.output_folder, os.path.basename(staged_filepath))
+            if os.path.isdir(staged_filepath) and os.path.isdir(published_filepath):
+                # a folder can't be renamed over one which isn't empty, so move the old one out of the way first
+                replaced_filepath = tempfile.mkdtemp(prefix=STAGING_FOLDER_PREFIX, dir=self.output_folder)
+                os.rename(published_filepath, os.path.join(replaced_filepath, 'replaced'))
+                os.rename(staged_filepath, published_filepath)
+                shutil.rmtree(replaced_filepath, ignore_errors=True)
+                published_filepaths.append(published_filepath)
+                continue
+            os.rename(staged_filepath, published_filepath)
+            published_filepaths.append(published_filepath)
+        return published_filepaths
@@ -2,9 +2,6 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
-from jpylyzer.jpylyzer import checkOneFile
-from xml.etree import ElementTree
-from xml.dom import minidom
 from PIL import Image, ImageSequence
 from image_processing import exceptions
 import logging
@@ -26,6 +23,11 @@ def validate_jp2(image_file, output_file=None):
     :param output_file: if not None, write the jpylyzer xml output to this file
     :type image_file: str
     """
+    # jpylyzer and minidom are slow to import, and not needed by callers that don't validate jp2s
+    from jpylyzer.jpylyzer import checkOneFile
+    from xml.etree import ElementTree
+    from xml.dom import minidom
+
     logger = logging.getLogger(__name__)
     jp2_element = checkOneFile(image_file)
     success = jp2_element.findtext('isValidJP2') == 'True'
@@ -66,12 +68,16 @@ def _to_bytes_generator(pil_image, min_buffer_size=65536):
         raise RuntimeError("encoder error {0} in tobytes when reading image pixel data".format(signal))
 
 
-def generate_pixel_checksum(image_filepath):
+def generate_pixel_checksum(image_filepath, shared_raster=None):
     """
     Generate a format-independent checksum based on the image's pixel values.
 
     :param image_filepath:
+    :param shared_raster: :class:`~image_processing.shared_raster.SharedRaster` of the image. If given, the checksum is
+        taken from its pixels instead of decoding the file again
     """
+    if shared_raster is not None:
+        return shared_raster.pixel_checksum()
     with Image.open(image_filepath) as pil_image:
         return generate_pixel_checksum_from_pil_image(pil_image)
 
@@ -0,0 +1,359 @@
+"""
+A daemon which converts TIFFs as they're dropped into hot folders, e.g. by scanning stations. Run it as a script:
+::
+
+    python -m image_processing.watch_folder --output-folder /data/derivatives --workers 4 /data/hot_folder
+
+Folders are watched with inotify on Linux, falling back to polling. A file is only picked up once its size and
+modification time have stopped changing, so files still being copied in are left alone. Each file's derivatives are
+generated in a folder named after it in the output folder, and then the source is moved into the ``done`` folder, or
+into the ``failed`` folder (with a ``.error.txt`` file describing the error) if it couldn't be converted.
+No more files are started while the output folder or scratch space is nearly full.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import stat
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from image_processing import derivative_files_generator, admission
+
+DEFAULT_WORKERS = 2
+DEFAULT_SETTLE_SECONDS = 10
+DEFAULT_POLL_SECONDS = 5
+DEFAULT_MIN_FREE_BYTES = 10 * 1024 ** 3
+DONE_FOLDER_NAME = 'done'
+FAILED_FOLDER_NAME = 'failed'
+SOURCE_EXTENSIONS = ['.tif', '.tiff']
+
+# from sys/inotify.h
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+
+class PollingWatcher(object):
+    """
+    Wakes up the daemon at a fixed interval to rescan the folders
+    """
+
+    def __init__(self, folders, poll_seconds=DEFAULT_POLL_SECONDS):
+        self.folders = folders
+        self.poll_seconds = poll_seconds
+
+    def wait(self, timeout):
+        """
+        Wait until something may have changed in the folders
+
+        :param timeout: the longest time to wait, in seconds
+        """
+        time.sleep(min(timeout, self.poll_seconds))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Wakes up the daemon as soon as a file is finished being written to, or moved into, one of the folders.
+    Only available on Linux.
+    """
+
+    def __init__(self, folders):
+        library_path = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(library_path, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for folder in folders:
+            watch_descriptor = libc.inotify_add_watch(self.fd, os.path.abspath(folder).encode('utf-8'),
+                                                      _IN_CLOSE_WRITE | _IN_MOVED_TO)
+            if watch_descriptor < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "Could not watch {0}".format(folder))
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # the events themselves don't matter, as the folders are rescanned
+            try:
+                while os.read(self.fd, 64 * 1024):
+                    pass
+            except OSError:  # EAGAIN once the events are drained
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(folders, use_inotify=True, poll_seconds=DEFAULT_POLL_SECONDS):
+    """
+    :return: an :class:`InotifyWatcher` if possible, otherwise a :class:`PollingWatcher`
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError, TypeError) as e:
+            logging.getLogger(__name__).info('Falling back to polling, as inotify is not available: {0}'.format(e))
+    return PollingWatcher(folders, poll_seconds=poll_seconds)
+
+
+def free_bytes(folder):
+    """
+    :return: the bytes available to unprivileged users on the folder's filesystem
+    """
+    stats = os.statvfs(folder)
+    return stats.f_bavail * stats.f_frsize
+
+
+def move_to_folder(filepath, folder):
+    """
+    Atomically move a file into a folder on the same filesystem, without replacing an existing file of the same name
+
+    :return: the new filepath
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    filename = os.path.basename(filepath)
+    destination = os.path.join(folder, filename)
+    if os.path.exists(destination):
+        base, extension = os.path.splitext(filename)
+        destination = os.path.join(folder, '{0}_{1}{2}'.format(base, time.strftime('%Y%m%dT%H%M%S'), extension))
+    os.rename(filepath, destination)
+    return destination
+
+
+class WatchFolderIngest(object):
+    """
+    Feeds files from hot folders into a :class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator`
+    with a bounded number of workers
+    """
+
+    def __init__(self, generator, watch_folders, output_folder, workers=DEFAULT_WORKERS,
+                 settle_seconds=DEFAULT_SETTLE_SECONDS, min_free_bytes=DEFAULT_MIN_FREE_BYTES, scratch_folder=None,
+                 use_inotify=True, poll_seconds=DEFAULT_POLL_SECONDS, generate_kwargs=None, memory_budget=None,
+                 memory_model=None):
+        """
+        :param generator: :class:`~image_processing.derivative_files_generator.DerivativeFilesGenerator`
+        :param watch_folders: list of folders to watch. Each has its own done and failed folders inside it
+        :param output_folder: each source file's derivatives are created in a folder named after it in here
+        :param workers: the most files to convert at once
+        :param settle_seconds: how long a file's size and modification time must be unchanged before it's converted
+        :param min_free_bytes: don't start converting a file unless the output folder and the scratch folder
+            both have at least this much free space
+        :param scratch_folder: the folder temporary files are written to. Defaults to the system temporary folder
+        :param use_inotify: watch the folders with inotify if it's available. Otherwise poll them
+        :param poll_seconds: how often to rescan the folders when polling
+        :param generate_kwargs: dict of other arguments for generate_derivatives_from_tiff, e.g. include_tiff
+        :param memory_budget: if set, only start files whose estimated peak memory fits into what's left of this many
+            bytes. See :mod:`~image_processing.admission`
+        :param memory_model: :class:`~image_processing.admission.MemoryModel` for the estimates
+        """
+        self.generator = generator
+        self.watch_folders = [os.path.abspath(folder) for folder in watch_folders]
+        self.output_folder = output_folder
+        self.workers = workers
+        self.settle_seconds = settle_seconds
+        self.min_free_bytes = min_free_bytes
+        self.scratch_folder = scratch_folder or tempfile.gettempdir()
+        self.use_inotify = use_inotify
+        self.poll_seconds = poll_seconds
+        self.generate_kwargs = generate_kwargs or {}
+        self.memory_model = memory_model or admission.MemoryModel()
+        self.admission_controller = None if memory_budget is None else admission.AdmissionController(memory_budget)
+        self.log = logging.getLogger(__name__)
+
+        self._file_states = {}
+        self._in_progress = set()
+        self._memory_estimates = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._stop = threading.Event()
+
+    def find_ready_files(self, now=None):
+        """
+        Scan the watched folders for source files which have stopped changing
+
+        :param now: the current time, for testing
+        :return: list of filepaths, oldest first
+        """
+        now = time.time() if now is None else now
+        candidates = []
+        for folder in self.watch_folders:
+            for filename in sorted(os.listdir(folder)):
+                if not filename.startswith('.') and os.path.splitext(filename)[1].lower() in SOURCE_EXTENSIONS:
+                    candidates.append(os.path.join(folder, filename))
+
+        ready = []
+        with self._lock:
+            seen = set()
+            for filepath in candidates:
+                try:
+                    stats = os.stat(filepath)
+                except OSError:  # moved or deleted since the folder was listed
+                    continue
+                if not stat.S_ISREG(stats.st_mode) or filepath in self._in_progress:
+                    continue
+                seen.add(filepath)
+                state = (stats.st_size, stats.st_mtime)
+                previous_state, stable_since = self._file_states.get(filepath, (None, None))
+                if state != previous_state:
+                    self._file_states[filepath] = (state, now)
+                elif now - stable_since >= self.settle_seconds:
+                    ready.append((stats.st_mtime, filepath))
+            for filepath in set(self._file_states) - seen:
+                del self._file_states[filepath]
+        return [filepath for _, filepath in sorted(ready)]
+
+    def has_capacity(self):
+        """
+        :return: True if another file can be started: there's a free worker, and enough free disk space
+        """
+        with self._lock:
+            if len(self._in_progress) >= self.workers:
+                return False
+        for folder in [self.output_folder, self.scratch_folder]:
+            available = free_bytes(folder)
+            if available < self.min_free_bytes:
+                self.log.warning('Not starting any more conversions: only {0} bytes free in {1}'
+                                 .format(available, folder))
+                return False
+        return True
+
+    def process_file(self, filepath):
+        """
+        Generate the derivatives for one source file, then move it into the done or failed folder
+
+        :return: True if it was converted
+        """
+        folder = os.path.dirname(filepath)
+        output_folder = os.path.join(self.output_folder, os.path.splitext(os.path.basename(filepath))[0])
+        try:
+            if not os.path.isdir(output_folder):
+                os.makedirs(output_folder)
+            self.generator.generate_derivatives_from_tiff(filepath, output_folder, **self.generate_kwargs)
+        except Exception as e:
+            self.log.error('Failed to convert {0}: {1!r}'.format(filepath, e))
+            failed_filepath = move_to_folder(filepath, os.path.join(folder, FAILED_FOLDER_NAME))
+            with open(failed_filepath + '.error.txt', 'w') as error_file:
+                error_file.write(traceback.format_exc())
+            return False
+        else:
+            move_to_folder(filepath, os.path.join(folder, DONE_FOLDER_NAME))
+            self.log.info('Converted {0} to {1}'.format(filepath, output_folder))
+            return True
+        finally:
+            with self._lock:
+                self._in_progress.discard(filepath)
+                self._file_states.pop(filepath, None)
+                estimate = self._memory_estimates.pop(filepath, None)
+            if estimate is not None:
+                self.admission_controller.release(estimate)
+
+    def submit_ready_files(self):
+        """
+        Start converting as many ready files as there's capacity for.
+        With a memory budget, the largest ready files that fit into it are started first, so smaller files fill the
+        space around them.
+
+        :return: the number of files started
+        """
+        ready_files = self.find_ready_files()
+        if self.admission_controller is not None:
+            estimates = []
+            for filepath in ready_files:
+                try:
+                    estimates.append((filepath, self.memory_model.estimate_file(filepath)))
+                except IOError as e:
+                    # the failure will be recorded when it's processed
+                    self.log.warning('Could not read the header of {0}: {1!r}'.format(filepath, e))
+                    estimates.append((filepath, 0))
+            ready_files = [filepath for filepath, _ in sorted(estimates, key=lambda pair: pair[1], reverse=True)]
+            estimates = dict(estimates)
+
+        started = 0
+        for filepath in ready_files:
+            if not self.has_capacity():
+                break
+            if self.admission_controller is not None:
+                if not self.admission_controller.try_admit(estimates[filepath]):
+                    continue
+                with self._lock:
+                    self._memory_estimates[filepath] = estimates[filepath]
+            with self._lock:
+                self._in_progress.add(filepath)
+            self._pool.apply_async(self.process_file, (filepath,))
+            started += 1
+        return started
+
+    def run(self):
+        """
+        Watch the folders until :func:`stop` is called, then wait for the conversions in progress to finish
+        """
+        watcher = create_watcher(self.watch_folders, use_inotify=self.use_inotify, poll_seconds=self.poll_seconds)
+        self._pool = ThreadPool(processes=self.workers)
+        self.log.info('Watching {0}'.format(', '.join(self.watch_folders)))
+        try:
+            while not self._stop.is_set():
+                self.submit_ready_files()
+                # files waiting to settle need rescanning before inotify would wake us up again
+                with self._lock:
+                    pending = bool(self._file_states)
+                watcher.wait(min(self.settle_seconds, self.poll_seconds) if pending else self.poll_seconds)
+        finally:
+            watcher.close()
+            self._pool.close()
+            self._pool.join()
+            self.log.info('Stopped watching {0}'.format(', '.join(self.watch_folders)))
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert TIFFs dropped into hot folders')
+    parser.add_argument('watch_folders', nargs='+')
+    parser.add_argument('--output-folder', required=True)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--settle-seconds', type=float, default=DEFAULT_SETTLE_SECONDS)
+    parser.add_argument('--min-free-mb', type=int, default=DEFAULT_MIN_FREE_BYTES // 1024 ** 2)
+    parser.add_argument('--memory-budget-mb', type=int, help='limit the estimated peak memory of running conversions')
+    parser.add_argument('--scratch-folder', help='defaults to the system temporary folder')
+    parser.add_argument('--poll', action='store_true', help='poll the folders instead of using inotify')
+    parser.add_argument('--kakadu-base-path', default=derivative_files_generator.DEFAULT_KAKADU_BASE_PATH)
+    parser.add_argument('--include-tiff', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.scratch_folder:
+        tempfile.tempdir = args.scratch_folder
+    generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=args.kakadu_base_path)
+    ingest = WatchFolderIngest(generator, args.watch_folders, args.output_folder, workers=args.workers,
+                               settle_seconds=args.settle_seconds, min_free_bytes=args.min_free_mb * 1024 ** 2,
+                               scratch_folder=args.scratch_folder, use_inotify=not args.poll,
+                               generate_kwargs={'include_tiff': args.include_tiff},
+                               memory_budget=args.memory_budget_mb * 1024 ** 2 if args.memory_budget_mb else None)
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_number, lambda *_: ingest.stop())
+    ingest.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
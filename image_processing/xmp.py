@@ -0,0 +1,158 @@
+"""
+Reading XMP packets and ICC profiles embedded in TIFF and JPEG files without exiftool, for images where exiftool's
+tag translation wouldn't add anything: i.e. all their metadata is already in the XMP packet.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import io
+import re
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+from PIL import Image, ImageCms
+
+from image_processing import jp2
+
+XMP_APP1_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+PHOTOSHOP_NAMESPACE = b'http://ns.adobe.com/photoshop/1.0/'
+
+TIFF_XMP_TAG = 700
+TIFF_ICC_PROFILE_TAG = 34675
+
+TIFF_TAGS_IN_XMP = {
+    256: b'tiff:ImageWidth', 257: b'tiff:ImageLength', 258: b'tiff:BitsPerSample', 259: b'tiff:Compression',
+    262: b'tiff:PhotometricInterpretation', 270: b'dc:description', 271: b'tiff:Make', 272: b'tiff:Model',
+    274: b'tiff:Orientation', 277: b'tiff:SamplesPerPixel', 282: b'tiff:XResolution', 283: b'tiff:YResolution',
+    284: b'tiff:PlanarConfiguration', 296: b'tiff:ResolutionUnit', 301: b'tiff:TransferFunction',
+    305: b'xmp:CreatorTool', 306: b'xmp:ModifyDate', 315: b'dc:creator', 318: b'tiff:WhitePoint',
+    319: b'tiff:PrimaryChromaticities', 529: b'tiff:YCbCrCoefficients', 530: b'tiff:YCbCrSubSampling',
+    531: b'tiff:YCbCrPositioning', 532: b'tiff:ReferenceBlackWhite', 33432: b'dc:rights',
+}
+"""Baseline TIFF tags which exiftool copies into XMP, and the XMP property they're copied to"""
+
+TIFF_TAGS_NOT_IN_XMP = {
+    254, 266, 273, 278, 279, 280, 281, 292, 293, 297, 317, 320, 322, 323, 324, 325, 338, 339,
+    TIFF_XMP_TAG, TIFF_ICC_PROFILE_TAG,
+}
+"""TIFF tags describing the image data layout, which exiftool doesn't copy into XMP"""
+
+JPEG_SEGMENTS_NOT_IN_XMP = {'APP2', 'APP14'}
+"""JPEG segments (ICC profile and Adobe colour transform) which exiftool doesn't copy into XMP"""
+
+EmbeddedMetadata = namedtuple('EmbeddedMetadata', ['xmp', 'icc_profile', 'untranslated'])
+"""
+The XMP packet (bytes or None) and ICC profile (bytes or None) embedded in an image, and a list of the other metadata
+(TIFF tags or JPEG segments) which would need translating into XMP by exiftool
+"""
+
+_XPACKET_BEGIN_PATTERN = re.compile(br'<\?xpacket begin=')
+_DESCRIPTION_PATTERN = re.compile(br' *<rdf:Description[^>]*?xmlns:(?P<prefix>[\w.-]+)=[^>]*>.*?</rdf:Description>\n',
+                                  re.DOTALL)
+
+
+def read_embedded_metadata(image_filepath):
+    """
+    :param image_filepath: a TIFF or JPEG file
+    :return: :class:`EmbeddedMetadata`
+    """
+    with Image.open(image_filepath) as image_pil:
+        if image_pil.format == 'TIFF':
+            return _read_tiff_metadata(image_pil)
+        if image_pil.format == 'JPEG':
+            return _read_jpeg_metadata(image_pil)
+        return EmbeddedMetadata(xmp=None, icc_profile=image_pil.info.get('icc_profile'),
+                                untranslated=[image_pil.format])
+
+
+def _read_tiff_metadata(image_pil):
+    tags = image_pil.tag_v2
+    xmp_packet = tags.get(TIFF_XMP_TAG)
+    if xmp_packet is not None:
+        xmp_packet = bytes(xmp_packet)
+    untranslated = []
+    for tag in sorted(tags.keys()):
+        if tag in TIFF_TAGS_NOT_IN_XMP:
+            continue
+        xmp_property = TIFF_TAGS_IN_XMP.get(tag)
+        if xmp_property is None or xmp_packet is None or not has_property(xmp_packet, xmp_property):
+            untranslated.append(tag)
+    return EmbeddedMetadata(xmp=xmp_packet, icc_profile=image_pil.info.get('icc_profile'), untranslated=untranslated)
+
+
+def _read_jpeg_metadata(image_pil):
+    xmp_packet = None
+    untranslated = []
+    for marker, data in image_pil.applist:
+        if marker == 'APP1' and data.startswith(XMP_APP1_HEADER) and xmp_packet is None:
+            xmp_packet = data[len(XMP_APP1_HEADER):]
+        elif marker not in JPEG_SEGMENTS_NOT_IN_XMP:
+            # includes EXIF, JFIF, IPTC and extended XMP segments
+            untranslated.append(marker)
+    return EmbeddedMetadata(xmp=xmp_packet, icc_profile=image_pil.info.get('icc_profile'), untranslated=untranslated)
+
+
+def has_property(xmp_packet, xmp_property):
+    """
+    :param xmp_packet: bytes
+    :param xmp_property: qualified property name, e.g. b'tiff:ImageWidth'
+    :return: True if the property is set in the packet, as an element or an attribute
+    """
+    return re.search(b'<' + re.escape(xmp_property) + b'[ >]|\\s' + re.escape(xmp_property) + b'=',
+                     xmp_packet) is not None
+
+
+def get_icc_profile_name(icc_profile):
+    """
+    :param icc_profile: bytes
+    :return: the profile description, as exiftool's ICC_Profile:ProfileDescription
+    """
+    return ImageCms.getProfileDescription(ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))).strip()
+
+
+def set_icc_profile_name(xmp_packet, profile_name):
+    """
+    Set photoshop:ICCProfile in an XMP packet serialised by exiftool, laid out the same way exiftool would write it:
+    one rdf:Description per namespace in alphabetical order, with properties in alphabetical order
+
+    :param xmp_packet: bytes
+    :param profile_name: text
+    :return: the XMP packet
+    """
+    value = escape(profile_name).encode('utf-8')
+    property_pattern = re.compile(br'<photoshop:ICCProfile>[^<]*</photoshop:ICCProfile>')
+    if property_pattern.search(xmp_packet):
+        return property_pattern.sub(lambda _: b'<photoshop:ICCProfile>' + value + b'</photoshop:ICCProfile>',
+                                    xmp_packet)
+    new_property = b'  <photoshop:ICCProfile>' + value + b'</photoshop:ICCProfile>\n'
+
+    for description in _DESCRIPTION_PATTERN.finditer(xmp_packet):
+        if description.group('prefix') == b'photoshop':
+            properties = re.finditer(br'  <photoshop:(\w+)', description.group(0))
+            insert_at = next((match.start() for match in properties if match.group(1) > b'ICCProfile'),
+                             description.group(0).rindex(b' </rdf:Description>'))
+            insert_at += description.start()
+            return xmp_packet[:insert_at] + new_property + xmp_packet[insert_at:]
+
+    new_description = (b" <rdf:Description rdf:about=''\n  xmlns:photoshop='" + PHOTOSHOP_NAMESPACE + b"'>\n" +
+                       new_property + b' </rdf:Description>\n\n')
+    following = next((description for description in _DESCRIPTION_PATTERN.finditer(xmp_packet)
+                      if description.group('prefix') > b'photoshop'), None)
+    insert_at = following.start() if following is not None else xmp_packet.rindex(b'</rdf:RDF>')
+    return xmp_packet[:insert_at] + new_description + xmp_packet[insert_at:]
+
+
+def to_sidecar(xmp_packet):
+    """
+    :param xmp_packet: an embedded XMP packet
+    :return: the packet as exiftool writes it to an .xmp file, without padding
+    """
+    return jp2.pad_xmp_packet(xmp_packet, padding=b'')
+
+
+def is_exiftool_packet(xmp_packet):
+    """
+    :return: True if the packet was serialised by exiftool, so it's already laid out as exiftool would write it
+    """
+    return _XPACKET_BEGIN_PATTERN.search(xmp_packet) is not None and b"x:xmptk='Image::ExifTool" in xmp_packet
@@ -12,5 +12,10 @@ setup(name='image_processing',
       author='Mel Mason',
       author_email='mel.mason@bodleian.ox.ac.uk',
       packages=['image_processing'],
-      install_requires=['Pillow', 'jpylyzer']
+      install_requires=['Pillow', 'jpylyzer'],
+      extras_require={
+          '16bit': ['numpy', 'tifffile'],
+          's3': ['boto3'],
+          'fingerprint': ['numpy'],
+      }
 )
@@ -0,0 +1,73 @@
+import threading
+import time
+
+from image_processing import admission
+from .test_utils import filepaths
+
+
+def header(width, height, compressed=False):
+    return admission.ImageHeader(width=width, height=height, channels=3, bits_per_sample=8, mode='RGB',
+                                 compressed=compressed)
+
+
+class TestAdmission(object):
+    def test_reads_image_header(self):
+        tiff_header = admission.read_image_header(filepaths.STANDARD_TIF)
+        assert tiff_header == header(1350, 1020)
+        assert admission.read_image_header(filepaths.STANDARD_JPG).compressed
+        assert admission.read_image_header(filepaths.BILEVEL_TIF).bits_per_sample == 1
+
+    def test_fits_memory_model(self):
+        model = admission.MemoryModel(base_bytes=100, per_byte=2.5, compressed_per_byte=1.5)
+        samples = [(header(w, h, compressed), model.estimate(header(w, h, compressed)))
+                   for w, h, compressed in [(10, 10, False), (100, 50, False), (200, 300, True), (40, 70, True)]]
+        fitted = admission.MemoryModel.fit(samples)
+        assert abs(fitted.base_bytes - 100) < 1
+        assert abs(fitted.per_byte - 2.5) < 0.001
+        assert abs(fitted.compressed_per_byte - 1.5) < 0.001
+
+    def test_admits_jobs_within_budget(self):
+        controller = admission.AdmissionController(100)
+        assert controller.try_admit(150)  # nothing else is running, so it can't wait forever
+        assert not controller.try_admit(10)
+        controller.release(150)
+        assert controller.try_admit(60)
+        assert controller.try_admit(40)
+        assert not controller.admit(1, timeout=0.01)
+        controller.release(40)
+        assert controller.admit(30, timeout=0.01)
+
+    def test_packs_small_jobs_around_large_ones(self):
+        chosen = admission.first_fit_decreasing([('a', 50), ('b', 80), ('c', 20), ('d', 30)], 100)
+        assert chosen == [('b', 80), ('c', 20)]
+
+    def test_runs_jobs_within_budget(self):
+        estimates = {filepaths.STANDARD_TIF: 60, filepaths.GREYSCALE_TIF: 50, filepaths.BILEVEL_TIF: 30,
+                     filepaths.SMALL_TIF: 10}
+
+        class FixedModel(admission.MemoryModel):
+            def estimate_file(self, image_filepath):
+                return estimates[image_filepath]
+
+        lock = threading.Lock()
+        running = []
+        started = []
+        peaks = []
+
+        def job(filepath):
+            with lock:
+                running.append(filepath)
+                started.append(filepath)
+                peaks.append(sum(estimates[f] for f in running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(filepath)
+            return filepath
+
+        results = admission.run_jobs(list(estimates), job, memory_budget=100, max_workers=3,
+                                     memory_model=FixedModel())
+        assert sorted(result.result for result in results) == sorted(estimates)
+        assert all(result.error is None for result in results)
+        assert max(peaks) <= 100
+        # the largest job starts first, with the smaller ones packed around it
+        assert started[0] == filepaths.STANDARD_TIF
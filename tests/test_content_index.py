@@ -0,0 +1,72 @@
+import os
+import shutil
+import threading
+
+from image_processing import content_index
+from image_processing.content_index import ContentIndex
+from .test_utils import temporary_folder, filepaths
+
+RECIPE = {'kakadu_compress_options': ['Clevels=6'], 'kakadu_version': '7.10'}
+
+
+class TestContentIndex(object):
+    def test_content_key_depends_on_pixels_profile_and_recipe(self):
+        key = content_index.content_key(filepaths.STANDARD_TIF, RECIPE, pixel_checksum='abc')
+        assert key == content_index.content_key(filepaths.STANDARD_TIF, RECIPE, pixel_checksum='abc')
+        assert key != content_index.content_key(filepaths.STANDARD_TIF, RECIPE, pixel_checksum='abd')
+        assert key != content_index.content_key(filepaths.STANDARD_TIF, dict(RECIPE, kakadu_version='8.0'),
+                                                pixel_checksum='abc')
+        # without an ICC profile
+        assert key != content_index.content_key(filepaths.NO_PROFILE_TIF, RECIPE, pixel_checksum='abc')
+
+    def test_adds_and_looks_up_files(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.abspath(os.path.join(output_folder, 'full_lossless.jp2'))
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            index = ContentIndex(os.path.join(output_folder, 'index.sqlite'))
+            assert index.lookup('key') is None
+            index.add('key', jp2_filepath, source_filepath=filepaths.STANDARD_TIF)
+            assert index.lookup('key') == jp2_filepath
+            assert len(index) == 1
+
+            # persisted for other workers
+            assert ContentIndex(os.path.join(output_folder, 'index.sqlite')).lookup('key') == jp2_filepath
+
+    def test_drops_modified_files(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.abspath(os.path.join(output_folder, 'full_lossless.jp2'))
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            index = ContentIndex(os.path.join(output_folder, 'index.sqlite'))
+            index.add('key', jp2_filepath)
+            with open(jp2_filepath, 'r+b') as jp2_file:
+                jp2_file.seek(-1, os.SEEK_END)
+                jp2_file.write(b'\x00')
+            assert index.lookup('key', verify_checksum=False) == jp2_filepath
+            assert index.lookup('key') is None
+            assert len(index) == 0
+
+    def test_concurrent_updates(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.abspath(os.path.join(output_folder, 'full_lossless.jp2'))
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            database_filepath = os.path.join(output_folder, 'index.sqlite')
+            ContentIndex(database_filepath)
+            errors = []
+
+            def add_keys(worker):
+                try:
+                    # each worker has its own index, as separate processes would
+                    index = ContentIndex(database_filepath)
+                    for i in range(20):
+                        index.add('{0}-{1}'.format(worker, i), jp2_filepath)
+                    index.close()
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=add_keys, args=(worker,)) for worker in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert errors == []
+            assert len(ContentIndex(database_filepath)) == 80
@@ -22,6 +22,18 @@ class TestImageFormatConverter(object):
             assert os.path.isfile(tiff_file)
             assert image_files_match(tiff_file, filepaths.TIF_FROM_STANDARD_JPG)
 
+    def test_extracts_frame(self):
+        with temporary_folder() as output_folder:
+            frame_file = os.path.join(output_folder, 'frame.tif')
+            conversion.Converter().extract_frame(filepaths.STANDARD_TIF, 1, frame_file)
+            with Image.open(frame_file) as frame_pil, Image.open(filepaths.STANDARD_TIF) as tiff_pil:
+                tiff_pil.seek(1)
+                assert frame_pil.size == tiff_pil.size
+                assert getattr(frame_pil, 'n_frames', 1) == 1
+                assert frame_pil.info['icc_profile'] == tiff_pil.info['icc_profile']
+                assert validation.generate_pixel_checksum_from_pil_image(frame_pil) == \
+                    validation.generate_pixel_checksum_from_pil_image(tiff_pil)
+
     def test_converts_tif_to_jpeg2000(self):
         with temporary_folder() as output_folder:
             output_file = os.path.join(output_folder, 'output.jp2')
@@ -30,6 +42,19 @@ class TestImageFormatConverter(object):
             assert os.path.isfile(output_file)
             assert image_files_match(output_file, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
 
+    def test_collects_kakadu_stats(self):
+        with temporary_folder() as output_folder:
+            output_file = os.path.join(output_folder, 'output.jp2')
+            stats = get_kakadu().kdu_compress(filepaths.STANDARD_TIF, output_file,
+                                              kakadu_options=kakadu.DEFAULT_COMPRESS_OPTIONS + kakadu.LOSSLESS_OPTIONS,
+                                              collect_stats=True)
+            assert image_files_match(output_file, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+        assert stats.command == 'kdu_compress'
+        assert stats.tile_count == 6
+        assert stats.code_block_count == 1242
+        assert len(stats.layer_bitrates) == 6
+        assert stats.cpu_seconds is not None
+
     def test_converts_tif_to_jpeg(self):
         with temporary_folder() as output_folder:
             output_file = os.path.join(output_folder, 'output.jpg')
@@ -73,11 +98,70 @@ class TestImageFormatConverter(object):
                 prf = ImageCms.ImageCmsProfile(f)
                 assert prf.profile.profile_description == "sRGB v4 ICC preference perceptual intent beta"
 
-    def test_icc_conversion_catches_16_bit_errors(self):
+    def test_icc_conversion_of_batch(self):
         with temporary_folder() as output_folder:
+            output_files = [os.path.join(output_folder, 'output{0}.tif'.format(i)) for i in range(2)]
+            cache = conversion.IccTransformCache()
+            converter = conversion.Converter(icc_transform_cache=cache)
+            converter.convert_icc_profiles([(filepaths.STANDARD_TIF, output_file) for output_file in output_files],
+                                           filepaths.SRGB_ICC_PROFILE)
+            assert len(cache) == 1
+            for output_file in output_files:
+                with Image.open(output_file) as output_pil:
+                    prf = ImageCms.ImageCmsProfile(io.BytesIO(output_pil.info.get('icc_profile')))
+                    assert prf.profile.profile_description == "sRGB v4 ICC preference perceptual intent beta"
+            assert validation.generate_pixel_checksum(output_files[0]) == \
+                validation.generate_pixel_checksum(output_files[1])
+
+    def test_icc_transform_cache_evicts_least_recently_used(self):
+        cache = conversion.IccTransformCache(max_size=2)
+        with Image.open(filepaths.STANDARD_TIF) as input_pil:
+            input_icc = input_pil.info.get('icc_profile')
+        with open(filepaths.SRGB_ICC_PROFILE, 'rb') as f:
+            output_icc = f.read()
+        perceptual = cache.get_transform(input_icc, output_icc, 'RGB', 'RGB', 0)
+        relative = cache.get_transform(input_icc, output_icc, 'RGB', 'RGB', 1)
+        assert cache.get_transform(input_icc, output_icc, 'RGB', 'RGB', 0) is perceptual
+        cache.get_transform(input_icc, output_icc, 'RGB', 'RGB', 3)
+        assert len(cache) == 2
+        assert cache.get_transform(input_icc, output_icc, 'RGB', 'RGB', 0) is perceptual
+        assert cache.get_transform(input_icc, output_icc, 'RGB', 'RGB', 1) is not relative
+
+    def test_icc_conversion_of_16_bit_tiff(self):
+        numpy = pytest.importorskip('numpy')
+        tifffile = pytest.importorskip('tifffile')
+        with temporary_folder() as output_folder:
+            input_file = os.path.join(output_folder, 'input_16_bit.tif')
             output_file = os.path.join(output_folder, 'output.tif')
+            with Image.open(filepaths.STANDARD_TIF) as input_pil:
+                input_pil = input_pil.convert('RGB')
+                pixels = numpy.asarray(input_pil).astype(numpy.uint16) * 257
+                tifffile.imwrite(input_file, pixels, photometric='rgb', rowsperstrip=64,
+                                 iccprofile=input_pil.info.get('icc_profile'), metadata=None)
+                expected_pil = ImageCms.profileToProfile(input_pil, io.BytesIO(input_pil.info.get('icc_profile')),
+                                                         filepaths.SRGB_ICC_PROFILE)
 
-            with pytest.raises(exceptions.ImageProcessingError):
-                conversion.Converter().convert_icc_profile(filepaths.TIF_16_BIT, output_file, filepaths.SRGB_ICC_PROFILE)
+            conversion.Converter().convert_icc_profile(input_file, output_file, filepaths.SRGB_ICC_PROFILE)
 
-            assert not os.path.isfile(output_file)
+            with Image.open(output_file) as output_pil:
+                assert output_pil.tag_v2[258] == (16, 16, 16)
+                prf = ImageCms.ImageCmsProfile(io.BytesIO(output_pil.info.get('icc_profile')))
+                assert prf.profile.profile_description == "sRGB v4 ICC preference perceptual intent beta"
+            output_pixels = tifffile.imread(output_file)
+            assert output_pixels.shape == pixels.shape
+            # the 16 bit conversion should agree with the 8 bit one to within rounding
+            difference = output_pixels / 257.0 - numpy.asarray(expected_pil).astype(numpy.float64)
+            assert numpy.abs(difference).max() <= 1
+
+    def test_icc_conversion_of_16_bit_tiff_with_unsupported_samples(self):
+        numpy = pytest.importorskip('numpy')
+        tifffile = pytest.importorskip('tifffile')
+        with temporary_folder() as output_folder:
+            input_file = os.path.join(output_folder, 'input_16_bit_la.tif')
+            with Image.open(filepaths.STANDARD_TIF) as input_pil:
+                icc_profile = input_pil.info.get('icc_profile')
+            tifffile.imwrite(input_file, numpy.zeros((16, 16, 2), dtype=numpy.uint16), photometric='minisblack',
+                             extrasamples=['unassalpha'], iccprofile=icc_profile, metadata=None)
+            with pytest.raises(exceptions.ImageProcessingError, match='samples per pixel 2'):
+                conversion.Converter().convert_16_bit_icc_profile(
+                    input_file, os.path.join(output_folder, 'output.tif'), filepaths.SRGB_ICC_PROFILE)
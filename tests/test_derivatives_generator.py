@@ -4,7 +4,9 @@ import os
 import shutil
 import sys
 import pytest
-from image_processing import derivative_files_generator, validation, exceptions
+from PIL import Image
+from image_processing import derivative_files_generator, validation, exceptions, storage, utils, content_index, \
+    kakadu, jp2
 from .test_utils import temporary_folder, filepaths, image_files_match, xmp_files_match
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -47,6 +49,31 @@ class TestDerivativeGenerator(object):
             assert image_files_match(jpg_file, filepaths.RESIZED_JPG_FROM_STANDARD_TIF)
             assert image_files_match(jp2_file, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
 
+    def test_creates_files_for_each_frame(self):
+        with temporary_folder() as output_folder:
+            generated_files = get_derivatives_generator().generate_derivatives_from_multi_frame_tiff(
+                filepaths.STANDARD_TIF, output_folder, check_lossless=True, max_workers=2)
+
+            assert len(generated_files) == 2
+            assert sorted(os.listdir(output_folder)) == [
+                'full_0001.jpg', 'full_0001.xmp', 'full_0002.jpg', 'full_0002.xmp',
+                'full_lossless_0001.jp2', 'full_lossless_0002.jp2']
+            assert generated_files[1][-1] == os.path.join(output_folder, 'full_lossless_0002.jp2')
+            assert image_files_match(os.path.join(output_folder, 'full_lossless_0001.jp2'),
+                                     filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+
+    def test_creates_files_in_storage(self):
+        with temporary_folder() as source_folder, temporary_folder() as output_folder:
+            source_storage = storage.LocalStorage(source_folder)
+            source_storage.upload(filepaths.STANDARD_TIF, 'masters/standard.tif')
+            output_keys = get_derivatives_generator().generate_derivatives_from_stored_tiff(
+                source_storage, 'masters/standard.tif', storage.LocalStorage(output_folder), 'derivatives/standard')
+
+            assert output_keys == ['derivatives/standard/full.jpg', 'derivatives/standard/full.xmp',
+                                   'derivatives/standard/full_lossless.jp2']
+            jp2_file = os.path.join(output_folder, 'derivatives', 'standard', 'full_lossless.jp2')
+            assert image_files_match(jp2_file, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+
     def test_creates_correct_files_without_default_names(self):
         with temporary_folder() as output_folder:
             orig_filepath = os.path.join(output_folder, 'test_tiff_filepath.tif')
@@ -221,3 +248,219 @@ class TestDerivativeGenerator(object):
             assert image_files_match(jpg_file, filepaths.STANDARD_JPG)
             assert image_files_match(jp2_file, filepaths.LOSSLESS_JP2_FROM_STANDARD_JPG_XMP)
             assert xmp_files_match(embedded_metadata_file, filepaths.STANDARD_JPG_XMP)
+
+    def test_creates_lossy_jp2_from_lossless(self):
+        with temporary_folder() as output_folder:
+            generator = get_derivatives_generator()
+            layers_jp2_file = os.path.join(output_folder, 'layers.jp2')
+            generator.generate_lossy_jp2_from_lossless(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, layers_jp2_file,
+                                                       layers=3)
+            validation.validate_jp2(layers_jp2_file)
+            assert os.path.getsize(layers_jp2_file) < os.path.getsize(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+
+            rate_jp2_file = os.path.join(output_folder, 'rate.jp2')
+            generator.generate_lossy_jp2_from_lossless(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, rate_jp2_file)
+            validation.validate_jp2(rate_jp2_file)
+            assert os.path.getsize(rate_jp2_file) < os.path.getsize(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+
+    def test_sampled_lossless_check(self):
+        generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                        lossless_check_sample_size=2)
+        generator.validate_jp2_conversion(filepaths.STANDARD_TIF, filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP,
+                                          check_lossless=True)
+        generator.check_conversion_was_lossless_sampled(filepaths.STANDARD_TIF,
+                                                        filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP,
+                                                        sample_size=3, seed=1)
+
+    def test_yields_derivatives_as_they_are_generated(self):
+        with temporary_folder() as output_folder:
+            generated_files = []
+            for generated_file in get_derivatives_generator().iter_derivatives_from_tiff(
+                    filepaths.STANDARD_TIF, output_folder, check_lossless=True):
+                # each file is in the output folder as soon as it's yielded
+                assert os.path.isfile(generated_file.path)
+                generated_files.append(generated_file)
+
+            assert [f.type for f in generated_files] == ['jpg', 'xmp', 'jp2']
+            assert [f.verified for f in generated_files] == [None, None, True]
+            for generated_file in generated_files:
+                assert os.path.dirname(generated_file.path) == output_folder
+                assert generated_file.size == os.path.getsize(generated_file.path)
+                assert generated_file.checksum == utils.file_checksum(generated_file.path)
+            assert len(os.listdir(output_folder)) == 3
+
+    def test_calls_back_with_each_derivative(self):
+        with temporary_folder() as output_folder:
+            generated_files = []
+            filepaths_created = get_derivatives_generator().generate_derivatives_from_tiff(
+                filepaths.STANDARD_TIF, output_folder, on_file_generated=generated_files.append)
+            assert [f.path for f in generated_files] == filepaths_created
+            assert generated_files[-1].type == derivative_files_generator.LOSSLESS_JP2_TYPE
+
+    def test_attaches_kakadu_stats_to_jp2(self):
+        with temporary_folder() as output_folder:
+            generator = derivative_files_generator.DerivativeFilesGenerator(
+                kakadu_base_path=filepaths.KAKADU_BASE_PATH, collect_kakadu_stats=True)
+            generated_files = list(generator.iter_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder))
+            assert [f.kakadu_stats for f in generated_files[:-1]] == [None, None]
+            # compressed, then expanded for the lossless check
+            assert [stats.command for stats in generated_files[-1].kakadu_stats] == ['kdu_compress', 'kdu_expand']
+            assert generated_files[-1].kakadu_stats[0].code_block_count == 1242
+
+    def test_writes_xmp_into_new_jp2_in_place(self):
+        generator = get_derivatives_generator()
+        copy_over_xmp_to_jp2 = generator.converter.copy_over_xmp_to_jp2
+        written = []
+
+        def record_copy_over_xmp_to_jp2(input_image_filepath, jp2_filepath, *args, **kwargs):
+            before = os.stat(jp2_filepath)
+            copy_over_xmp_to_jp2(input_image_filepath, jp2_filepath, *args, **kwargs)
+            after = os.stat(jp2_filepath)
+            written.append(((before.st_ino, before.st_size), (after.st_ino, after.st_size)))
+        generator.converter.copy_over_xmp_to_jp2 = record_copy_over_xmp_to_jp2
+
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'full_lossless.jp2')
+            generator.generate_jp2_from_tiff(filepaths.STANDARD_TIF, jp2_filepath)
+            assert len(written) == 1
+            before, after = written[0]
+            assert after == before
+            # the reserved box's empty packet has been replaced
+            assert b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>' not in jp2.read_xmp(jp2_filepath)
+
+    def test_records_recipe_in_jp2(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'full_lossless.jp2')
+            generator = get_derivatives_generator()
+            generator.generate_jp2_from_tiff(filepaths.STANDARD_TIF, jp2_filepath)
+            assert kakadu.read_recipe(jp2_filepath) == generator.get_compress_options(filepaths.STANDARD_TIF)
+            assert kakadu.read_recipe(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP) is None
+
+    def test_compress_options_policy_picks_options_per_image(self):
+        probes = []
+
+        def policy(kakadu_options, probe):
+            probes.append(probe)
+            return kakadu.replace_option(kakadu_options, 'Cblk', '{32,32}')
+        generator = derivative_files_generator.DerivativeFilesGenerator(
+            kakadu_base_path=filepaths.KAKADU_BASE_PATH, compress_options_policy=policy)
+        options = generator.get_compress_options(filepaths.BILEVEL_TIF)
+        assert 'Cblk={32,32}' in options
+        assert probes[0].mode == '1'
+        assert probes[0].bit_depth == 1
+
+    def test_creates_tile_pyramid(self):
+        with temporary_folder() as output_folder:
+            generated_files = list(get_derivatives_generator().iter_derivatives_from_tiff(
+                filepaths.STANDARD_TIF, output_folder, tile_pyramid_id='http://example.org/iiif/image'))
+            assert [f.type for f in generated_files] == ['jpg', 'xmp', 'iiif', 'jp2']
+            pyramid_folder = os.path.join(output_folder, derivative_files_generator.DEFAULT_TILE_PYRAMID_FOLDER_NAME)
+            assert generated_files[2].path == pyramid_folder
+            assert os.path.isfile(os.path.join(pyramid_folder, 'info.json'))
+            assert generated_files[2].checksum is None
+
+    def test_removes_yielded_derivatives_on_failure(self):
+        with temporary_folder() as output_folder:
+            generator = get_derivatives_generator()
+
+            def fail(*args, **kwargs):
+                raise exceptions.ValidationError('failed')
+            generator.validate_jp2_conversion = fail
+            generated_files = []
+            with pytest.raises(exceptions.ValidationError):
+                for generated_file in generator.iter_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder):
+                    generated_files.append(generated_file)
+            assert [f.type for f in generated_files] == ['jpg', 'xmp']
+            assert os.listdir(output_folder) == []
+
+    def test_reuses_jp2_with_the_same_content(self):
+        with temporary_folder() as output_folder:
+            index = content_index.ContentIndex(os.path.join(output_folder, 'index.sqlite'))
+            generator = derivative_files_generator.DerivativeFilesGenerator(
+                kakadu_base_path=filepaths.KAKADU_BASE_PATH, content_index=index)
+            first_folder = os.path.join(output_folder, 'first')
+            second_folder = os.path.join(output_folder, 'second')
+            os.mkdir(first_folder)
+            os.mkdir(second_folder)
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, first_folder)
+            assert len(index) == 1
+
+            def fail(*args, **kwargs):
+                raise AssertionError('the jp2 should not be encoded again')
+            generator.generate_jp2_from_tiff = fail
+            redelivered_filepath = os.path.join(output_folder, 'redelivered.tif')
+            shutil.copy(filepaths.STANDARD_TIF, redelivered_filepath)
+            generator.generate_derivatives_from_tiff(redelivered_filepath, second_folder)
+
+            assert filecmp.cmp(os.path.join(first_folder, 'full_lossless.jp2'),
+                               os.path.join(second_folder, 'full_lossless.jp2'), shallow=False)
+
+    def test_flags_near_duplicates(self):
+        fingerprint = pytest.importorskip('image_processing.fingerprint')
+        near_duplicates = []
+        generator = derivative_files_generator.DerivativeFilesGenerator(
+            kakadu_base_path=filepaths.KAKADU_BASE_PATH, fingerprint_index=fingerprint.FingerprintIndex(),
+            on_near_duplicates=lambda source, matches: near_duplicates.append((source, matches)))
+        with temporary_folder() as output_folder:
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+        assert near_duplicates == []
+        with temporary_folder() as output_folder:
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder)
+        assert near_duplicates == [(filepaths.STANDARD_TIF, [(filepaths.STANDARD_TIF, 0)])]
+
+    @pytest.mark.skipif(sys.version_info < (3, 8), reason="multiprocessing.shared_memory needs Python 3.8")
+    def test_shares_decoded_source_raster(self, monkeypatch):
+        from image_processing.shared_raster import SharedRaster
+        created = []
+        create = SharedRaster.create
+
+        def record_create(*args, **kwargs):
+            shared_raster = create(*args, **kwargs)
+            created.append(shared_raster.name)
+            return shared_raster
+        monkeypatch.setattr(SharedRaster, 'create', staticmethod(record_create))
+
+        generator = derivative_files_generator.DerivativeFilesGenerator(kakadu_base_path=filepaths.KAKADU_BASE_PATH,
+                                                                        share_source_raster=True)
+        with temporary_folder() as output_folder:
+            generator.generate_derivatives_from_tiff(filepaths.STANDARD_TIF, output_folder, check_lossless=True)
+            assert image_files_match(os.path.join(output_folder, 'full.jpg'), filepaths.RESIZED_JPG_FROM_STANDARD_TIF)
+            assert image_files_match(os.path.join(output_folder, 'full_lossless.jp2'),
+                                     filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert len(created) == 1
+        # the block has been released
+        with pytest.raises((OSError, exceptions.ImageProcessingError)):
+            SharedRaster.attach(created[0])
+
+
+class TestSourceRegions(object):
+    def test_only_reads_the_segments_covering_each_window(self, monkeypatch):
+        numpy = pytest.importorskip('numpy')
+        tifffile = pytest.importorskip('tifffile')
+        read_indices = []
+        read_segments = tifffile.FileHandle.read_segments
+
+        def record_read_segments(self, offsets, bytecounts, *args, **kwargs):
+            read_indices.append(sorted(kwargs['indices']))
+            return read_segments(self, offsets, bytecounts, *args, **kwargs)
+        monkeypatch.setattr(tifffile.FileHandle, 'read_segments', record_read_segments)
+
+        with Image.open(filepaths.STANDARD_TIF) as source_pil:
+            pixels = numpy.asarray(source_pil)
+        with temporary_folder() as output_folder:
+            strips_filepath = os.path.join(output_folder, 'strips.tif')
+            tiles_filepath = os.path.join(output_folder, 'tiles.tif')
+            tifffile.imwrite(strips_filepath, pixels, photometric='rgb', rowsperstrip=16, compression='zlib')
+            tifffile.imwrite(tiles_filepath, pixels, photometric='rgb', tile=(256, 256), compression='zlib')
+
+            windows = [(0, 0, 512, 512), (1024, 1000, 326, 20)]
+            # strips of 16 rows, and tiles 256 square in 6 columns
+            expected_indices = {strips_filepath: [list(range(0, 32)), [62, 63]],
+                                tiles_filepath: [[0, 1, 6, 7], [22, 23]]}
+            for tiff_filepath in [strips_filepath, tiles_filepath]:
+                del read_indices[:]
+                with derivative_files_generator._SourceRegions(tiff_filepath) as source_regions:
+                    for left, top, width, height in windows:
+                        region = numpy.asarray(source_regions.region(left, top, width, height))
+                        assert numpy.array_equal(region, pixels[top:top + height, left:left + width])
+                assert read_indices == expected_indices[tiff_filepath]
@@ -0,0 +1,84 @@
+import os
+import random
+import threading
+import time
+
+import pytest
+from PIL import Image, ImageEnhance
+
+from .test_utils import temporary_folder, filepaths
+
+numpy = pytest.importorskip('numpy')
+from image_processing import fingerprint  # noqa: E402
+from image_processing.fingerprint import FingerprintIndex  # noqa: E402
+
+
+class TestFingerprint(object):
+    def test_thumbnail_has_nearly_the_same_fingerprint_as_source(self):
+        with Image.open(filepaths.STANDARD_TIF) as source:
+            source_fingerprint = fingerprint.dhash(source)
+        thumbnail_fingerprint = fingerprint.dhash_file(filepaths.RESIZED_JPG_FROM_STANDARD_TIF)
+        assert fingerprint.hamming_distance(source_fingerprint, thumbnail_fingerprint) <= 4
+
+    def test_rescan_is_a_near_duplicate(self):
+        with Image.open(filepaths.STANDARD_TIF) as source:
+            source_fingerprint = fingerprint.dhash(source)
+            width, height = source.size
+            rescan = ImageEnhance.Brightness(source.crop((2, 2, width - 3, height - 2))).enhance(1.1)
+            rescan_fingerprint = fingerprint.dhash(rescan)
+            different_fingerprint = fingerprint.dhash(source.transpose(Image.FLIP_LEFT_RIGHT))
+        assert fingerprint.hamming_distance(source_fingerprint, rescan_fingerprint) <= \
+            fingerprint.DEFAULT_MAX_DISTANCE
+        assert fingerprint.hamming_distance(source_fingerprint, different_fingerprint) > \
+            fingerprint.DEFAULT_MAX_DISTANCE
+
+    def test_searches_by_hamming_distance(self):
+        index = FingerprintIndex()
+        assert index.search(0) == []
+        index.add('far', 0xFFFFFFFFFFFFFFFF)
+        index.add('two bits', 0b101)
+        index.add('same', 0)
+        index.add('one bit', 1 << 63)
+        assert index.search(0, max_distance=2) == [('same', 0), ('one bit', 1), ('two bits', 2)]
+        assert index.search_and_add('new', 0xFFFFFFFFFFFFFFFE, max_distance=1) == [('far', 1)]
+        assert len(index) == 5
+
+    def test_concurrent_near_duplicates_find_each_other(self):
+        index = FingerprintIndex()
+        matches_found = []
+
+        def ingest(worker):
+            for i in range(200):
+                matches = index.search_and_add('{0}-{1}'.format(worker, i), 0)
+                matches_found.append(len(matches))
+
+        workers = [threading.Thread(target=ingest, args=(worker,)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # each identical fingerprint is found by exactly the ones added after it
+        assert sorted(matches_found) == list(range(800))
+
+    def test_saves_and_loads_index(self):
+        index = FingerprintIndex()
+        for i in range(2000):
+            index.add('image{0}'.format(i), i * 7919)
+        with temporary_folder() as output_folder:
+            index_filepath = os.path.join(output_folder, 'fingerprints.npz')
+            index.save(index_filepath)
+            loaded_index = FingerprintIndex.load(index_filepath)
+        assert len(loaded_index) == 2000
+        assert loaded_index.search(1234 * 7919, max_distance=0) == [('image1234', 0)]
+
+    def test_searches_a_million_fingerprints_quickly(self):
+        index = FingerprintIndex()
+        generator = numpy.random.RandomState(0)
+        fingerprints = generator.randint(0, 2 ** 63, size=1000000, dtype=numpy.int64).astype(numpy.uint64)
+        index._fingerprints = fingerprints
+        index._identifiers = list(range(len(fingerprints)))
+        target = int(fingerprints[random.Random(0).randrange(len(fingerprints))])
+        start = time.time()
+        matches = index.search(target, max_distance=0)
+        assert time.time() - start < 1
+        assert target in [int(fingerprints[identifier]) for identifier, _ in matches]
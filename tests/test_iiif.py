@@ -0,0 +1,81 @@
+import os
+from image_processing import iiif, iiif_replay, exceptions
+from .test_utils import filepaths, temporary_folder
+import pytest
+import shutil
+
+
+class TestIIIF(object):
+    def test_parses_requests(self):
+        request = iiif.parse_request('/iiif/image/abc%2F1/0,0,512,512/256,/0/default.jpg')
+        assert request == iiif.IIIFRequest('abc/1', '0,0,512,512', '256,', '0', 'default', 'jpg')
+        log_line = '127.0.0.1 - - [01/Jan/2018:00:00:00 +0000] "GET /iiif/abc/full/!200,200/0/default.png HTTP/1.1" 200'
+        assert iiif.parse_request(log_line) == iiif.IIIFRequest('abc', 'full', '!200,200', '0', 'default', 'png')
+        assert iiif.parse_request('/iiif/abc/info.json') is None
+
+    def test_resolves_regions(self):
+        assert iiif.resolve_region('full', 1000, 800) == (0, 0, 1000, 800)
+        assert iiif.resolve_region('square', 1000, 800) == (100, 0, 800, 800)
+        assert iiif.resolve_region('900,700,512,512', 1000, 800) == (900, 700, 100, 100)
+        assert iiif.resolve_region('pct:50,50,50,50', 1000, 800) == (500, 400, 500, 400)
+        with pytest.raises(exceptions.ImageProcessingError):
+            iiif.resolve_region('1000,0,10,10', 1000, 800)
+
+    def test_resolves_sizes(self):
+        assert iiif.resolve_size('full', 1000, 800) == (1000, 800)
+        assert iiif.resolve_size('500,', 1000, 800) == (500, 400)
+        assert iiif.resolve_size(',400', 1000, 800) == (500, 400)
+        assert iiif.resolve_size('pct:25', 1000, 800) == (250, 200)
+        assert iiif.resolve_size('!200,200', 1000, 800) == (200, 160)
+        assert iiif.resolve_size('200,200', 1000, 800) == (200, 200)
+
+    def test_plans_reduced_decodes(self):
+        request = iiif.IIIFRequest('abc', '0,0,2048,2048', '512,', '0', 'default', 'jpg')
+        plan = iiif.plan_decode(request, 4000, 3000, levels=6)
+        assert plan.reduce == 2
+        assert (plan.output_width, plan.output_height) == (512, 512)
+        assert iiif.plan_decode(request, 4000, 3000, levels=1).reduce == 1
+        thumbnail = iiif.IIIFRequest('abc', 'full', '!256,256', '0', 'default', 'jpg')
+        assert iiif.plan_decode(thumbnail, 4000, 3000, levels=6).reduce == 3
+
+    def test_synthetic_requests_are_valid(self):
+        requests = iiif.synthetic_requests([('abc', 1350, 1020, 6)], 50, tile_size=256)
+        assert len(requests) == 50
+        for request in requests:
+            plan = iiif.plan_decode(request, 1350, 1020, 6)
+            assert plan.left + plan.width <= 1350 and plan.top + plan.height <= 1020
+
+    def test_info_json_lists_tiles_and_sizes(self):
+        info = iiif.info_json('http://localhost/abc', 1350, 1020, 512, 512, levels=2, compliance_level=0)
+        assert info['@id'] == 'http://localhost/abc'
+        assert (info['width'], info['height']) == (1350, 1020)
+        assert info['tiles'] == [{'width': 512, 'height': 512, 'scaleFactors': [1, 2, 4]}]
+        assert info['sizes'] == [{'width': 338, 'height': 255}, {'width': 675, 'height': 510},
+                                 {'width': 1350, 'height': 1020}]
+        assert info['profile'] == ['http://iiif.io/api/image/2/level0.json']
+
+    def test_finds_jp2_files_in_subfolders(self):
+        with temporary_folder() as jp2_folder:
+            os.makedirs(os.path.join(jp2_folder, 'book', 'page1'))
+            jp2_filepath = os.path.join(jp2_folder, 'book', 'page1', 'full_lossless.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+            assert iiif_replay.find_jp2_files(jp2_folder) == {}
+            jp2_files = iiif_replay.find_jp2_files(jp2_folder, recursive=True)
+            assert jp2_files == {'book/page1/full_lossless.jp2': jp2_filepath, 'book/page1/full_lossless': jp2_filepath}
+
+    def test_percentile(self):
+        assert iiif_replay.percentile(list(range(1, 101)), 99) == 99
+        assert iiif_replay.percentile([3, 1, 2], 50) == 2
+        assert iiif_replay.percentile([], 50) is None
+
+    def test_replays_requests(self):
+        with temporary_folder() as jp2_folder:
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, os.path.join(jp2_folder, 'image.jp2'))
+            replayer = iiif_replay.RequestReplayer(iiif_replay.find_jp2_files(jp2_folder),
+                                                   kakadu_base_path=filepaths.KAKADU_BASE_PATH)
+            requests = iiif.synthetic_requests([('image', 1350, 1020, 6)], 10) + \
+                [iiif.IIIFRequest('missing', 'full', 'full', '0', 'default', 'jpg')]
+            summary = iiif_replay.summarise(replayer.replay(requests))
+            assert summary['requests'] == 11
+            assert summary['errors'] == 1
+            assert summary['p99_seconds'] > 0
@@ -0,0 +1,126 @@
+import io
+import json
+import os
+import shutil
+import threading
+import time
+
+from PIL import Image
+
+from image_processing import iiif_server
+from image_processing.iiif_server import TileCache
+from .test_utils import filepaths, temporary_folder
+
+import pytest
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # python 2
+    from urllib2 import urlopen, HTTPError
+
+
+class TestTileCache(object):
+    def test_evicts_least_recently_used_tiles(self):
+        cache = TileCache(max_memory_bytes=20)
+        cache.get('a', lambda: b'a' * 8)
+        cache.get('b', lambda: b'b' * 8)
+        # a is now more recently used than b
+        assert cache.get('a', lambda: b'new') == b'a' * 8
+        cache.get('c', lambda: b'c' * 8)
+        assert cache.get('a', lambda: b'new') == b'a' * 8
+        assert cache.get('b', lambda: b'new') == b'new'
+        assert (cache.memory_hits, cache.misses) == (2, 4)
+
+    def test_keeps_tiles_on_disk(self):
+        with temporary_folder() as cache_folder:
+            cache = TileCache(max_memory_bytes=0, disk_folder=cache_folder, max_disk_bytes=20)
+            cache.get('a', lambda: b'a' * 8)
+            cache.get('b', lambda: b'b' * 8)
+            assert cache.get('a', lambda: b'new') == b'a' * 8
+            cache.get('c', lambda: b'c' * 8)
+            assert len(os.listdir(cache_folder)) == 2
+            assert cache.disk_hits == 1
+
+            # the disk cache is loaded again on restart, in the same order
+            cache = TileCache(max_memory_bytes=0, disk_folder=cache_folder, max_disk_bytes=20)
+            assert cache.get('c', lambda: b'new') == b'c' * 8
+            assert cache.get('b', lambda: b'new') == b'new'
+
+    def test_creates_tile_once_for_concurrent_requests(self):
+        cache = TileCache()
+        calls = []
+        results = []
+
+        def create():
+            calls.append(1)
+            time.sleep(0.2)
+            return b'tile'
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get('a', create))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert results == [b'tile'] * 8
+
+    def test_failures_are_not_cached(self):
+        cache = TileCache()
+
+        def fail():
+            raise IOError('failed')
+        with pytest.raises(IOError):
+            cache.get('a', fail)
+        assert cache.get('a', lambda: b'tile') == b'tile'
+
+
+class TestIIIFServer(object):
+    def test_serves_info_and_tiles(self):
+        with temporary_folder() as jp2_folder:
+            os.mkdir(os.path.join(jp2_folder, 'page1'))
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, os.path.join(jp2_folder, 'page1', 'image.jp2'))
+            service = iiif_server.TileService(jp2_folder, filepaths.KAKADU_BASE_PATH)
+            server = iiif_server.make_server(service, port=0)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            try:
+                base_uri = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+                info = json.loads(urlopen(base_uri + '/page1%2Fimage/info.json').read().decode('utf-8'))
+                assert info['@id'] == base_uri + '/page1%2Fimage'
+                assert (info['width'], info['height']) == (1350, 1020)
+
+                tile = urlopen(base_uri + '/page1%2Fimage/512,512,512,512/256,/0/default.jpg').read()
+                # the region is clipped to the bottom of the image
+                assert Image.open(io.BytesIO(tile)).size == (256, 254)
+                urlopen(base_uri + '/page1%2Fimage/512,512,512,512/256,/0/default.jpg').read()
+                assert (service.cache.misses, service.cache.memory_hits) == (1, 1)
+
+                with pytest.raises(HTTPError) as e:
+                    urlopen(base_uri + '/missing/full/full/0/default.jpg')
+                assert e.value.code == 404
+                with pytest.raises(HTTPError) as e:
+                    urlopen(base_uri + '/page1%2Fimage/5000,0,10,10/full/0/default.jpg')
+                assert e.value.code == 400
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_answers_unexpected_errors_with_500(self):
+        class BrokenTileService(object):
+            def image(self, request):
+                raise ValueError('broken')
+
+        server = iiif_server.make_server(BrokenTileService(), port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            base_uri = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+            with pytest.raises(HTTPError) as e:
+                urlopen(base_uri + '/image/full/full/0/default.jpg')
+            assert e.value.code == 500
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,47 @@
+import json
+import os
+
+from PIL import Image
+
+from image_processing import iiif_static, kakadu
+from .test_utils import filepaths, temporary_folder
+
+
+class TestTilePyramid(object):
+    def test_reads_pnm_in_bands(self):
+        with temporary_folder() as output_folder:
+            pnm_filepath = os.path.join(output_folder, 'image.ppm')
+            with Image.open(filepaths.STANDARD_TIF) as image:
+                image.save(pnm_filepath)
+                with iiif_static._BandReader(pnm_filepath, pnm_mode='RGB') as band_reader:
+                    assert band_reader.size == (1350, 1020)
+                    band = band_reader.read(512, 508)
+                    assert band.tobytes() == image.crop((0, 512, 1350, 1020)).tobytes()
+
+    def test_generates_level_0_pyramid(self):
+        with temporary_folder() as output_folder:
+            pyramid_folder = os.path.join(output_folder, 'iiif')
+            tile_count = iiif_static.generate_tile_pyramid(
+                kakadu.Kakadu(filepaths.KAKADU_BASE_PATH), filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP,
+                pyramid_folder, 'http://example.org/iiif/image', workers=2)
+            # 6 tiles at full resolution, 2 at half, then one at each of the 5 smaller scales
+            assert tile_count == 13
+
+            with open(os.path.join(pyramid_folder, 'info.json')) as info_file:
+                info = json.load(info_file)
+            assert info['@id'] == 'http://example.org/iiif/image'
+            assert info['tiles'] == [{'width': 512, 'height': 512, 'scaleFactors': [1, 2, 4, 8, 16, 32, 64]}]
+            assert info['sizes'][-1] == {'width': 338, 'height': 255}
+
+            with Image.open(os.path.join(pyramid_folder, '1024,512,326,508', '326,', '0', 'default.jpg')) as tile:
+                assert tile.size == (326, 508)
+            with Image.open(os.path.join(pyramid_folder, '0,0,1024,1020', '512,', '0', 'default.jpg')) as tile:
+                assert tile.size == (512, 510)
+            with Image.open(os.path.join(pyramid_folder, '0,0,1350,1020', '338,', '0', 'default.jpg')) as tile:
+                assert tile.size == (338, 255)
+            with Image.open(os.path.join(pyramid_folder, '1024,0,326,1020', '163,', '0', 'default.jpg')) as tile:
+                assert tile.size == (163, 510)
+            for size in info['sizes']:
+                size_filepath = os.path.join(pyramid_folder, 'full', '{0},'.format(size['width']), '0', 'default.jpg')
+                with Image.open(size_filepath) as image:
+                    assert image.size == (size['width'], size['height'])
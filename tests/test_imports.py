@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from image_processing import utils
+
+IMPORT_TIME_BUDGET_SECONDS = 1.0
+
+IMPORT_SCRIPT = '''
+import sys
+from timeit import default_timer
+start = default_timer()
+import image_processing.derivative_files_generator
+print(default_timer() - start)
+print(' '.join(sorted(name for name in ['jpylyzer', 'sqlite3', 'xml.dom.minidom'] if name in sys.modules)))
+'''
+
+
+class TestImports(object):
+    def test_import_is_fast_and_lazy(self):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        lines = output.decode('utf-8').splitlines()
+        assert float(lines[0]) < IMPORT_TIME_BUDGET_SECONDS
+        assert len(lines) == 1 or lines[1].strip() == ''
+
+    def test_executable_lookups_are_cached(self, monkeypatch):
+        utils.clear_executable_cache()
+        python_path = utils.resolve_executable(sys.executable)
+        assert python_path == sys.executable
+
+        def fail(*args):
+            raise AssertionError('the filesystem should not be searched again')
+        monkeypatch.setattr(os.path, 'isfile', fail)
+        assert utils.cmd_is_executable(sys.executable)
+
+        monkeypatch.undo()
+        utils.clear_executable_cache()
+        assert not utils.cmd_is_executable('not_a_real_executable_for_image_processing')
@@ -0,0 +1,143 @@
+import os
+import re
+import shutil
+import struct
+
+from PIL import Image
+
+from image_processing import jp2, exceptions
+from .test_utils import filepaths, temporary_folder
+import pytest
+
+
+class TestJp2(object):
+    def test_reads_codestream_info(self):
+        info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert (info.width, info.height) == (1350, 1020)
+        assert (info.tile_height, info.tile_width) == (512, 512)
+        assert info.components == 3
+        assert info.bit_depths == [8, 8, 8]
+        assert info.progression_order == 'RPCL'
+        assert info.layers == 6
+        assert info.levels == 6
+        assert info.code_block_size == (64, 64)
+        assert info.precinct_sizes[:3] == [(256, 256), (256, 256), (128, 128)]
+        assert info.reversible
+        assert info.sop_markers and info.eph_markers
+
+    def test_reads_lossy_codestream_info(self):
+        info = jp2.read_codestream_info(filepaths.LOSSY_JP2_FROM_STANDARD_TIF)
+        assert not info.reversible
+
+    def test_counts_tiles_and_code_blocks(self):
+        info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert jp2.count_tiles(info) == 6
+        # per component, a full 512x512 tile has 4x4 code-blocks in each of the 3 highest resolution subbands, 2x2 in
+        # the next, and one in each of the others
+        full_tile_code_blocks = 3 * 16 + 3 * 4 + 4 * 3 + 1
+        assert jp2.count_code_blocks(info._replace(width=512, height=512, components=1)) == full_tile_code_blocks
+        assert jp2.count_code_blocks(info) == 1242
+
+    def test_reads_codestream_comments(self):
+        comments = jp2.read_codestream_comments(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert comments[0] == 'Kakadu-v7.10.4'
+        assert comments[1].startswith('Kdu-Layer-Info')
+
+    def test_rejects_files_without_codestream(self):
+        with pytest.raises(exceptions.ImageProcessingError):
+            jp2.read_codestream_info(filepaths.SRGB_ICC_PROFILE)
+
+    def test_writes_xmp_box_like_exiftool(self):
+        exiftool_xmp = jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        unpadded_xmp = exiftool_xmp.replace(jp2.XMP_PADDING, b'')
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'test.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            jp2.write_xmp(jp2_filepath, unpadded_xmp, keep_box_size=False)
+            assert jp2.read_xmp(jp2_filepath) == exiftool_xmp
+            assert jp2.read_codestream_info(jp2_filepath) == \
+                jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+
+    def test_rewrites_xmp_box_in_place(self):
+        original_xmp = jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+        new_xmp = re.sub(b'<aux:Firmware>[^<]*</aux:Firmware>', b'', original_xmp)
+        assert len(new_xmp) < len(original_xmp)
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'test.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            jp2.write_xmp(jp2_filepath, new_xmp)
+            assert os.path.getsize(jp2_filepath) == os.path.getsize(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
+            written_xmp = jp2.read_xmp(jp2_filepath)
+            assert b'aux:Firmware' not in written_xmp
+            assert written_xmp.rstrip(b' \n').endswith(b"<?xpacket end='w'?>")
+            assert written_xmp.startswith(new_xmp[:new_xmp.index(b'</x:xmpmeta>')])
+
+    def test_writes_xmp_into_reserved_box_in_place(self):
+        xmp = jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'test.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+            jp2.write_metadata_boxes(jp2_filepath, [jp2.reserved_xmp_box()])
+            assert jp2.read_xmp(jp2_filepath).rstrip(b' \n').endswith(b'<?xpacket end="w"?>')
+            before = os.stat(jp2_filepath)
+
+            jp2.write_xmp(jp2_filepath, xmp)
+            after = os.stat(jp2_filepath)
+            assert (after.st_ino, after.st_size) == (before.st_ino, before.st_size)
+            written_xmp = jp2.read_xmp(jp2_filepath)
+            assert len(written_xmp) > len(xmp)
+            assert written_xmp.startswith(xmp.replace(jp2.XMP_PADDING, b'').split(b'<?xpacket end')[0].rstrip())
+
+            # XMP which doesn't fit is still written, by rewriting the file
+            large_xmp = jp2.pad_xmp_packet(xmp, b' ' * jp2.XMP_RESERVED_BOX_LENGTH)
+            jp2.write_xmp(jp2_filepath, large_xmp, keep_box_size=False)
+            assert jp2.read_xmp(jp2_filepath) == jp2.pad_xmp_packet(large_xmp)
+
+    def test_adds_xmp_box_after_header(self):
+        xmp = jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'test.jp2')
+            with open(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, 'rb') as source, open(jp2_filepath, 'wb') as f:
+                for box_type, offset, _, box_length in jp2.iter_boxes(source):
+                    source.seek(offset)
+                    box = source.read(box_length)
+                    if box_type != jp2.UUID_BOX_TYPE:
+                        f.write(box)
+            assert jp2.read_xmp(jp2_filepath) is None
+            jp2.write_xmp(jp2_filepath, xmp)
+            assert jp2.read_xmp(jp2_filepath) == xmp
+            with open(jp2_filepath, 'rb') as f:
+                assert [box[0] for box in jp2.iter_boxes(f)] == [b'jP  ', b'ftyp', b'jp2h', b'uuid', b'jp2c']
+
+    def test_writes_codestream_comment(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'test.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+            jp2.write_codestream_comment(jp2_filepath, 'recipe: old')
+            jp2.write_codestream_comment(jp2_filepath, 'recipe: new', replace_prefix='recipe: ')
+            original_comments = jp2.read_codestream_comments(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            assert jp2.read_codestream_comments(jp2_filepath) == original_comments + ['recipe: new']
+            assert jp2.read_codestream_info(jp2_filepath) == \
+                jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            assert jp2.read_xmp(jp2_filepath) == jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            with Image.open(jp2_filepath) as commented, \
+                    Image.open(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP) as original:
+                assert commented.tobytes() == original.tobytes()
+
+    def test_copies_metadata_boxes(self):
+        boxes = jp2.read_metadata_boxes(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert [box[4:8] for box in boxes] == [jp2.UUID_BOX_TYPE, jp2.UUID_BOX_TYPE]
+        xml_box = struct.pack('>I4s', 16, jp2.XML_BOX_TYPE) + b'<a>b</a>'
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'test.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            jp2.write_metadata_boxes(jp2_filepath, boxes + [xml_box])
+            assert jp2.read_metadata_boxes(jp2_filepath) == boxes + [xml_box]
+            assert jp2.read_xmp(jp2_filepath) == jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            with open(jp2_filepath, 'rb') as f:
+                assert [box[0] for box in jp2.iter_boxes(f)] == [b'jP  ', b'ftyp', b'jp2h', b'uuid', b'uuid', b'xml ',
+                                                                 b'jp2c']
+            jp2.write_metadata_boxes(jp2_filepath, [])
+            assert jp2.read_metadata_boxes(jp2_filepath) == []
+            assert jp2.read_codestream_info(jp2_filepath) == \
+                jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF)
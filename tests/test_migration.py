@@ -0,0 +1,174 @@
+import os
+import shutil
+
+import pytest
+
+from image_processing import jp2, kakadu, migration, validation
+from image_processing.exceptions import ImageProcessingError
+from image_processing.migration import Migrator, MigrationLedger
+from .test_utils import temporary_folder, filepaths
+
+
+def _jp2_with_recipe(output_folder, kakadu_options):
+    jp2_filepath = os.path.join(output_folder, 'archive', 'page1.jp2')
+    os.makedirs(os.path.dirname(jp2_filepath))
+    shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+    jp2.write_codestream_comment(jp2_filepath, kakadu.recipe_comment(kakadu_options))
+    return jp2_filepath
+
+
+class TestMigrationPlan(object):
+    def test_plans_by_what_changed(self):
+        options = kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS
+        assert migration.plan_migration(options, options) is None
+        assert migration.plan_migration(options, kakadu.replace_option(options, '-flush_period', 512)) is None
+        assert migration.plan_migration(options, kakadu.replace_option(options, 'Corder', 'LRCP')) == \
+            migration.TRANSCODE
+        assert migration.plan_migration(options, options + ['ORGgen_tlm=8']) == migration.TRANSCODE
+        # the default can't be restored without knowing what it is
+        assert migration.plan_migration(options, kakadu.replace_option(options, 'ORGgen_plt', None)) == \
+            migration.REENCODE
+        assert migration.plan_migration(options, kakadu.replace_option(options, 'Cblk', '{32,32}')) == \
+            migration.REENCODE
+        assert migration.plan_migration(options, options + [kakadu.ALPHA_OPTION]) == migration.REENCODE
+        assert migration.plan_migration(None, options) == migration.REENCODE
+
+    def test_plans_from_the_codestream_without_a_recipe(self):
+        info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        options = kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS
+        # the PLT markers and tile-parts can't be read from the main header, so they're written again
+        assert migration.plan_migration(None, options, info) == migration.TRANSCODE
+        without_markers = kakadu.replace_option(kakadu.replace_option(options, 'ORGgen_plt', None), 'ORGtparts', None)
+        assert migration.plan_migration(None, without_markers, info) is None
+        assert migration.plan_migration(None, kakadu.replace_option(without_markers, 'Corder', 'LRCP'), info) == \
+            migration.TRANSCODE
+        for option_name, value in [('Cblk', '{32,32}'), ('Clevels', '5'), ('Cprecincts', '{256,256}'),
+                                   ('Stiles', None), ('Cuse_sop', None)]:
+            assert migration.plan_migration(None, kakadu.replace_option(options, option_name, value), info) == \
+                migration.REENCODE
+        assert migration.plan_migration(None, options + [kakadu.ALPHA_OPTION], info) == migration.REENCODE
+
+    def test_only_migrates_lossless_files_without_alpha(self):
+        info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        migration.check_can_migrate(info)
+        with pytest.raises(ImageProcessingError):
+            migration.check_can_migrate(jp2.read_codestream_info(filepaths.LOSSY_JP2_FROM_STANDARD_TIF))
+        with pytest.raises(ImageProcessingError):
+            migration.check_can_migrate(info._replace(components=4, bit_depths=[8, 8, 8, 8]))
+
+    def test_probes_codestream_like_the_source(self):
+        info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+        assert migration.probe_codestream(info) == kakadu.ImageProbe(width=1350, height=1020, mode='RGB',
+                                                                     bit_depth=8, components=3)
+
+    def test_only_migrates_to_lossless_recipes(self):
+        with pytest.raises(ValueError):
+            Migrator(kakadu_compress_options=kakadu.DEFAULT_LOSSY_COMPRESS_OPTIONS)
+
+    def test_finds_jp2_files_but_not_partial_files(self):
+        with temporary_folder() as output_folder:
+            for filename in ['b.jp2', os.path.join('volume', 'a.JP2'), '.b.partial.jp2', 'c.tif']:
+                filepath = os.path.join(output_folder, filename)
+                if not os.path.isdir(os.path.dirname(filepath)):
+                    os.makedirs(os.path.dirname(filepath))
+                open(filepath, 'w').close()
+            assert migration.find_jp2_files(output_folder) == [os.path.join(output_folder, 'b.jp2'),
+                                                               os.path.join(output_folder, 'volume', 'a.JP2')]
+
+
+class TestMigrationLedger(object):
+    def test_records_status_per_recipe(self):
+        with temporary_folder() as output_folder:
+            ledger = MigrationLedger(os.path.join(output_folder, 'ledger.db'))
+            options = kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS
+            assert ledger.status('page1.jp2', options) is None
+            ledger.record('page1.jp2', options, migration.FAILED, method=migration.REENCODE, error='timed out')
+            ledger.record('page1.jp2', options, migration.MIGRATED, method=migration.REENCODE, checksum='abc')
+            ledger.record('page2.jp2', options, migration.UNCHANGED)
+            assert ledger.status(os.path.abspath('page1.jp2'), options) == migration.MIGRATED
+            assert ledger.status('page1.jp2', options + ['ORGgen_tlm=8']) is None
+            ledger.close()
+            assert MigrationLedger(ledger.database_filepath).counts() == {migration.MIGRATED: 1,
+                                                                          migration.UNCHANGED: 1}
+
+
+class TestMigrator(object):
+    def test_files_with_the_recipe_are_unchanged(self):
+        with temporary_folder() as output_folder:
+            migrator = Migrator()
+            info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            jp2_filepath = _jp2_with_recipe(output_folder, migrator.get_compress_options(info))
+            assert migrator.migrate([jp2_filepath]) == [
+                migration.MigratedFile(jp2_filepath, migration.UNCHANGED, None, None)]
+
+    def test_reencodes_files_without_a_recipe(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'page1.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+            ledger_filepath = os.path.join(output_folder, 'ledger.db')
+
+            assert migration.main([output_folder, '--ledger', ledger_filepath, '--set', 'Cblk={32,32}']) == 0
+            info = jp2.read_codestream_info(jp2_filepath)
+            assert info.code_block_size == (32, 32)
+            migrator = Migrator(kakadu_compress_options=kakadu.replace_option(
+                kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS, 'Cblk', '{32,32}'), ledger=MigrationLedger(ledger_filepath))
+            assert kakadu.read_recipe(jp2_filepath) == migrator.get_compress_options(info)
+            assert jp2.read_metadata_boxes(jp2_filepath) == \
+                jp2.read_metadata_boxes(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            migrator.kakadu.kdu_expand(jp2_filepath, os.path.join(output_folder, 'migrated.tif'), [])
+            validation.check_visually_identical(filepaths.STANDARD_TIF, os.path.join(output_folder, 'migrated.tif'))
+
+            # a second run resumes from the ledger
+            assert [result.status for result in migrator.migrate([jp2_filepath])] == [migration.SKIPPED]
+
+    def test_transcodes_files_without_a_recipe(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'page1.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+            migrator = Migrator()
+            assert migrator.migrate([jp2_filepath]) == [
+                migration.MigratedFile(jp2_filepath, migration.MIGRATED, migration.TRANSCODE, None)]
+            info = jp2.read_codestream_info(jp2_filepath)
+            assert info == jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            assert kakadu.read_recipe(jp2_filepath) == migrator.get_compress_options(info)
+            assert jp2.read_xmp(jp2_filepath) == jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            assert [result.status for result in migrator.migrate([jp2_filepath])] == [migration.UNCHANGED]
+
+    def test_lossy_files_fail_and_are_left_alone(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'page1.jp2')
+            shutil.copy(filepaths.LOSSY_JP2_FROM_STANDARD_TIF, jp2_filepath)
+            ledger = MigrationLedger(os.path.join(output_folder, 'ledger.db'))
+            results = Migrator(ledger=ledger).migrate([jp2_filepath])
+            assert results[0].status == migration.FAILED
+            assert 'Lossy' in results[0].error
+            assert ledger.counts() == {migration.FAILED: 1}
+            with open(jp2_filepath, 'rb') as migrated, open(filepaths.LOSSY_JP2_FROM_STANDARD_TIF, 'rb') as f:
+                assert migrated.read() == f.read()
+
+    def test_transcodes_when_only_markers_change(self):
+        with temporary_folder() as output_folder:
+            info = jp2.read_codestream_info(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            jp2_filepath = _jp2_with_recipe(output_folder, Migrator().get_compress_options(info))
+            migrator = Migrator(kakadu_compress_options=kakadu.replace_option(
+                kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS, 'Corder', 'LRCP'))
+            assert migrator.migrate([jp2_filepath]) == [
+                migration.MigratedFile(jp2_filepath, migration.MIGRATED, migration.TRANSCODE, None)]
+            assert jp2.read_codestream_info(jp2_filepath).progression_order == 'LRCP'
+            assert kakadu.read_recipe(jp2_filepath) == migrator.get_compress_options(info)
+            assert jp2.read_xmp(jp2_filepath) == jp2.read_xmp(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP)
+            assert os.listdir(os.path.dirname(jp2_filepath)) == ['page1.jp2']
+
+    def test_failed_migrations_leave_the_file_alone(self):
+        with temporary_folder() as output_folder:
+            jp2_filepath = os.path.join(output_folder, 'page1.jp2')
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, jp2_filepath)
+            ledger = MigrationLedger(os.path.join(output_folder, 'ledger.db'))
+            # kdu_compress rejects the unknown parameter
+            migrator = Migrator(ledger=ledger, compress_options_policy=lambda options, probe: options + ['Cbogus=yes'])
+            results = migrator.migrate([jp2_filepath])
+            assert results[0].status == migration.FAILED
+            assert ledger.counts() == {migration.FAILED: 1}
+            with open(jp2_filepath, 'rb') as migrated, open(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, 'rb') as f:
+                assert migrated.read() == f.read()
+            assert not any(filename.startswith('.') for filename in os.listdir(output_folder))
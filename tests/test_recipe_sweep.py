@@ -0,0 +1,95 @@
+import os
+
+from PIL import Image
+
+from image_processing import kakadu, recipe_sweep
+from .test_utils import filepaths, temporary_folder
+
+
+def make_result(variant, lossless=True, **metrics):
+    values = dict((metric, 1.0) for metric in recipe_sweep.METRICS)
+    values.update(metrics)
+    return recipe_sweep.SweepResult(variant=variant, kakadu_options=['Corder={0}'.format(variant['Corder'])],
+                                    source_file='test.tif', lossless=lossless, **values)
+
+
+class TestRecipeSweep(object):
+    def test_replace_option(self):
+        options = kakadu.DEFAULT_COMPRESS_OPTIONS
+        assert 'Stiles={1024,1024}' in kakadu.replace_option(options, 'Stiles', '{1024,1024}')
+        assert 'Stiles={512,512}' not in kakadu.replace_option(options, 'Stiles', '{1024,1024}')
+        assert not any(o.startswith('Stiles=') for o in kakadu.replace_option(options, 'Stiles', None))
+        assert kakadu.replace_option(options, 'ORGgen_tlm', 6)[-1] == 'ORGgen_tlm=6'
+        flush_options = kakadu.replace_option(options, '-flush_period', 2048)
+        assert flush_options[flush_options.index('-flush_period') + 1] == '2048'
+        assert '-flush_period' not in kakadu.replace_option(options, '-flush_period', None)
+        assert options == kakadu.DEFAULT_COMPRESS_OPTIONS
+
+    def test_get_option(self):
+        options = kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS
+        assert kakadu.get_option(options, 'Clevels') == '6'
+        assert kakadu.get_option(options, '-rate') == '-'
+        assert kakadu.get_option(options, 'Cmodes') is None
+        assert kakadu.get_option(options, '-no_weights') is None
+
+    def test_default_policy_adapts_levels_and_tiles(self):
+        options = kakadu.DEFAULT_LOSSLESS_COMPRESS_OPTIONS
+        policy = kakadu.default_compress_options_policy
+        # a typical page scan is left alone
+        assert policy(options, kakadu.ImageProbe(1350, 1020, 'RGB', 8, 3)) == options
+        assert policy(options, kakadu.ImageProbe(8000, 6000, 'RGB', 8, 3)) == options
+        thumbnail_options = policy(options, kakadu.ImageProbe(300, 200, 'L', 8, 1))
+        assert kakadu.get_option(thumbnail_options, 'Clevels') == '4'
+        assert thumbnail_options == kakadu.replace_option(options, 'Clevels', 4)
+        map_options = policy(options, kakadu.ImageProbe(60000, 40000, 'RGB', 8, 3))
+        assert kakadu.get_option(map_options, 'Stiles') == '{1024,1024}'
+        assert kakadu.get_option(map_options, 'Clevels') == '6'
+        assert kakadu.get_option(policy(options, kakadu.ImageProbe(200000, 1000, '1', 1, 1)), 'Clevels') == '8'
+
+    def test_option_variants(self):
+        variants = recipe_sweep.option_variants({'Corder': ['RPCL', 'PCRL'], 'Stiles': ['{512,512}', '{1024,1024}']})
+        assert len(variants) == 4
+        for variant, options in variants:
+            assert 'Corder={0}'.format(variant['Corder']) in options
+            assert 'Stiles={0}'.format(variant['Stiles']) in options
+            assert len(options) == len(kakadu.DEFAULT_COMPRESS_OPTIONS)
+
+    def test_rank_variants(self):
+        results = [make_result({'Corder': 'RPCL'}, output_bytes=100.0),
+                   make_result({'Corder': 'PCRL'}, output_bytes=50.0),
+                   make_result({'Corder': 'LRCP'}, lossless=False, output_bytes=10.0)]
+        ranked = recipe_sweep.rank_variants(results)
+        assert [r['variant']['Corder'] for r in ranked] == ['PCRL', 'RPCL']
+        assert ranked[0]['score'] == len(recipe_sweep.METRICS)
+        assert 'PCRL' in recipe_sweep.format_table(ranked)
+
+    def test_rank_variants_over_rgb_and_rgba_sources(self):
+        rgba_result = make_result({'Corder': 'RPCL'}, output_bytes=100.0)._replace(
+            source_file='rgba.tif', kakadu_options=['Corder=RPCL', kakadu.ALPHA_OPTION])
+        results = [make_result({'Corder': 'RPCL'}, output_bytes=10.0), rgba_result,
+                   make_result({'Corder': 'PCRL'}, output_bytes=60.0),
+                   make_result({'Corder': 'PCRL'}, output_bytes=60.0)._replace(source_file='rgba.tif')]
+        ranked = recipe_sweep.rank_variants(results)
+        assert [(r['variant']['Corder'], r['output_bytes']) for r in ranked] == [('RPCL', 110.0), ('PCRL', 120.0)]
+        assert ranked[0]['kakadu_options'] == ['Corder=RPCL']
+
+    def test_run_sweep_over_rgb_and_rgba_sources(self):
+        with temporary_folder() as output_folder:
+            rgba_filepath = os.path.join(output_folder, 'rgba.tif')
+            with Image.open(filepaths.STANDARD_TIF) as source:
+                source.convert('RGBA').save(rgba_filepath)
+            results = recipe_sweep.run_sweep(filepaths.KAKADU_BASE_PATH, [filepaths.STANDARD_TIF, rgba_filepath],
+                                             {'Corder': ['RPCL', 'PCRL']}, region_size=256)
+        assert all(kakadu.ALPHA_OPTION not in result.kakadu_options for result in results)
+        ranked = recipe_sweep.rank_variants(results)
+        assert len(ranked) == 2
+        for summary in ranked:
+            assert summary['output_bytes'] == sum(result.output_bytes for result in results
+                                                  if result.variant == summary['variant'])
+
+    def test_run_sweep(self):
+        results = recipe_sweep.run_sweep(filepaths.KAKADU_BASE_PATH, [filepaths.STANDARD_TIF],
+                                         {'Corder': ['RPCL', 'PCRL']}, region_size=256)
+        assert len(results) == 2
+        assert all(result.lossless for result in results)
+        assert len(recipe_sweep.rank_variants(results)) == 2
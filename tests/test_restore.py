@@ -0,0 +1,95 @@
+import os
+import shutil
+
+from PIL import Image
+
+from image_processing import restore, validation, xmp
+from image_processing.restore import Restorer
+from .test_utils import temporary_folder, filepaths
+
+
+def _write_manifest(folder, lines):
+    manifest_filepath = os.path.join(folder, 'manifest.txt')
+    with open(manifest_filepath, 'w') as manifest_file:
+        manifest_file.write('\n'.join(lines) + '\n')
+    return manifest_filepath
+
+
+class TestManifest(object):
+    def test_reads_sha256sum_format(self):
+        with temporary_folder() as output_folder:
+            manifest_filepath = _write_manifest(output_folder, [
+                '# pixel checksums recorded at ingest',
+                'ABC123  volume1/page 1.jp2',
+                '',
+                'def456 *volume1/page2.jp2'])
+            manifest = restore.read_manifest(manifest_filepath)
+        assert list(manifest.items()) == [('volume1/page 1.jp2', 'abc123'), ('volume1/page2.jp2', 'def456')]
+
+    def test_restores_to_the_same_relative_path(self):
+        tiff_filepath = restore.tiff_filepath_for('/jp2/volume1/page1.jp2', '/jp2', '/tiff')
+        assert tiff_filepath == os.path.join('/tiff', 'volume1', 'page1.tif')
+        assert restore.partial_filepath_for(tiff_filepath) == os.path.join('/tiff', 'volume1', '.page1.partial.tif')
+
+
+class TestRestorer(object):
+    def test_skips_tiffs_already_restored(self):
+        with temporary_folder() as output_folder:
+            tiff_filepath = os.path.join(output_folder, 'tiff', 'page1.tif')
+            os.makedirs(os.path.dirname(tiff_filepath))
+            shutil.copy(filepaths.STANDARD_TIF, tiff_filepath)
+            results = Restorer().restore({'page1.jp2': 'unchecked'}, os.path.join(output_folder, 'jp2'),
+                                         os.path.join(output_folder, 'tiff'))
+        assert [result.status for result in results] == [restore.SKIPPED]
+
+    def test_failures_are_reported_without_leaving_partial_files(self):
+        with temporary_folder() as output_folder:
+            jp2_folder = os.path.join(output_folder, 'jp2')
+            tiff_folder = os.path.join(output_folder, 'tiff')
+            os.makedirs(jp2_folder)
+            with open(os.path.join(jp2_folder, 'broken.jp2'), 'wb') as broken_file:
+                broken_file.write(b'not a jp2')
+            results = Restorer().restore({'broken.jp2': 'abc', 'missing.jp2': 'def'}, jp2_folder, tiff_folder)
+            assert [result.status for result in results] == [restore.FAILED, restore.FAILED]
+            assert all(result.error for result in results)
+            assert os.listdir(tiff_folder) == []
+
+    def test_restores_and_verifies_tiffs(self):
+        pixel_checksum = validation.generate_pixel_checksum(filepaths.STANDARD_TIF)
+        with temporary_folder() as output_folder:
+            jp2_folder = os.path.join(output_folder, 'jp2')
+            tiff_folder = os.path.join(output_folder, 'tiff')
+            os.makedirs(os.path.join(jp2_folder, 'volume1'))
+            shutil.copy(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF_XMP, os.path.join(jp2_folder, 'volume1', 'page1.jp2'))
+            manifest_filepath = _write_manifest(output_folder, ['{0}  volume1/page1.jp2'.format(pixel_checksum)])
+
+            assert restore.main([jp2_folder, tiff_folder, '--manifest', manifest_filepath, '--workers', '2',
+                                 '--kakadu-threads', '1']) == 0
+            tiff_filepath = os.path.join(tiff_folder, 'volume1', 'page1.tif')
+            assert validation.generate_pixel_checksum(tiff_filepath) == pixel_checksum
+            assert xmp.read_embedded_metadata(tiff_filepath) is not None
+            assert os.listdir(os.path.join(tiff_folder, 'volume1')) == ['page1.tif']
+
+            # a second run resumes, skipping what has been restored
+            results = Restorer(verify_existing=True).restore(
+                restore.read_manifest(manifest_filepath), jp2_folder, tiff_folder)
+            assert [result.status for result in results] == [restore.SKIPPED]
+
+    def test_restores_bitonal_tiffs(self):
+        pixel_checksum = validation.generate_pixel_checksum(filepaths.BILEVEL_TIF)
+        with temporary_folder() as output_folder:
+            tiff_filepath = os.path.join(output_folder, 'page1.tif')
+            result = Restorer()._restore_safely(filepaths.LOSSLESS_JP2_FROM_BILEVEL_TIF_XMP, tiff_filepath,
+                                                pixel_checksum)
+            assert result.status == restore.RESTORED
+            with Image.open(tiff_filepath) as tiff_pil:
+                assert tiff_pil.mode == validation.BITONAL
+            validation.check_visually_identical(filepaths.BILEVEL_TIF, tiff_filepath)
+
+    def test_mismatched_pixels_are_not_published(self):
+        with temporary_folder() as output_folder:
+            tiff_filepath = os.path.join(output_folder, 'page1.tif')
+            result = Restorer()._restore_safely(filepaths.LOSSLESS_JP2_FROM_STANDARD_TIF, tiff_filepath, '0' * 64)
+            assert result.status == restore.FAILED
+            assert 'recorded at ingest' in result.error
+            assert os.listdir(output_folder) == []
@@ -0,0 +1,137 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from image_processing import utils, kakadu, openjpeg
+from image_processing.derivative_files_generator import StageTimeouts
+from image_processing.exceptions import CommandTimeoutError
+from .test_utils import temporary_folder
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # a zombie has exited, but hasn't been reaped by its parent yet
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat_file:
+            return stat_file.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+        return True
+
+
+class TestRunCommand(object):
+    def test_runs_command(self):
+        with temporary_folder() as output_folder:
+            output_filepath = os.path.join(output_folder, 'touched')
+            utils.run_command(['touch', output_filepath], timeout=10)
+            assert os.path.isfile(output_filepath)
+
+    def test_raises_error_when_command_fails(self):
+        with pytest.raises(subprocess.CalledProcessError) as e:
+            utils.run_command(['sh', '-c', 'exit 3'], timeout=10)
+        assert e.value.returncode == 3
+
+    def test_captures_output(self):
+        assert utils.run_command(['sh', '-c', 'echo out; echo err >&2'], capture_output=True) == 'out\nerr\n'
+        with pytest.raises(subprocess.CalledProcessError) as e:
+            utils.run_command(['sh', '-c', 'echo failed; exit 1'], capture_output=True)
+        assert e.value.output == 'failed\n'
+
+    def test_times_out(self):
+        start = time.time()
+        with pytest.raises(CommandTimeoutError) as e:
+            utils.run_command(['sleep', '30'], timeout=0.5)
+        assert time.time() - start < 10
+        assert e.value.timeout == 0.5
+        assert e.value.command == ['sleep', '30']
+
+    def test_kills_process_group_on_timeout(self):
+        with temporary_folder() as output_folder:
+            pid_filepath = os.path.join(output_folder, 'child.pid')
+            with pytest.raises(CommandTimeoutError):
+                utils.run_command(['sh', '-c', 'sleep 30 & echo $! > {0}; wait'.format(pid_filepath)], timeout=0.5)
+            with open(pid_filepath) as pid_file:
+                child_pid = int(pid_file.read())
+            time.sleep(0.2)
+            assert not process_exists(child_pid)
+
+    def test_kills_stray_children_when_command_exits(self):
+        with temporary_folder() as output_folder:
+            pid_filepath = os.path.join(output_folder, 'child.pid')
+            utils.run_command(['sh', '-c', 'sleep 30 & echo $! > {0}'.format(pid_filepath)], timeout=10)
+            with open(pid_filepath) as pid_file:
+                child_pid = int(pid_file.read())
+            time.sleep(0.2)
+            assert not process_exists(child_pid)
+
+    def test_limits_memory(self):
+        allocate = [sys.executable, '-c', 'b = bytearray(1024 ** 3)']
+        with pytest.raises(subprocess.CalledProcessError):
+            utils.run_command(allocate, timeout=30,
+                              resource_limits=utils.ResourceLimits(max_memory_bytes=512 * 1024 ** 2))
+
+    def test_cpu_limit_is_a_timeout(self):
+        with pytest.raises(CommandTimeoutError):
+            utils.run_command([sys.executable, '-c', 'while True: pass'], timeout=30,
+                              resource_limits=utils.ResourceLimits(max_cpu_seconds=1))
+
+
+class TestStageTimeouts(object):
+    def test_scales_kakadu_timeouts_with_megapixels(self):
+        stage_timeouts = StageTimeouts(kdu_compress=(10, 2.0), exiftool=5)
+        assert stage_timeouts.kakadu_timeout('kdu_compress', 1000, 1000) == 12
+        assert stage_timeouts.kakadu_timeout('kdu_compress', 10000, 5000) == 110
+        assert stage_timeouts.exiftool == 5
+
+
+KDU_COMPRESS_STATS_OUTPUT = """Kakadu Core Warning:
+Unassociated alpha channel found in the source image; it will be treated as
+an opacity channel.
+
+Generated 12 tile-part(s) for a total of 6 tile(s).
+Code-stream bytes (excluding any file format) = 2,416,093 = 14.037283 bits/pel.
+Compressed data rate (excluding any file format) = 14.037283 bits/pel.
+Layer bit-rates (possibly inexact if tiles are divided across tile-parts):
+        0.302117, 0.604261, 1.208463, 2.416962, 4.833873,
+        14.037283
+Layer thresholds:
+        53456, 50800, 48048, 45064, 41440, 0
+Processed using the multi-threaded environment, with
+    8 parallel threads of execution (see `-num_threads')
+End-to-end CPU time = 0.812 seconds (includes I/O)
+"""
+
+
+class TestCommandStats(object):
+    def test_parses_kakadu_stats(self):
+        stats = kakadu.parse_stats('kdu_compress', KDU_COMPRESS_STATS_OUTPUT, wall_seconds=0.3)
+        assert stats.command == 'kdu_compress'
+        assert stats.wall_seconds == 0.3
+        assert stats.cpu_seconds == 0.812
+        assert stats.threads == 8
+        assert stats.layer_bitrates == [0.302117, 0.604261, 1.208463, 2.416962, 4.833873, 14.037283]
+        assert stats.layer_thresholds == [53456, 50800, 48048, 45064, 41440, 0]
+        assert stats.codestream_bytes == 2416093
+        assert stats.bits_per_pixel == 14.037283
+        assert (stats.tile_count, stats.tile_part_count) == (6, 12)
+        assert stats.warnings == ['Unassociated alpha channel found in the source image; it will be treated as '
+                                  'an opacity channel.']
+
+    def test_unrecognised_kakadu_output_is_left_out(self):
+        stats = kakadu.parse_stats('kdu_expand', 'Kakadu Version 7.10\n')
+        assert stats.cpu_seconds is None
+        assert stats.layer_bitrates is None
+        assert stats.codestream_bytes is None
+        assert stats.warnings == []
+
+    def test_parses_openjpeg_stats(self):
+        stats = openjpeg.parse_stats('opj_compress', '[WARNING] Tile part 0 has no data\n'
+                                                     '[INFO] Generated outfile output.jp2\n'
+                                                     'encode time: 250 ms \n', wall_seconds=0.3)
+        assert stats.codec_seconds == 0.25
+        assert stats.warnings == ['Tile part 0 has no data']
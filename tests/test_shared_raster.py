@@ -0,0 +1,81 @@
+import hashlib
+import multiprocessing
+import sys
+
+import pytest
+from PIL import Image
+
+from image_processing import validation
+from image_processing.exceptions import ImageProcessingError
+from .test_utils import filepaths
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 8), reason="multiprocessing.shared_memory needs Python 3.8")
+
+
+def checksum_in_other_process(name, results):
+    from image_processing.shared_raster import SharedRaster
+    with SharedRaster.attach(name) as shared_raster:
+        results.put((shared_raster.pixel_checksum(), shared_raster.reference_count))
+
+
+class TestSharedRaster(object):
+    def test_decodes_image_into_shared_memory(self):
+        from image_processing.shared_raster import SharedRaster
+        with Image.open(filepaths.STANDARD_TIF) as image_pil:
+            expected_pixels = image_pil.tobytes()
+            expected_icc_profile = image_pil.info['icc_profile']
+            expected_size = image_pil.size
+        with SharedRaster.create(filepaths.STANDARD_TIF, band_height=7) as shared_raster:
+            assert shared_raster.mode == 'RGB'
+            assert shared_raster.size == expected_size
+            assert shared_raster.icc_profile == expected_icc_profile
+            assert bytes(shared_raster.pixels()) == expected_pixels
+            assert shared_raster.pixel_checksum() == hashlib.sha256(expected_pixels).hexdigest()
+
+            image_pil = shared_raster.as_image()
+            assert image_pil.tobytes() == expected_pixels
+            assert image_pil.info['icc_profile'] == expected_icc_profile
+
+    def test_array_view_is_backed_by_shared_memory(self):
+        numpy = pytest.importorskip('numpy')
+        from image_processing.shared_raster import SharedRaster
+        with SharedRaster.create(filepaths.GREYSCALE_TIF) as shared_raster:
+            array = shared_raster.as_array()
+            width, height = shared_raster.size
+            assert array.shape == (height, width)
+            assert not array.flags['OWNDATA']
+            assert not array.flags['WRITEABLE']
+            with Image.open(filepaths.GREYSCALE_TIF) as image_pil:
+                assert numpy.array_equal(array, numpy.asarray(image_pil))
+            del array
+
+    def test_shares_raster_with_other_processes(self):
+        from image_processing.shared_raster import SharedRaster
+        results = multiprocessing.Queue()
+        with SharedRaster.create(filepaths.STANDARD_TIF) as shared_raster:
+            process = multiprocessing.Process(target=checksum_in_other_process, args=(shared_raster.name, results))
+            process.start()
+            checksum, reference_count = results.get(timeout=30)
+            process.join()
+            assert checksum == shared_raster.pixel_checksum()
+            assert reference_count == 2
+            # the other process's reference was released when it finished
+            assert shared_raster.reference_count == 1
+
+    def test_removes_block_after_last_release(self):
+        from image_processing.shared_raster import SharedRaster
+        shared_raster = SharedRaster.create(filepaths.BILEVEL_TIF)
+        name = shared_raster.name
+        consumer = SharedRaster.attach(name)
+        shared_raster.release()
+        assert consumer.reference_count == 1
+        consumer.release()
+        with pytest.raises((OSError, ImageProcessingError)):
+            SharedRaster.attach(name)
+
+    def test_pixel_checksum_matches_the_file(self):
+        from image_processing.shared_raster import SharedRaster
+        for image_filepath in [filepaths.STANDARD_TIF, filepaths.GREYSCALE_TIF, filepaths.BILEVEL_TIF]:
+            with SharedRaster.create(image_filepath) as shared_raster:
+                assert validation.generate_pixel_checksum(image_filepath, shared_raster=shared_raster) == \
+                    validation.generate_pixel_checksum(image_filepath)
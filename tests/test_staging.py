@@ -0,0 +1,81 @@
+import filecmp
+import hashlib
+import os
+import stat
+
+import pytest
+
+from image_processing import utils
+from .test_utils import temporary_folder, filepaths
+
+
+class TestStaging(object):
+    def test_places_file(self):
+        with temporary_folder() as output_folder:
+            output_filepath = os.path.join(output_folder, 'placed.tif')
+            method = utils.place_file(filepaths.STANDARD_TIF, output_filepath)
+            assert method in ['reflink', 'copy_file_range', 'copy']
+            assert filecmp.cmp(filepaths.STANDARD_TIF, output_filepath, shallow=False)
+            assert stat.S_IMODE(os.stat(output_filepath).st_mode) == \
+                stat.S_IMODE(os.stat(filepaths.STANDARD_TIF).st_mode)
+
+    def test_places_file_as_hardlink(self):
+        with temporary_folder() as output_folder:
+            source_filepath = os.path.join(output_folder, 'source.tif')
+            utils.place_file(filepaths.STANDARD_TIF, source_filepath)
+            output_filepath = os.path.join(output_folder, 'placed.tif')
+            method = utils.place_file(source_filepath, output_filepath, allow_hardlink=True)
+            if method == 'hardlink':
+                assert os.path.samefile(source_filepath, output_filepath)
+            assert filecmp.cmp(source_filepath, output_filepath, shallow=False)
+
+    def test_replacing_a_hardlink_of_the_source_keeps_the_source(self):
+        with temporary_folder() as output_folder:
+            source_filepath = os.path.join(output_folder, 'source.tif')
+            utils.place_file(filepaths.STANDARD_TIF, source_filepath)
+            output_filepath = os.path.join(output_folder, 'placed.tif')
+            os.link(source_filepath, output_filepath)
+
+            assert utils.place_file(source_filepath, output_filepath, allow_hardlink=True) == 'hardlink'
+            assert filecmp.cmp(filepaths.STANDARD_TIF, source_filepath, shallow=False)
+
+            assert utils.place_file(source_filepath, output_filepath) != 'hardlink'
+            assert not os.path.samefile(source_filepath, output_filepath)
+            assert filecmp.cmp(filepaths.STANDARD_TIF, source_filepath, shallow=False)
+            assert filecmp.cmp(filepaths.STANDARD_TIF, output_filepath, shallow=False)
+            assert sorted(os.listdir(output_folder)) == ['placed.tif', 'source.tif']
+
+    def test_publishes_staged_files(self):
+        with temporary_folder() as output_folder:
+            with utils.StagingFolder(output_folder) as staging_folder:
+                staged_filepath = staging_folder.filepath('full.xmp')
+                with open(staged_filepath, 'w') as f:
+                    f.write('staged')
+                assert os.listdir(output_folder) == [os.path.basename(staging_folder.staging_folder)]
+                published = staging_folder.publish([staged_filepath])
+            assert published == [os.path.join(output_folder, 'full.xmp')]
+            assert os.listdir(output_folder) == ['full.xmp']
+
+    def test_publishes_staged_folders(self):
+        with temporary_folder() as output_folder:
+            os.makedirs(os.path.join(output_folder, 'iiif', 'old'))
+            with utils.StagingFolder(output_folder) as staging_folder:
+                staged_folder = staging_folder.filepath('iiif')
+                os.makedirs(os.path.join(staged_folder, 'new'))
+                assert staging_folder.publish([staged_folder]) == [os.path.join(output_folder, 'iiif')]
+            assert os.listdir(os.path.join(output_folder, 'iiif')) == ['new']
+            assert os.listdir(output_folder) == ['iiif']
+
+    def test_discards_unpublished_files(self):
+        with temporary_folder() as output_folder:
+            with pytest.raises(ValueError):
+                with utils.StagingFolder(output_folder) as staging_folder:
+                    with open(staging_folder.filepath('full_lossless.jp2'), 'w') as f:
+                        f.write('half written')
+                    raise ValueError()
+            assert os.listdir(output_folder) == []
+
+    def test_file_checksum(self):
+        with open(filepaths.STANDARD_TIF, 'rb') as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        assert utils.file_checksum(filepaths.STANDARD_TIF) == expected
@@ -0,0 +1,55 @@
+import filecmp
+import os
+
+import pytest
+from PIL import Image
+
+from image_processing import storage
+from .test_utils import temporary_folder, filepaths
+
+
+class TestStorage(object):
+    def test_local_storage_round_trip(self):
+        with temporary_folder() as storage_folder, temporary_folder() as local_folder:
+            local_storage = storage.LocalStorage(storage_folder)
+            local_storage.upload(filepaths.STANDARD_TIF, 'masters/standard.tif')
+            assert os.listdir(os.path.join(storage_folder, 'masters')) == ['standard.tif']
+            assert local_storage.size('masters/standard.tif') == os.path.getsize(filepaths.STANDARD_TIF)
+            with local_storage.open('masters/standard.tif') as f:
+                with Image.open(f) as image_pil:
+                    assert image_pil.size == (1350, 1020)
+
+            downloaded_filepath = os.path.join(local_folder, 'downloaded.tif')
+            local_storage.download('masters/standard.tif', downloaded_filepath)
+            assert filecmp.cmp(filepaths.STANDARD_TIF, downloaded_filepath, shallow=False)
+            local_storage.delete('masters/standard.tif')
+            assert os.listdir(os.path.join(storage_folder, 'masters')) == []
+
+    def test_local_storage_rejects_keys_outside_root(self):
+        with temporary_folder() as storage_folder:
+            with pytest.raises(ValueError):
+                storage.LocalStorage(storage_folder).filepath('../outside.tif')
+
+    def test_joins_keys(self):
+        assert storage.join_key('', 'full.jp2') == 'full.jp2'
+        assert storage.join_key('derivatives/', 'full.jp2') == 'derivatives/full.jp2'
+        assert storage.join_key('derivatives', 'full.jp2') == 'derivatives/full.jp2'
+
+    def test_s3_storage_round_trip(self):
+        boto3 = pytest.importorskip('boto3')
+        moto = pytest.importorskip('moto')
+        mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+        with mock_aws(), temporary_folder() as local_folder:
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='images')
+            s3_storage = storage.S3Storage('images', client=client, read_buffer_size=4096,
+                                           multipart_threshold=5 * 1024 * 1024, multipart_chunk_size=5 * 1024 * 1024)
+            s3_storage.upload(filepaths.STANDARD_TIF, 'masters/standard.tif')
+            with s3_storage.open('masters/standard.tif') as f:
+                with Image.open(f) as image_pil:
+                    assert image_pil.size == (1350, 1020)
+                    assert image_pil.info['icc_profile']
+
+            downloaded_filepath = os.path.join(local_folder, 'downloaded.tif')
+            s3_storage.download('masters/standard.tif', downloaded_filepath)
+            assert filecmp.cmp(filepaths.STANDARD_TIF, downloaded_filepath, shallow=False)
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+from image_processing import watch_folder
+from image_processing.exceptions import ValidationError
+from .test_utils import temporary_folder, filepaths
+
+
+class RecordingGenerator(object):
+    """Stands in for DerivativeFilesGenerator, so the daemon can be tested without kakadu"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.converted = []
+
+    def generate_derivatives_from_tiff(self, tiff_filepath, output_folder, **kwargs):
+        if self.fail:
+            raise ValidationError('Not convertible')
+        self.converted.append(os.path.basename(tiff_filepath))
+        with open(os.path.join(output_folder, 'full_lossless.jp2'), 'w') as f:
+            f.write('jp2')
+
+
+def get_ingest(generator, hot_folder, output_folder, **kwargs):
+    return watch_folder.WatchFolderIngest(generator, [hot_folder], output_folder, settle_seconds=10,
+                                          min_free_bytes=0, use_inotify=False, **kwargs)
+
+
+class TestWatchFolder(object):
+    def test_waits_for_files_to_settle(self):
+        with temporary_folder() as hot_folder, temporary_folder() as output_folder:
+            ingest = get_ingest(RecordingGenerator(), hot_folder, output_folder)
+            shutil.copy(filepaths.STANDARD_TIF, os.path.join(hot_folder, 'page1.tif'))
+            with open(os.path.join(hot_folder, 'notes.txt'), 'w') as f:
+                f.write('not an image')
+            assert ingest.find_ready_files(now=100) == []
+            assert ingest.find_ready_files(now=105) == []
+            with open(os.path.join(hot_folder, 'page1.tif'), 'ab') as f:
+                f.write(b'still copying')
+            assert ingest.find_ready_files(now=112) == []
+            assert ingest.find_ready_files(now=122) == [os.path.abspath(os.path.join(hot_folder, 'page1.tif'))]
+
+    def test_moves_converted_and_failed_files(self):
+        with temporary_folder() as hot_folder, temporary_folder() as output_folder:
+            source_filepath = os.path.join(hot_folder, 'page1.tif')
+            shutil.copy(filepaths.STANDARD_TIF, source_filepath)
+            generator = RecordingGenerator()
+            assert get_ingest(generator, hot_folder, output_folder).process_file(source_filepath)
+            assert generator.converted == ['page1.tif']
+            assert os.listdir(os.path.join(output_folder, 'page1')) == ['full_lossless.jp2']
+            assert os.listdir(os.path.join(hot_folder, watch_folder.DONE_FOLDER_NAME)) == ['page1.tif']
+
+            shutil.copy(filepaths.STANDARD_TIF, source_filepath)
+            assert not get_ingest(RecordingGenerator(fail=True), hot_folder, output_folder).process_file(
+                source_filepath)
+            assert sorted(os.listdir(os.path.join(hot_folder, watch_folder.FAILED_FOLDER_NAME))) == \
+                ['page1.tif', 'page1.tif.error.txt']
+            assert sorted(os.listdir(hot_folder)) == [watch_folder.DONE_FOLDER_NAME, watch_folder.FAILED_FOLDER_NAME]
+
+    def test_applies_back_pressure(self):
+        with temporary_folder() as hot_folder, temporary_folder() as output_folder:
+            ingest = get_ingest(RecordingGenerator(), hot_folder, output_folder, workers=1)
+            assert ingest.has_capacity()
+            ingest.min_free_bytes = watch_folder.free_bytes(output_folder) * 2
+            assert not ingest.has_capacity()
@@ -0,0 +1,43 @@
+import os
+import re
+
+from PIL import Image
+
+from image_processing import xmp
+from .test_utils import temporary_folder, filepaths
+
+
+def get_sidecar_without_icc_profile_name():
+    with open(filepaths.STANDARD_TIF_XMP, 'rb') as f:
+        sidecar = f.read()
+    return sidecar, re.sub(b'  <photoshop:ICCProfile>[^<]*</photoshop:ICCProfile>\n', b'', sidecar)
+
+
+class TestXmp(object):
+    def test_finds_metadata_that_needs_translating(self):
+        assert xmp.read_embedded_metadata(filepaths.STANDARD_TIF).untranslated == \
+            [271, 272, 274, 282, 283, 296, 305, 306, 318, 319, 33723, 34665]
+        assert xmp.read_embedded_metadata(filepaths.STANDARD_JPG).untranslated == ['APP0', 'APP1', 'APP13']
+
+    def test_reads_tiff_with_only_xmp(self):
+        sidecar, xmp_packet = get_sidecar_without_icc_profile_name()
+        with Image.open(filepaths.STANDARD_TIF) as image_pil:
+            icc_profile = image_pil.info['icc_profile']
+        with temporary_folder() as output_folder:
+            tiff_filepath = os.path.join(output_folder, 'xmp_only.tif')
+            Image.new('RGB', (8, 8)).save(tiff_filepath, tiffinfo={xmp.TIFF_XMP_TAG: xmp_packet},
+                                          icc_profile=icc_profile)
+            embedded_metadata = xmp.read_embedded_metadata(tiff_filepath)
+            assert embedded_metadata.untranslated == []
+            assert xmp.is_exiftool_packet(embedded_metadata.xmp)
+            assert xmp.set_icc_profile_name(xmp.to_sidecar(embedded_metadata.xmp),
+                                            xmp.get_icc_profile_name(embedded_metadata.icc_profile)) == sidecar
+
+    def test_adds_photoshop_description(self):
+        sidecar, _ = get_sidecar_without_icc_profile_name()
+        without_photoshop = re.sub(b" <rdf:Description rdf:about=''\n  xmlns:photoshop=.*?</rdf:Description>\n\n",
+                                   b'', sidecar, flags=re.DOTALL)
+        xmp_packet = xmp.set_icc_profile_name(without_photoshop, u'Adobe RGB (1998)')
+        assert xmp_packet.index(b'<photoshop:ICCProfile>Adobe RGB (1998)</photoshop:ICCProfile>') < \
+            xmp_packet.index(b'xmlns:tiff')
+        assert xmp_packet.index(b'xmlns:exifEX') < xmp_packet.index(b'xmlns:photoshop')